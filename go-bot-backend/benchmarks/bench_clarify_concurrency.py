@@ -0,0 +1,111 @@
+# bench_clarify_concurrency.py - Concurrent /clarify calls against a stubbed Claude upstream
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.bench_clarify_concurrency --concurrency 10 --latency 1.0
+#
+# The Anthropic API is replaced by an in-process httpx transport that sleeps for
+# --latency seconds before answering, so the numbers only measure how well one
+# worker overlaps requests. With a non-blocking client, N concurrent calls should
+# finish in roughly the time of one.
+import os
+import json
+import time
+import asyncio
+import argparse
+
+os.environ.setdefault("ENABLE_RATE_LIMITING", "false")
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("ANTHROPIC_API_KEY", None)
+
+import anthropic
+import httpx
+
+from go_bot_backend.app import app
+
+
+CLARIFICATION = {
+    "acceptanceCriteria": ["Given a user, when they log in, then they see the dashboard"],
+    "edgeCases": ["Expired session"],
+    "successMetrics": ["Login success rate > 99%"],
+    "testScenarios": ["Log in with valid credentials"],
+}
+
+
+def tool_call_stream(tool_input: dict) -> str:
+    """Server-sent events for a streamed record_clarification tool call"""
+    arguments = json.dumps(tool_input)
+    events = [
+        ("message_start", {"type": "message_start", "message": {
+            "id": "msg_bench", "type": "message", "role": "assistant", "model": "claude-sonnet-4-20250514",
+            "content": [], "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": 200, "output_tokens": 1},
+        }}),
+        ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {
+            "type": "tool_use", "id": "toolu_bench", "name": "record_clarification", "input": {},
+        }}),
+    ]
+    for start in range(0, len(arguments), 40):
+        events.append(("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {
+            "type": "input_json_delta", "partial_json": arguments[start:start + 40],
+        }}))
+    events += [
+        ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "tool_use", "stop_sequence": None},
+                           "usage": {"output_tokens": 100}}),
+        ("message_stop", {"type": "message_stop"}),
+    ]
+    return "".join(f"event: {event}\ndata: {json.dumps(data)}\n\n" for event, data in events)
+
+
+def stub_claude(latency: float) -> anthropic.AsyncAnthropic:
+    """Build an async Claude client whose upstream is a fixed-latency stub"""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        return httpx.Response(
+            200,
+            text=tool_call_stream(CLARIFICATION),
+            headers={"content-type": "text/event-stream"},
+        )
+
+    return anthropic.AsyncAnthropic(
+        api_key="bench",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+
+
+async def timed_batch(client: httpx.AsyncClient, n: int) -> float:
+    """Fire n /clarify requests at once and return the wall-clock time"""
+    # Distinct titles so the result cache doesn't coalesce the batch into one call
+    tickets = [
+        {"title": f"Add login page {time.time_ns()}-{i}", "description": "Users need to log in", "issueType": "Story"}
+        for i in range(n)
+    ]
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[client.post("/clarify", json=ticket) for ticket in tickets])
+    elapsed = time.perf_counter() - start
+    failed = [r.status_code for r in responses if r.status_code != 200]
+    if failed:
+        raise SystemExit(f"❌ {len(failed)} requests failed: {failed[:5]}")
+    return elapsed
+
+
+async def main(concurrency: int, latency: float):
+    async with app.router.lifespan_context(app):
+        app.state.claude = stub_claude(latency)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            single = await timed_batch(client, 1)
+            batch = await timed_batch(client, concurrency)
+
+    print(f"upstream latency:      {latency:.2f}s")
+    print(f"1 request:             {single:.2f}s")
+    print(f"{concurrency} concurrent requests: {batch:.2f}s ({batch / single:.2f}x single)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent /clarify benchmark")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=1.0, help="Stubbed upstream latency in seconds")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.latency))
@@ -0,0 +1,99 @@
+# bench_email.py - License key emails: inline Mailgun calls vs the background mailer
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.bench_email --emails 200 --latency 0.2
+#
+# Both modes send to benchmarks.fake_mailgun with --latency per API call.
+# "inline" is the old path: render the email and POST it from the request
+# handler on a fresh connection, one call per email. "queued" is
+# MailgunMailer: the handler only enqueues, and a background task batches
+# recipients into Mailgun API calls over one keep-alive client. "handler" is
+# the time a request spends on email; "delivered" is until the last email
+# has been accepted by the fake server.
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+from benchmarks.fake_mailgun import FakeMailgun
+from go_bot_backend.app import LICENSE_KEY_EMAIL
+from go_bot_backend.mailer import MailgunMailer
+
+
+def inline(fake: FakeMailgun, emails: int):
+    handler = []
+    started = time.perf_counter()
+    for i in range(emails):
+        call_started = time.perf_counter()
+        values = {"license_key": f"GOBOT-BENCH-{i:04d}", "plan_name": "Free", "gobot_limit": 10}
+        response = httpx.post(
+            f"{fake.url}/bench.example.com/messages",
+            auth=("api", "key-bench"),
+            data={
+                "from": "GoBot <gobot@gobot.ai>",
+                "to": f"user{i}@example.com",
+                "subject": LICENSE_KEY_EMAIL.subject.render(**values),
+                "text": LICENSE_KEY_EMAIL.text.render(**values),
+                "html": LICENSE_KEY_EMAIL.html.render(**values),
+            },
+            timeout=10,
+        )
+        response.raise_for_status()
+        handler.append(time.perf_counter() - call_started)
+    return handler, time.perf_counter() - started
+
+
+async def queued(fake: FakeMailgun, emails: int, batch_size: int, batch_window: float):
+    mailer = MailgunMailer(
+        "key-bench", "bench.example.com", "GoBot <gobot@gobot.ai>",
+        templates={"license_key": LICENSE_KEY_EMAIL},
+        api_base=fake.url,
+        batch_size=batch_size,
+        batch_window=batch_window,
+        retry_base=0.1,
+    )
+    await mailer.start()
+    handler = []
+    started = time.perf_counter()
+    for i in range(emails):
+        call_started = time.perf_counter()
+        mailer.send("license_key", f"user{i}@example.com",
+                    license_key=f"GOBOT-BENCH-{i:04d}", plan_name="Free", gobot_limit=10)
+        handler.append(time.perf_counter() - call_started)
+    await mailer.stop(timeout=300)
+    delivered = time.perf_counter() - started
+    stats = mailer.stats()
+    if stats["sent"] != emails:
+        raise RuntimeError(f"Only {stats['sent']} of {emails} emails delivered: {stats}")
+    return handler, delivered
+
+
+def report(label: str, handler, delivered: float, fake: FakeMailgun):
+    stats = fake.stats()
+    print(
+        f"{label:<7} handler p50 {statistics.median(handler) * 1000:8.3f} ms   "
+        f"max {max(handler) * 1000:8.3f} ms   delivered in {delivered:6.2f} s   "
+        f"{stats['requests']} API calls over {stats['connections']} connections"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Email delivery benchmark")
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per fake Mailgun call")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of calls answered with 503 (queued mode)")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-window", type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"{args.emails} emails, {args.latency * 1000:.0f} ms per Mailgun call")
+
+    fake = FakeMailgun(latency=args.latency).start()
+    report("inline", *inline(fake, args.emails), fake)
+    fake.stop()
+
+    fake = FakeMailgun(latency=args.latency, fail_rate=args.fail_rate).start()
+    report("queued", *asyncio.run(queued(fake, args.emails, args.batch_size, args.batch_window)), fake)
+    fake.stop()
@@ -0,0 +1,114 @@
+# bench_near_duplicates.py - Near-duplicate ticket detection: hit rate, precision and lookup time
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.bench_near_duplicates --tickets 5000 --queries 500 --threshold 0.85
+#
+# Indexes one install's synthetic tickets (templated, like the bench_rag
+# corpus, plus a customer name) in a NearDuplicateIndex and an exact
+# normalized-text hash, then looks up:
+#   copy        the template filled in again for another customer - the
+#               same request, should hit
+#   edited      the same ticket re-filed with a typo, a moved sentence and
+#               an extra word - should hit
+#   near miss   the same template asking for a different feature - must not hit
+#   unrelated   bug reports never stored - must not hit
+# A hit is wrong when the matched ticket asks for something else. "LSH
+# recall" is how many of the queries whose best exact Jaccard similarity is
+# at the threshold (found by brute force) the index found a match for.
+import time
+import random
+import argparse
+
+from benchmarks.bench_rag import FEATURES, edit, make_bug, make_request, near_miss, percentile
+from go_bot_backend.near_duplicates import NearDuplicateIndex, jaccard, shingles
+
+
+CUSTOMERS = [
+    "ACME Corp", "Globex", "Initech", "Umbrella Health", "Stark Industries", "Wayne Logistics",
+    "Hooli", "Vandelay Imports", "Soylent Foods", "Tyrell Systems", "Cyberdyne", "Wonka Retail",
+]
+
+
+def make_ticket(request: tuple, rng: random.Random) -> str:
+    feature, subject, surface, constraints = request
+    customer = rng.choice(CUSTOMERS)
+    reference = f"{rng.choice(['PROJ', 'CORE', 'WEB', 'OPS'])}-{rng.randint(100, 9999)}"
+    return (
+        f"Story\nAdd {feature} for {customer} {subject} in {surface} ({reference})\n"
+        f"As one of the {subject} at {customer} I want {feature} in {surface} so that I can work without asking support. "
+        f"Show a clear error when it fails and update the list of {feature} items right away. {' '.join(constraints)}"
+    )
+
+
+def normalized(text: str) -> str:
+    return " ".join(sorted(shingles(text, 1)))
+
+
+def run(tickets: int, queries: int, threshold: float, shingle_size: int, num_perm: int, seed: int):
+    rng = random.Random(seed)
+    index = NearDuplicateIndex(threshold, num_perm=num_perm, shingle_size=shingle_size, max_per_scope=tickets)
+    requests = [make_request(rng) for _ in range(tickets)]
+    corpus = [make_ticket(request, rng) for request in requests]
+
+    started = time.perf_counter()
+    for i, text in enumerate(corpus):
+        index.add("bench", text, i)
+    added = time.perf_counter() - started
+    exact = {normalized(text): i for i, text in enumerate(corpus)}
+    corpus_shingles = [shingles(text, shingle_size) for text in corpus]
+    print(f"{tickets} tickets, {shingle_size}-word shingles, {num_perm} hashes in {index.bands} bands of "
+          f"{index.rows}, threshold {threshold}: indexed in {added:.2f} s\n")
+
+    sources = rng.sample(range(tickets), min(queries, tickets))
+    kinds = {"copy": [], "edited": [], "near miss": [], "unrelated": []}
+    for i in sources:
+        kinds["copy"].append((make_ticket(requests[i], rng), requests[i]))
+        kinds["edited"].append((edit(corpus[i], rng), requests[i]))
+        other = near_miss(requests[i], rng)
+        kinds["near miss"].append((make_ticket(other, rng), other))
+        kinds["unrelated"].append((make_bug(requests[i], rng), None))
+
+    lookup_times, brute_times = [], []
+    print(f"{'queries':<10} {'exact hash':>10} {'minhash':>8} {'wrong':>6} {'LSH recall':>11} {'best jaccard p50':>17}")
+    for kind, pairs in kinds.items():
+        exact_hits = hits = wrong = eligible = found = 0
+        best_scores = []
+        for text, request in pairs:
+            exact_hits += normalized(text) in exact
+
+            started = time.perf_counter()
+            match = index.find("bench", text)
+            lookup_times.append(time.perf_counter() - started)
+            if match:
+                hits += 1
+                wrong += requests[match[0]] != request
+
+            # Ground truth: the best exact Jaccard similarity, by brute force
+            started = time.perf_counter()
+            query = shingles(text, shingle_size)
+            best = max(jaccard(query, stored) for stored in corpus_shingles)
+            brute_times.append(time.perf_counter() - started)
+            best_scores.append(best)
+            if best >= threshold:
+                eligible += 1
+                found += match is not None
+        n = len(pairs)
+        recall = f"{found / eligible:11.1%}" if eligible else f"{'-':>11}"
+        best_scores.sort()
+        print(f"{kind:<10} {exact_hits / n:10.1%} {hits / n:8.1%} {wrong / n:6.1%} {recall} {best_scores[n // 2]:17.3f}")
+
+    print(f"\nMinHash lookup:      p50 {percentile(lookup_times, 0.5) * 1e6:7.1f} µs   p99 {percentile(lookup_times, 0.99) * 1e6:7.1f} µs")
+    print(f"brute-force Jaccard: p50 {percentile(brute_times, 0.5) * 1e6:7.1f} µs   p99 {percentile(brute_times, 0.99) * 1e6:7.1f} µs")
+    print(f"{len(FEATURES)} features; index stats: {index.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Near-duplicate ticket detection benchmark")
+    parser.add_argument("--tickets", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--shingle-size", type=int, default=3)
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.tickets, args.queries, args.threshold, args.shingle_size, args.num_perm, args.seed)
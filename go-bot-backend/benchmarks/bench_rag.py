@@ -0,0 +1,194 @@
+# bench_rag.py - Similar ticket retrieval: recall, reuse precision and latency
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.bench_rag --tickets 5000 --queries 500
+#
+# Builds one install's worth of synthetic tickets (one template, so they
+# share most of their wording) in a LocalVectorIndex, then queries it with:
+#   edited      the same ticket re-filed: case, whitespace, a typo, a
+#               sentence moved, a word added - should be reused
+#   reworded    a third of the words dropped or swapped for synonyms -
+#               should be retrieved as similar
+#   near miss   the same ticket asking for a different feature - similar,
+#               but its result must not be reused
+#   unrelated   bug reports in other words, never stored
+# It reports recall@1/@k against the ticket each query came from, how often
+# a stored result would be reused, how often that result answers a
+# different request (a wrong answer), and embedding and search latency.
+import time
+import random
+import argparse
+import statistics
+
+import numpy as np
+
+from go_bot_backend.rag import HashingEmbedder, LocalVectorIndex
+
+
+FEATURES = [
+    "password reset", "two factor login", "CSV export", "PDF invoice", "dark mode", "audit log",
+    "bulk user import", "webhook retries", "search filters", "saved views", "team invitations",
+    "role permissions", "billing portal", "usage dashboard", "email digest", "Slack notifications",
+    "API rate limits", "file attachments", "comment mentions", "sprint report", "SSO with Okta",
+    "data retention policy", "mobile push alerts", "calendar sync", "offline mode",
+]
+SUBJECTS = ["admins", "customers", "project managers", "support agents", "guest users", "developers"]
+SURFACES = ["the settings page", "the dashboard", "the mobile app", "the public API", "the admin console", "the onboarding flow"]
+CONSTRAINTS = [
+    "It must work for accounts with more than 10,000 records.",
+    "Keep the response time under 200 ms.",
+    "Log every change for compliance.",
+    "Only paid plans get this feature.",
+    "Respect the user's locale and time zone.",
+    "Errors must be shown inline, not as a toast.",
+    "Do not send more than one email per hour.",
+    "Existing integrations must keep working unchanged.",
+]
+SYNONYMS = {
+    "add": "implement", "users": "people", "page": "screen", "show": "display", "error": "failure",
+    "update": "change", "create": "make", "remove": "delete", "email": "mail", "fast": "quick",
+    "allow": "let", "should": "must", "list": "table", "new": "fresh", "support": "handle",
+}
+
+
+def make_request(rng: random.Random) -> tuple:
+    """What a ticket asks for; tickets asking for the same thing may share a result"""
+    return (rng.choice(FEATURES), rng.choice(SUBJECTS), rng.choice(SURFACES), tuple(sorted(rng.sample(CONSTRAINTS, 2))))
+
+
+def make_ticket(request: tuple, rng: random.Random) -> str:
+    feature, subject, surface, constraints = request
+    reference = f"{rng.choice(['PROJ', 'CORE', 'WEB', 'OPS'])}-{rng.randint(100, 9999)}"
+    return (
+        f"Story\nAdd {feature} for {subject} in {surface} ({reference})\n"
+        f"As one of the {subject} I want {feature} in {surface} so that I can work without asking support. "
+        f"Show a clear error when it fails and update the list of {feature} items right away. {' '.join(constraints)}"
+    )
+
+
+def make_bug(request: tuple, rng: random.Random) -> str:
+    feature, subject, surface, constraints = request
+    return (
+        f"Bug\n{surface.capitalize()} crashes for {subject} using {feature}\n"
+        f"Steps: open {surface}, start {feature}, wait {rng.randint(2, 90)} seconds. "
+        f"Expected the {feature} screen, got a blank page and a 500 in the logs."
+    )
+
+
+def near_miss(request: tuple, rng: random.Random) -> tuple:
+    """The same request for a different feature"""
+    feature = rng.choice([feature for feature in FEATURES if feature != request[0]])
+    return (feature,) + request[1:]
+
+
+def edit(text: str, rng: random.Random) -> str:
+    """The same ticket filed again with cosmetic changes"""
+    sentences = text.split(". ")
+    if len(sentences) > 2:
+        i = rng.randrange(1, len(sentences))
+        sentences.insert(0, sentences.pop(i))
+    text = ". ".join(sentences)
+    words = text.split(" ")
+    i = rng.randrange(len(words))
+    if len(words[i]) > 4:
+        word = list(words[i])
+        j = rng.randrange(len(word) - 1)
+        word[j], word[j + 1] = word[j + 1], word[j]
+        words[i] = "".join(word)
+    words.insert(rng.randrange(len(words)), rng.choice(["please", "ASAP", "(see Slack)", "again"]))
+    return "  ".join(words).upper() if rng.random() < 0.2 else " ".join(words)
+
+
+def reword(text: str, rng: random.Random) -> str:
+    """The same request written differently"""
+    words = []
+    for word in text.split(" "):
+        roll = rng.random()
+        if roll < 0.2:
+            continue
+        if roll < 0.35:
+            word = SYNONYMS.get(word.lower(), word)
+        words.append(word)
+    return " ".join(words)
+
+
+def percentile(values, q: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(tickets: int, queries: int, dim: int, top_k: int, reuse: float, min_similarity: float, seed: int):
+    rng = random.Random(seed)
+    embedder = HashingEmbedder(dim)
+    index = LocalVectorIndex(dim, max_per_namespace=tickets)
+    requests = [make_request(rng) for _ in range(tickets)]
+    corpus = [make_ticket(request, rng) for request in requests]
+
+    started = time.perf_counter()
+    vectors = embedder.embed(corpus)
+    embed_batch = time.perf_counter() - started
+    index.upsert("bench", [(str(i), vector, {}) for i, vector in enumerate(vectors)])
+    print(f"{tickets} tickets, {dim} dims: embedded in {embed_batch:.2f} s "
+          f"({embed_batch / tickets * 1e6:.0f} µs per ticket)\n")
+
+    sources = rng.sample(range(tickets), min(queries, tickets))
+    kinds = {"edited": [], "reworded": [], "near miss": [], "unrelated": []}
+    for i in sources:
+        kinds["edited"].append((edit(corpus[i], rng), str(i), requests[i]))
+        kinds["reworded"].append((reword(corpus[i], rng), str(i), requests[i]))
+        other = near_miss(requests[i], rng)
+        kinds["near miss"].append((make_ticket(other, rng), None, other))
+        kinds["unrelated"].append((make_bug(requests[i], rng), None, None))
+
+    embed_times, query_times = [], []
+    print(f"{'queries':<10} {'recall@1':>9} {f'recall@{top_k}':>9} {'similar':>8} {'reused':>7} {'wrong reuse':>12} {'top score p50':>14}")
+    for kind, pairs in kinds.items():
+        hits_1 = hits_k = similar = reused = wrong = 0
+        top_scores = []
+        for text, source, request in pairs:
+            started = time.perf_counter()
+            vector = embedder.embed([text])[0]
+            embedded = time.perf_counter()
+            matches = index.query("bench", vector, top_k)
+            embed_times.append(embedded - started)
+            query_times.append(time.perf_counter() - embedded)
+
+            top_scores.append(matches[0].score)
+            ids = [match.id for match in matches if match.score >= min_similarity]
+            hits_1 += bool(ids) and ids[0] == source
+            hits_k += source in ids
+            similar += bool(ids)
+            if matches[0].score >= reuse:
+                reused += 1
+                wrong += requests[int(matches[0].id)] != request
+        n = len(pairs)
+        recall = f"{hits_1 / n:9.1%} {hits_k / n:9.1%}" if source else f"{'-':>9} {'-':>9}"
+        print(f"{kind:<10} {recall} {similar / n:8.1%} {reused / n:7.1%} {wrong / n:12.1%} {statistics.median(top_scores):14.3f}")
+
+    print(f"\nembed one ticket:  p50 {percentile(embed_times, 0.5) * 1000:.3f} ms   p99 {percentile(embed_times, 0.99) * 1000:.3f} ms")
+    print(f"search {tickets}:     p50 {percentile(query_times, 0.5) * 1000:.3f} ms   p99 {percentile(query_times, 0.99) * 1000:.3f} ms")
+
+    # What the exact search costs as an install grows
+    probe = embedder.embed([corpus[0]])[0]
+    for size in (1000, 10000, 50000):
+        scale = LocalVectorIndex(dim, max_per_namespace=size)
+        base = vectors[np.arange(size) % tickets]
+        scale.upsert("bench", [(str(i), vector, {}) for i, vector in enumerate(base)])
+        times = []
+        for _ in range(50):
+            started = time.perf_counter()
+            scale.query("bench", probe, top_k)
+            times.append(time.perf_counter() - started)
+        print(f"search {size:>6} tickets: p50 {percentile(times, 0.5) * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Similar ticket retrieval benchmark")
+    parser.add_argument("--tickets", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--reuse-similarity", type=float, default=0.95)
+    parser.add_argument("--min-similarity", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    run(args.tickets, args.queries, args.dim, args.top_k, args.reuse_similarity, args.min_similarity, args.seed)
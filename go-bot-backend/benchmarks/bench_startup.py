@@ -0,0 +1,84 @@
+# bench_startup.py - Cold start: app import time and time to first healthy /health
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.bench_startup --runs 5
+#
+# Each run uses a fresh interpreter, so nothing is warm except the OS page
+# cache. "import" is the time to import go_bot_backend.app; "healthy" is the
+# time from spawning uvicorn until GET /health first answers 200, which is
+# what Railway deploys and scale-out wait on. The environment (DATABASE_URL,
+# REDIS_URL, feature flags) is passed through, so point it at real services
+# to include their connection setup.
+import sys
+import time
+import socket
+import statistics
+import subprocess
+import argparse
+
+import httpx
+
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); "
+    "import go_bot_backend.app; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def import_seconds() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def healthy_seconds(timeout: float) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "go_bot_backend.app:app", "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1.0).status_code == 200:
+                    return time.perf_counter() - started
+            except httpx.TransportError:
+                pass
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+            time.sleep(0.01)
+        raise TimeoutError(f"/health not healthy after {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(label: str, samples):
+    print(
+        f"{label:<8} median {statistics.median(samples) * 1000:8.1f} ms   "
+        f"min {min(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for /health per run")
+    args = parser.parse_args()
+
+    imports = [import_seconds() for _ in range(args.runs)]
+    healthy = [healthy_seconds(args.timeout) for _ in range(args.runs)]
+
+    print(f"{args.runs} runs")
+    report("import", imports)
+    report("healthy", healthy)
@@ -0,0 +1,163 @@
+# fake_mailgun.py - Local stand-in for Mailgun's messages API
+#
+# Run from go-bot-backend/:
+#   python -m benchmarks.fake_mailgun --port 8025 --latency 0.2 --fail-rate 0.1
+#
+# then start the app with MAILGUN_API_BASE=http://127.0.0.1:8025/v3 (and any
+# MAILGUN_API_KEY / MAILGUN_DOMAIN). POST /v3/<domain>/messages answers like
+# Mailgun after --latency seconds, failing --fail-rate of calls with a 503 and
+# answering 429 past --max-rps. Batch sends are checked: every %recipient.x%
+# variable in the subject and bodies must be defined for every recipient.
+# GET /stats returns the counters; delivered messages are kept in memory
+# (FakeMailgun.messages) when it's used in-process by a benchmark or test.
+# Tests can script the next responses: fake.responses.extend([429, 503]).
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+RECIPIENT_VARIABLE = re.compile(r"%recipient\.(\w+)%")
+
+
+class FakeMailgun:
+    def __init__(self, port: int = 0, latency: float = 0.0, fail_rate: float = 0.0, max_rps: float = 0.0):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.max_rps = max_rps
+        self.messages = []
+        self.responses = deque()  # Statuses to answer the next calls with, before anything else
+        self.retry_after = 1  # Retry-After seconds sent with 429s
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "messages": 0, "failed": 0, "throttled": 0, "rejected": 0, "connections": 0}
+        self._window = (0, 0)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v3"
+
+    def start(self) -> "FakeMailgun":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def _throttled(self) -> bool:
+        if not self.max_rps:
+            return False
+        with self.lock:
+            second, count = self._window
+            now = int(time.time())
+            count = count + 1 if second == now else 1
+            self._window = (now, count)
+            return count > self.max_rps
+
+    def _accept(self, form):
+        """Validate a send and expand it into per-recipient messages; None if invalid"""
+        recipients = form.get("to", [])
+        if not recipients or not form.get("from") or not form.get("subject"):
+            return None
+        variables = json.loads(form["recipient-variables"][0]) if "recipient-variables" in form else {}
+        messages = []
+        for to in recipients:
+            values = variables.get(to, {})
+            message = {"to": to}
+            for part in ("subject", "text", "html"):
+                body = form.get(part, [""])[0]
+                missing = set(RECIPIENT_VARIABLE.findall(body)) - set(values)
+                if missing:
+                    return None
+                message[part] = RECIPIENT_VARIABLE.sub(lambda match: str(values[match.group(1)]), body)
+            messages.append(message)
+        return messages
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                fake._count("connections")
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: dict):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", str(fake.retry_after))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self._reply(200, fake.stats())
+                else:
+                    self._reply(404, {"message": "Not found"})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                fake._count("requests")
+                if not self.path.startswith("/v3/") or not self.path.endswith("/messages"):
+                    return self._reply(404, {"message": "Not found"})
+                if not self.headers.get("Authorization", "").startswith("Basic "):
+                    return self._reply(401, {"message": "Forbidden"})
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    scripted = fake.responses.popleft() if fake.responses else None
+                if scripted:
+                    fake._count("throttled" if scripted == 429 else "failed")
+                    return self._reply(scripted, {"message": "Scripted failure"})
+                if fake._throttled():
+                    fake._count("throttled")
+                    return self._reply(429, {"message": "Too many requests"})
+                if random.random() < fake.fail_rate:
+                    fake._count("failed")
+                    return self._reply(503, {"message": "Service unavailable"})
+
+                messages = fake._accept(parse_qs(body))
+                if messages is None:
+                    fake._count("rejected")
+                    return self._reply(400, {"message": "Invalid message"})
+                with fake.lock:
+                    fake.messages.extend(messages)
+                    fake.counters["messages"] += len(messages)
+                self._reply(200, {"id": f"<{time.time()}@fake.mailgun>", "message": "Queued. Thank you."})
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Mailgun messages API")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before each response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of calls answered with 503")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="Calls per second before answering 429 (0 = no limit)")
+    args = parser.parse_args()
+
+    fake = FakeMailgun(args.port, args.latency, args.fail_rate, args.max_rps)
+    print(f"Fake Mailgun listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
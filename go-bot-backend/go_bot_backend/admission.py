@@ -0,0 +1,187 @@
+# admission.py - Concurrency cap and weighted fair queuing for Claude calls
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+from fastapi import HTTPException
+
+
+class AdmissionRejected(HTTPException):
+    """Raised when a Claude call can't be admitted; carries a Retry-After header"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps how many Claude calls a replica has in flight, and decides who goes
+    next when the cap is reached.
+
+    Waiting calls are served by weighted fair queuing per tenant (install):
+    each call gets a virtual finish tag of max(now, tenant's last tag) +
+    1/weight, and the smallest tag is admitted first. A tenant with twice
+    the weight gets twice the share of slots under contention, and a burst
+    from one tenant only delays that tenant.
+
+    The queue is bounded in total and per tenant, and waits are bounded by
+    max_wait; callers that can't be served are rejected straight away with
+    a Retry-After estimate instead of piling up.
+
+    All state is touched from the event loop only, so no locking is needed.
+    """
+
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 64, max_queue_per_tenant: int = 16, max_wait: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.max_wait = max_wait
+
+        self._in_flight = 0
+        self._heap = []  # [finish_tag, seq, future, tenant, start_tag]
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._tenant_tags: Dict[str, float] = {}
+        self._queued = Counter()
+        self._queued_total = 0
+
+        # Metrics
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._avg_call_seconds = 5.0  # EWMA of slot hold time, for Retry-After
+
+    # ------------------------------------------------------------------
+    # Queueing
+    # ------------------------------------------------------------------
+
+    def _tags(self, tenant: str, weight: float):
+        start = max(self._virtual_time, self._tenant_tags.get(tenant, 0.0))
+        finish = start + 1.0 / max(weight, 1e-6)
+        self._tenant_tags[tenant] = finish
+        if len(self._tenant_tags) > 10000:
+            # Tags at or behind virtual time mean the same as no tag at all
+            self._tenant_tags = {t: tag for t, tag in self._tenant_tags.items() if tag > self._virtual_time}
+        return start, finish
+
+    def retry_after(self) -> int:
+        """Seconds until a queued call would likely be admitted"""
+        waves = (self._queued_total + 1) / self.max_concurrency
+        return max(1, min(60, math.ceil(waves * self._avg_call_seconds)))
+
+    def check(self, tenant: str):
+        """Reject right away if a call for this tenant would not be queued"""
+        if self._in_flight < self.max_concurrency and not self._queued_total:
+            return
+        if self._queued[tenant] >= self.max_queue_per_tenant:
+            self.rejected += 1
+            raise AdmissionRejected(429, "Too many AI requests in progress for this workspace. Please retry shortly.", self.retry_after())
+        if self._queued_total >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(503, "AI service is at capacity. Please retry shortly.", self.retry_after())
+
+    def _dispatch(self):
+        while self._in_flight < self.max_concurrency and self._heap:
+            _, _, future, tenant, start = heapq.heappop(self._heap)
+            if future.cancelled():
+                continue  # Gave up waiting; already taken off the counters
+            self._dequeue(tenant)
+            self._in_flight += 1
+            self._virtual_time = max(self._virtual_time, start)
+            future.set_result(None)
+
+    def _dequeue(self, tenant: str):
+        self._queued[tenant] -= 1
+        if not self._queued[tenant]:
+            del self._queued[tenant]
+        self._queued_total -= 1
+
+    def _abandon(self, future: asyncio.Future, tenant: str):
+        future.cancel()
+        self._dequeue(tenant)
+        if len(self._heap) > 2 * self._queued_total + 100:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled()]
+            heapq.heapify(self._heap)
+
+    def _release(self, held: float):
+        self._in_flight -= 1
+        self._avg_call_seconds = 0.8 * self._avg_call_seconds + 0.2 * held
+        self._dispatch()
+
+    async def _acquire(self, tenant: str, weight: float, bounded: bool):
+        start, finish = self._tags(tenant, weight)
+
+        if self._in_flight < self.max_concurrency and not self._queued_total:
+            self._in_flight += 1
+            self._virtual_time = max(self._virtual_time, start)
+            return
+
+        if bounded:
+            self.check(tenant)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, [finish, next(self._seq), future, tenant, start])
+        self._queued[tenant] += 1
+        self._queued_total += 1
+
+        try:
+            await asyncio.wait({future}, timeout=self.max_wait if bounded else None)
+        except BaseException:
+            # Cancelled while waiting (e.g. the client went away)
+            if future.done():
+                self._release(0.0)
+            else:
+                self._abandon(future, tenant)
+            raise
+
+        if not future.done():
+            self._abandon(future, tenant)
+            self.timeouts += 1
+            self.rejected += 1
+            raise AdmissionRejected(503, "AI service is busy. Please retry shortly.", self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, weight: float = 1.0, bounded: bool = True):
+        """
+        Hold one Claude call slot for tenant. Unbounded waits (background
+        jobs) skip the queue limits and the wait timeout but are still
+        scheduled fairly.
+        """
+        queued_at = time.monotonic()
+        await self._acquire(tenant, weight, bounded)
+
+        admitted_at = time.monotonic()
+        waited = admitted_at - queued_at
+        self.admitted += 1
+        self._wait_count += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue length and wait time metrics (exposed on /health)"""
+        return {
+            "maxConcurrency": self.max_concurrency,
+            "inFlight": self._in_flight,
+            "queued": self._queued_total,
+            "queuedInstalls": len(self._queued),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "avgWaitMs": round(self._wait_total / self._wait_count * 1000, 2) if self._wait_count else 0.0,
+            "maxWaitMs": round(self._wait_max * 1000, 2),
+            "avgCallSeconds": round(self._avg_call_seconds, 3),
+        }
@@ -0,0 +1,263 @@
+# analytics.py - Append-only usage event ledger, batched writes and hourly rollups
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Sequence
+
+from psycopg2.extras import execute_values
+
+from go_bot_backend.db import DatabasePool, timed_query
+
+
+EVENT_COLUMNS = (
+    "created_at",
+    "endpoint",
+    "key_code",
+    "install",
+    "plan",
+    "status",
+    "latency_ms",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_tokens",
+    "cache_creation_tokens",
+)
+
+# Serializes rollups across replicas
+ROLLUP_LOCK_ID = 0x60B08
+
+# Folds the events inserted in [since, until) into the rollup rows of the hour they were created in
+ROLLUP_SQL = """
+    WITH batch AS (
+        SELECT
+            date_trunc('hour', created_at) AS hour, endpoint, plan,
+            COALESCE(key_code, '') AS key_code, COALESCE(install, '') AS install,
+            COUNT(*) AS requests, COUNT(*) FILTER (WHERE status >= 400) AS errors,
+            SUM(latency_ms) AS latency_ms_total, MAX(latency_ms) AS latency_ms_max,
+            SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,
+            SUM(cache_read_tokens) AS cache_read_tokens, SUM(cache_creation_tokens) AS cache_creation_tokens
+        FROM usage_events
+        WHERE inserted_at >= %s AND inserted_at < %s
+        GROUP BY 1, 2, 3, 4, 5
+    ), folded AS (
+        INSERT INTO usage_rollups (
+            hour, endpoint, plan, key_code, install,
+            requests, errors, latency_ms_total, latency_ms_max,
+            input_tokens, output_tokens, cache_read_tokens, cache_creation_tokens
+        )
+        SELECT * FROM batch
+        ON CONFLICT (hour, endpoint, plan, key_code, install) DO UPDATE SET
+            requests = usage_rollups.requests + EXCLUDED.requests,
+            errors = usage_rollups.errors + EXCLUDED.errors,
+            latency_ms_total = usage_rollups.latency_ms_total + EXCLUDED.latency_ms_total,
+            latency_ms_max = GREATEST(usage_rollups.latency_ms_max, EXCLUDED.latency_ms_max),
+            input_tokens = usage_rollups.input_tokens + EXCLUDED.input_tokens,
+            output_tokens = usage_rollups.output_tokens + EXCLUDED.output_tokens,
+            cache_read_tokens = usage_rollups.cache_read_tokens + EXCLUDED.cache_read_tokens,
+            cache_creation_tokens = usage_rollups.cache_creation_tokens + EXCLUDED.cache_creation_tokens
+    )
+    SELECT COALESCE(SUM(requests), 0) AS events FROM batch
+"""
+
+
+class UsageEventRecorder:
+    """
+    In-process buffer for usage_events rows.
+
+    record() only appends to a bounded deque, so the request path never
+    waits on Postgres; flush() (called from a background task) drains it
+    with multi-row INSERTs. If the buffer fills up while Postgres is
+    unreachable the oldest events are dropped and counted.
+    """
+
+    def __init__(self, db: DatabasePool, batch_size: int = 500, max_buffer: int = 50000):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self._buffer = deque()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+    def record(self, **event):
+        """Buffer one event (keys from EVENT_COLUMNS; created_at defaults to now)"""
+        event.setdefault("created_at", datetime.now())
+        row = tuple(event.get(column) for column in EVENT_COLUMNS)
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(row)
+            self.recorded += 1
+
+    def _take(self) -> List[tuple]:
+        with self._lock:
+            count = min(self.batch_size, len(self._buffer))
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def _put_back(self, rows: List[tuple]):
+        with self._lock:
+            room = self.max_buffer - len(self._buffer)
+            self.dropped += max(0, len(rows) - room)
+            self._buffer.extendleft(reversed(rows[:max(0, room)]))
+
+    def flush(self) -> int:
+        """Write all buffered events, batch_size rows per INSERT (blocking)"""
+        written = 0
+        while True:
+            rows = self._take()
+            if not rows:
+                return written
+            try:
+                with self.db.connection() as conn:
+                    cur = conn.cursor()
+                    with timed_query("usage events insert"):
+                        execute_values(
+                            cur,
+                            f"INSERT INTO usage_events ({', '.join(EVENT_COLUMNS)}) VALUES %s",
+                            rows,
+                            page_size=len(rows),
+                        )
+                    conn.commit()
+            except Exception:
+                self.flush_errors += 1
+                self._put_back(rows)
+                raise
+            written += len(rows)
+            self.flushed += len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        """Buffer and write counters (exposed on /health)"""
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "flushErrors": self.flush_errors,
+        }
+
+
+# ----------------------------------------------------------------------
+# Partition maintenance
+# ----------------------------------------------------------------------
+
+def _month_start(moment: datetime, offset: int = 0) -> datetime:
+    month = moment.year * 12 + moment.month - 1 + offset
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def maintain_partitions(conn, months_ahead: int = 2, retention_months: int = 13) -> Dict[str, List[str]]:
+    """
+    Create monthly usage_events partitions up to months_ahead and drop
+    those older than retention_months. Partitions must exist before their
+    month starts: rows that land in the default partition block creating
+    the partition for their month.
+    """
+    now = datetime.now()
+    cur = conn.cursor()
+    created = []
+    for offset in range(months_ahead + 1):
+        start, end = _month_start(now, offset), _month_start(now, offset + 1)
+        name = f"usage_events_{start:%Y_%m}"
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+        if not cur.fetchone()['present']:
+            cur.execute(
+                f"CREATE TABLE {name} PARTITION OF usage_events FOR VALUES FROM (%s) TO (%s)",
+                (start, end),
+            )
+            created.append(name)
+
+    cutoff = f"usage_events_{_month_start(now, -retention_months):%Y_%m}"
+    cur.execute("""
+        SELECT child.relname AS name
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'usage_events'
+        AND child.relname ~ '^usage_events_[0-9]{4}_[0-9]{2}$'
+        AND child.relname < %s
+    """, (cutoff,))
+    dropped = [row['name'] for row in cur.fetchall()]
+    for name in dropped:
+        cur.execute(f"DROP TABLE {name}")
+
+    conn.commit()
+    return {"created": created, "dropped": dropped}
+
+
+# ----------------------------------------------------------------------
+# Rollups
+# ----------------------------------------------------------------------
+
+def rollup_usage_events(conn, lag_seconds: int = 300) -> int:
+    """
+    Fold events inserted more than lag_seconds ago and since the last rollup
+    into hourly usage_rollups rows. Returns the number of events rolled up,
+    or -1 if another replica is rolling up right now. The watermark is on
+    inserted_at (the database's clock), so events flushed late, e.g. after
+    an outage, are added to their past hours instead of being skipped; the
+    lag only has to outlast an insert's transaction.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (ROLLUP_LOCK_ID,))
+        if not cur.fetchone()['locked']:
+            conn.rollback()
+            return -1
+
+        cur.execute("SELECT LOCALTIMESTAMP - make_interval(secs => %s) AS until", (lag_seconds,))
+        until = cur.fetchone()['until']
+        cur.execute("SELECT rolled_up_to FROM usage_rollup_state")
+        row = cur.fetchone()
+        since = row['rolled_up_to'] if row else datetime(1970, 1, 1)
+        if until <= since:
+            conn.rollback()
+            return 0
+
+        with timed_query("usage rollup"):
+            cur.execute(ROLLUP_SQL, (since, until))
+        events = cur.fetchone()['events']
+
+        cur.execute("""
+            INSERT INTO usage_rollup_state (id, rolled_up_to) VALUES (true, %s)
+            ON CONFLICT (id) DO UPDATE SET rolled_up_to = EXCLUDED.rolled_up_to
+        """, (until,))
+        conn.commit()
+        return int(events)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+# ----------------------------------------------------------------------
+# Reports
+# ----------------------------------------------------------------------
+
+def usage_report_sql(group: str, filters: Sequence[str] = (), order: str = "requests DESC") -> str:
+    """
+    Rollup totals per group (a column expression) for the hours between two
+    timestamps. Parameters are since, until and one value per filter column.
+    """
+    conditions = ["hour >= date_trunc('hour', %s::timestamp)", "hour < %s"]
+    conditions += [f"{column} = %s" for column in filters]
+    return f"""
+        SELECT
+            {group} AS group_value,
+            SUM(requests) AS requests,
+            SUM(errors) AS errors,
+            SUM(latency_ms_total) AS latency_ms_total,
+            MAX(latency_ms_max) AS latency_ms_max,
+            SUM(input_tokens) AS input_tokens,
+            SUM(output_tokens) AS output_tokens,
+            SUM(cache_read_tokens) AS cache_read_tokens,
+            SUM(cache_creation_tokens) AS cache_creation_tokens
+        FROM usage_rollups
+        WHERE {' AND '.join(conditions)}
+        GROUP BY 1
+        ORDER BY {order}
+        LIMIT 1000
+    """
@@ -3,36 +3,60 @@ import os
 import json
 import time
 import asyncio
+import uuid
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Literal
 from dotenv import load_dotenv
 
 
 from fastapi import FastAPI, HTTPException, Depends, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-import anthropic
-from pinecone import Pinecone
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from pydantic import BaseModel, Field, ValidationError
+import httpx
 import redis
-import requests
-import stripe
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 
-import bcrypt
-import jwt
-from datetime import datetime, timedelta
-from typing import Optional
 import secrets
 import string
 
-import stripe
-import secrets
-import string
-from datetime import datetime, timedelta
+# anthropic and stripe are imported where they are first needed,
+# so importing the app (and booting a replica) doesn't pay for unused SDKs
+
+from go_bot_backend.admission import AdmissionController, AdmissionRejected
+from go_bot_backend.analytics import UsageEventRecorder, maintain_partitions, rollup_usage_events, usage_report_sql
+from go_bot_backend.cache import ResultCache, content_hash_key
+from go_bot_backend.db import DatabasePool, timed_query
+from go_bot_backend.jobs import JobQueue
+from go_bot_backend.migrations import SCHEMA_VERSION, migrate, schema_version
+from go_bot_backend.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, HTTPMetricsMiddleware
+from go_bot_backend.mailer import Email, EmailTemplate, EmailTemplates, MailgunMailer
+from go_bot_backend.license_cache import LicenseCache, fetch_license_by_key, fetch_key_code_by_install
+from go_bot_backend.ratelimit import Bucket, RateLimiter
+from go_bot_backend.usage import RESERVE_USAGE_SQL, USAGE_SWEEP_SQL, UsageCounter, UsageLimitExceeded
+from go_bot_backend.stripe_events import StripeEventOutbox
+from go_bot_backend.structured import StreamingArrayParser, forced_tool_choice, list_fields_tool
+from go_bot_backend.profiler import SamplingProfiler
+from go_bot_backend.queries import (
+    CANCEL_SUBSCRIPTION_SQL,
+    DEACTIVATE_OLD_KEYS_SQL,
+    FREE_KEY_UPSERT_SQL,
+    LICENSE_BY_PAYMENT_INTENT_SQL,
+    RENEW_SUBSCRIPTION_SQL,
+    SUBSCRIPTION_STATUS_SQL,
+)
+from go_bot_backend.timing import ServerTimingMiddleware, record_span, span
+from go_bot_backend.llm import (
+    TokenUsageStats,
+    adaptive_max_tokens,
+    cached_system,
+    continuation_messages,
+    strip_seam,
+    with_cache_breakpoint,
+)
 
 load_dotenv()
 
@@ -48,18 +72,130 @@ STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 MAILGUN_API_KEY = os.getenv("MAILGUN_API_KEY")
 MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN")
 MAILGUN_FROM_EMAIL = os.getenv("MAILGUN_FROM_EMAIL", "GoBot <gobot@gobot.ai>")
+MAILGUN_API_BASE = os.getenv("MAILGUN_API_BASE", "https://api.mailgun.net/v3")
  
 # Feature flags
 ENABLE_RAG = os.getenv("ENABLE_RAG", "false").lower() == "true"
 ENABLE_RATE_LIMITING = os.getenv("ENABLE_RATE_LIMITING", "true").lower() == "true"
 ENABLE_PAYMENTS = os.getenv("ENABLE_PAYMENTS", "false").lower() == "true"
 ENABLE_ANALYTICS = os.getenv("ENABLE_ANALYTICS", "true").lower() == "true"
+ENABLE_RESULT_CACHE = os.getenv("ENABLE_RESULT_CACHE", "true").lower() == "true"
+ENABLE_USAGE_COUNTERS = os.getenv("ENABLE_USAGE_COUNTERS", "true").lower() == "true"
+ENABLE_LICENSE_CACHE = os.getenv("ENABLE_LICENSE_CACHE", "true").lower() == "true"
 
 # Rate limiting config
 RATE_LIMIT_FREE = int(os.getenv("RATE_LIMIT_FREE", "10"))  # per month
 RATE_LIMIT_PRO = int(os.getenv("RATE_LIMIT_PRO", "100"))  # unlimited
 RATE_LIMIT_TEAM = int(os.getenv("RATE_LIMIT_TEAM", "400"))  # seconds
 
+# Request rate limits (token buckets in Redis, shared by all replicas)
+REQUEST_RATE_FREE = int(os.getenv("REQUEST_RATE_FREE", "6"))  # AI requests per minute per key and per install
+REQUEST_RATE_PRO = int(os.getenv("REQUEST_RATE_PRO", "20"))
+REQUEST_RATE_TEAM = int(os.getenv("REQUEST_RATE_TEAM", "60"))
+VALIDATE_RATE = int(os.getenv("VALIDATE_RATE", "30"))  # /validate-key calls per minute per key and per install
+FREE_KEY_RATE_PER_IP = int(os.getenv("FREE_KEY_RATE_PER_IP", "10"))  # /create-free-key calls per hour
+FREE_KEY_RATE_PER_EMAIL = int(os.getenv("FREE_KEY_RATE_PER_EMAIL", "3"))  # /create-free-key calls per hour
+
+# Claude client config
+CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+ANTHROPIC_TIMEOUT = float(os.getenv("ANTHROPIC_TIMEOUT", "600"))  # seconds per request
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "100"))
+ANTHROPIC_MAX_KEEPALIVE = int(os.getenv("ANTHROPIC_MAX_KEEPALIVE", "20"))
+
+# Clarification config
+CLARIFY_SECTION_TIMEOUT = float(os.getenv("CLARIFY_SECTION_TIMEOUT", "45"))  # seconds per section in sections mode
+
+# Claude admission control (per replica)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))  # Claude calls in flight
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))  # calls waiting for a slot
+LLM_MAX_QUEUE_PER_INSTALL = int(os.getenv("LLM_MAX_QUEUE_PER_INSTALL", "16"))
+LLM_MAX_QUEUE_WAIT = float(os.getenv("LLM_MAX_QUEUE_WAIT", "30"))  # seconds before a waiting call gets a 503
+
+# Parallel code generation config
+CODEGEN_MAX_PARALLELISM = int(os.getenv("CODEGEN_MAX_PARALLELISM", "4"))  # files generated at once per request
+
+# Schema migrations (normally applied by the Railway pre-deploy command)
+RUN_MIGRATIONS_ON_STARTUP = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "false").lower() == "true"
+
+# Database pool config
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30"))  # seconds idle before ping
+
+# Job queue config
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # concurrent generations per replica
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))  # before a crashed worker's job is retried
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Stripe webhook outbox config (events are acknowledged once stored, then applied by workers)
+STRIPE_EVENT_WORKERS = int(os.getenv("STRIPE_EVENT_WORKERS", "2"))  # events applied at once per replica
+STRIPE_EVENT_LEASE_SECONDS = int(os.getenv("STRIPE_EVENT_LEASE_SECONDS", "300"))  # before a crashed worker's event is retried
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", "8"))
+STRIPE_EVENT_RETRY_BASE = float(os.getenv("STRIPE_EVENT_RETRY_BASE", "5"))  # seconds, doubled per failed attempt
+STRIPE_EVENT_RETENTION_DAYS = int(os.getenv("STRIPE_EVENT_RETENTION_DAYS", "30"))  # processed event ids kept for dedupe
+
+# Email delivery config (Mailgun batch sends from a background task)
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "100"))  # recipients per Mailgun API call
+EMAIL_BATCH_WINDOW = float(os.getenv("EMAIL_BATCH_WINDOW", "0.5"))  # seconds to wait for a batch to fill
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "4"))
+EMAIL_RETRY_BASE = float(os.getenv("EMAIL_RETRY_BASE", "1"))  # seconds, doubled per failed attempt
+EMAIL_MAX_QUEUE = int(os.getenv("EMAIL_MAX_QUEUE", "10000"))  # emails waiting for delivery
+EMAIL_DELIVERY_TIMEOUT = float(os.getenv("EMAIL_DELIVERY_TIMEOUT", "60"))  # seconds a Stripe event waits for its key email
+
+# Usage counter config
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))  # seconds between write-behind flushes
+USAGE_COUNTER_RELOAD_AFTER = int(os.getenv("USAGE_COUNTER_RELOAD_AFTER", "300"))  # seconds before re-reading Postgres
+USAGE_SWEEP_INTERVAL = float(os.getenv("USAGE_SWEEP_INTERVAL", "3600"))  # seconds between idle usage window sweeps
+USAGE_SWEEP_BATCH_SIZE = int(os.getenv("USAGE_SWEEP_BATCH_SIZE", "200"))  # rows locked per sweep batch
+
+# Usage analytics config (usage_events ledger, see analytics.py)
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "2"))  # seconds between batched inserts
+ANALYTICS_BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "500"))  # rows per INSERT
+ANALYTICS_MAX_BUFFER = int(os.getenv("ANALYTICS_MAX_BUFFER", "50000"))  # events held in memory while Postgres is down
+ANALYTICS_ROLLUP_INTERVAL = float(os.getenv("ANALYTICS_ROLLUP_INTERVAL", "60"))  # seconds between rollups
+ANALYTICS_ROLLUP_LAG = int(os.getenv("ANALYTICS_ROLLUP_LAG", "300"))  # seconds events wait before being rolled up
+ANALYTICS_RETENTION_MONTHS = int(os.getenv("ANALYTICS_RETENTION_MONTHS", "13"))  # monthly partitions kept
+ANALYTICS_API_TOKEN = os.getenv("ANALYTICS_API_TOKEN")  # X-Admin-Token for /analytics/usage
+
+# Prometheus metrics (/metrics)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Bearer token required to scrape, if set
+
+# Per-request stage timing (Server-Timing header, timing log) and profiling
+ENABLE_SERVER_TIMING = os.getenv("ENABLE_SERVER_TIMING", "true").lower() == "true"
+TIMING_LOG_MIN_MS = float(os.getenv("TIMING_LOG_MIN_MS", "1000"))  # log requests at least this slow (-1 = never)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")  # requests sending X-Profile: <token> are always profiled
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # fraction of requests profiled at random
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "2000"))  # sampled profiles are kept for requests this slow
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # seconds between stack samples
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # where .folded profiles are written
+
+# Similar ticket retrieval config (ENABLE_RAG, see rag.py)
+RAG_INDEX = os.getenv("RAG_INDEX", "local")  # "local" (in-process, reloaded from Postgres) or "pinecone"
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+PINECONE_INDEX = os.getenv("PINECONE_INDEX", "gobot-tickets")  # cosine metric, RAG_EMBEDDING_DIM dimensions
+RAG_EMBEDDING_DIM = int(os.getenv("RAG_EMBEDDING_DIM", "1024"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))  # similar past tickets added to the prompt
+RAG_MIN_SIMILARITY = float(os.getenv("RAG_MIN_SIMILARITY", "0.5"))  # cosine similarity to count as similar
+RAG_REUSE_SIMILARITY = float(os.getenv("RAG_REUSE_SIMILARITY", "0.95"))  # return the past result instead of generating
+RAG_MAX_PER_INSTALL = int(os.getenv("RAG_MAX_PER_INSTALL", "20000"))  # tickets kept per install and kind (stored and indexed)
+
+# Near-duplicate ticket detection (MinHash/LSH over the result cache, see near_duplicates.py)
+ENABLE_NEAR_DUPLICATES = os.getenv("ENABLE_NEAR_DUPLICATES", "false").lower() == "true"
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.85"))  # Jaccard similarity of word 3-grams
+NEAR_DUPLICATE_MAX_PER_INSTALL = int(os.getenv("NEAR_DUPLICATE_MAX_PER_INSTALL", "5000"))  # tickets per install and kind
+
+# Result cache config
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "86400"))  # seconds
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))  # in Redis
+RESULT_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_LOCAL_MAX_ENTRIES", "1000"))  # in-process fallback
+
+# License lookup cache config (entries are invalidated on write, TTLs are only a backstop)
+LICENSE_CACHE_TTL = int(os.getenv("LICENSE_CACHE_TTL", "3600"))  # seconds in Redis
+LICENSE_CACHE_LOCAL_TTL = int(os.getenv("LICENSE_CACHE_LOCAL_TTL", "300"))  # seconds in-process
+LICENSE_CACHE_MISSING_TTL = int(os.getenv("LICENSE_CACHE_MISSING_TTL", "60"))  # seconds for "no key" answers
+LICENSE_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("LICENSE_CACHE_LOCAL_MAX_ENTRIES", "10000"))
+
 # ============================================================================
 # Initialize Services
 # ============================================================================
@@ -70,11 +206,49 @@ async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Initializing services...")
     
-    # Initialize Claude
-    app.state.claude = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY) if ANTHROPIC_API_KEY else None
+    # Initialize Claude (async client so LLM calls don't block the event loop,
+    # sharing one keep-alive connection pool across all requests)
+    app.state.claude = None
+    if ANTHROPIC_API_KEY:
+        import anthropic
+        app.state.claude = anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            timeout=ANTHROPIC_TIMEOUT,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=ANTHROPIC_MAX_CONNECTIONS,
+                    max_keepalive_connections=ANTHROPIC_MAX_KEEPALIVE,
+                )
+            ),
+        )
+    app.state.llm_usage = TokenUsageStats()
+    app.state.admission = AdmissionController(
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        max_queue=LLM_MAX_QUEUE,
+        max_queue_per_tenant=LLM_MAX_QUEUE_PER_INSTALL,
+        max_wait=LLM_MAX_QUEUE_WAIT,
+    )
+
+    # Initialize PostgreSQL connection pool
+    app.state.db = None
+    if DATABASE_URL:
+        app.state.db = DatabasePool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            checkout_timeout=DB_POOL_TIMEOUT,
+            health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+        )
+        try:
+            app.state.db.open()
+            print("✅ Database pool initialized")
+        except Exception as e:
+            print(f"⚠️  Database unavailable: {e}")
+        await run_in_threadpool(check_schema)
  
     # Initialize Redis (optional)
-    if ENABLE_RATE_LIMITING and REDIS_URL:
+    app.state.redis = None
+    if (ENABLE_RATE_LIMITING or ENABLE_RESULT_CACHE or ENABLE_USAGE_COUNTERS or ENABLE_LICENSE_CACHE) and REDIS_URL:
         try:
             app.state.redis = redis.from_url(REDIS_URL, decode_responses=True)
             app.state.redis.ping()
@@ -82,11 +256,143 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             print(f"⚠️  Redis unavailable: {e}")
             app.state.redis = None
+
+    # Initialize result cache (falls back to an in-process LRU without Redis)
+    app.state.result_cache = ResultCache(
+        app.state.redis,
+        ttl=RESULT_CACHE_TTL,
+        max_entries=RESULT_CACHE_MAX_ENTRIES,
+        local_max_entries=RESULT_CACHE_LOCAL_MAX_ENTRIES,
+    ) if ENABLE_RESULT_CACHE else None
+
+    # Initialize license lookup cache (in-process LRU in front of Redis; writes
+    # invalidate it on every replica through Redis pub/sub)
+    app.state.license_cache = None
+    if ENABLE_LICENSE_CACHE and app.state.db:
+        app.state.license_cache = LicenseCache(
+            app.state.db,
+            app.state.redis,
+            local_ttl=LICENSE_CACHE_LOCAL_TTL,
+            redis_ttl=LICENSE_CACHE_TTL,
+            missing_ttl=LICENSE_CACHE_MISSING_TTL,
+            local_max_entries=LICENSE_CACHE_LOCAL_MAX_ENTRIES,
+        )
+        app.state.license_cache.start()
+
+    # Initialize request rate limiter (needs Redis so limits hold across replicas)
+    app.state.rate_limiter = None
+    if ENABLE_RATE_LIMITING:
+        if app.state.redis:
+            app.state.rate_limiter = RateLimiter(app.state.redis)
+            print("✅ Rate limiting enabled")
+        else:
+            print("⚠️  Rate limiting disabled (Redis unavailable)")
+
+    # Initialize usage counters (Redis hot path, written behind to Postgres)
+    app.state.usage = None
+    app.state.usage_flusher = None
+    if ENABLE_USAGE_COUNTERS and app.state.redis and app.state.db:
+        app.state.usage = UsageCounter(
+            app.state.redis,
+            app.state.db,
+            reload_after=USAGE_COUNTER_RELOAD_AFTER,
+            on_flush=invalidate_license_cache,
+        )
+        try:
+            await run_in_threadpool(app.state.usage.reconcile)
+        except Exception as e:
+            print(f"⚠️  Usage counter reconciliation failed: {e}")
+        app.state.usage_flusher = asyncio.create_task(flush_usage_periodically())
+    
+    # Roll over idle keys' usage windows now and then (keys in use roll over
+    # on their next metered call, so nothing depends on this running)
+    app.state.usage_sweeper = asyncio.create_task(sweep_usage_windows_periodically()) if app.state.db else None
+    
+    # Initialize usage event ledger (buffered in-process; batch inserts and
+    # rollups run in the background, off the request path)
+    app.state.usage_events = None
+    app.state.analytics_tasks = []
+    if ENABLE_ANALYTICS and app.state.db:
+        app.state.usage_events = UsageEventRecorder(
+            app.state.db,
+            batch_size=ANALYTICS_BATCH_SIZE,
+            max_buffer=ANALYTICS_MAX_BUFFER,
+        )
+        app.state.analytics_tasks = [
+            asyncio.create_task(flush_usage_events_periodically()),
+            asyncio.create_task(rollup_usage_periodically()),
+        ]
+    
+    # Initialize similar ticket retrieval (NumPy and the Pinecone SDK are only
+    # imported when it's enabled)
+    app.state.rag = None
+    if ENABLE_RAG:
+        try:
+            app.state.rag = await run_in_threadpool(init_similar_tickets)
+        except Exception as e:
+            print(f"⚠️  Similar ticket retrieval unavailable: {e}")
+    
+    # Initialize near-duplicate detection (in-process; it points at result cache entries)
+    app.state.near_duplicates = None
+    if ENABLE_NEAR_DUPLICATES and app.state.result_cache:
+        try:
+            from go_bot_backend.near_duplicates import NearDuplicateIndex
+            app.state.near_duplicates = NearDuplicateIndex(
+                threshold=NEAR_DUPLICATE_THRESHOLD,
+                max_per_scope=NEAR_DUPLICATE_MAX_PER_INSTALL,
+            )
+            print(f"✅ Near-duplicate detection enabled (threshold {NEAR_DUPLICATE_THRESHOLD})")
+        except Exception as e:
+            print(f"⚠️  Near-duplicate detection unavailable: {e}")
     
-    # Initialize Stripe (optional)
+    # Stripe (optional) is imported on the first payment request
     if ENABLE_PAYMENTS and STRIPE_SECRET_KEY:
-        stripe.api_key = STRIPE_SECRET_KEY
-        print("✅ Stripe initialized")
+        print("✅ Stripe configured")
+    
+    # Start email delivery (handlers only queue emails)
+    app.state.mailer = None
+    if MAILGUN_API_KEY and MAILGUN_DOMAIN:
+        app.state.mailer = MailgunMailer(
+            MAILGUN_API_KEY,
+            MAILGUN_DOMAIN,
+            MAILGUN_FROM_EMAIL,
+            templates={"license_key": LICENSE_KEY_EMAIL},
+            api_base=MAILGUN_API_BASE,
+            batch_size=EMAIL_BATCH_SIZE,
+            batch_window=EMAIL_BATCH_WINDOW,
+            max_attempts=EMAIL_MAX_ATTEMPTS,
+            retry_base=EMAIL_RETRY_BASE,
+            max_queue=EMAIL_MAX_QUEUE,
+            on_failure=email_delivery_failed,
+        )
+        await app.state.mailer.start()
+    
+    # Start Stripe event workers (webhooks only store events in the outbox)
+    app.state.stripe_events = None
+    if ENABLE_PAYMENTS and app.state.db:
+        app.state.stripe_events = StripeEventOutbox(
+            app.state.db,
+            handler=process_stripe_event,
+            workers=STRIPE_EVENT_WORKERS,
+            lease_seconds=STRIPE_EVENT_LEASE_SECONDS,
+            max_attempts=STRIPE_EVENT_MAX_ATTEMPTS,
+            retry_base=STRIPE_EVENT_RETRY_BASE,
+            retention_days=STRIPE_EVENT_RETENTION_DAYS,
+        )
+        await app.state.stripe_events.start()
+    
+    # Start job workers (jobs are persisted in Postgres)
+    app.state.jobs = None
+    if app.state.db:
+        app.state.jobs = JobQueue(
+            app.state.db,
+            handlers={"clarify": run_clarify_job, "gen-code": run_code_job},
+            workers=JOB_WORKERS,
+            lease_seconds=JOB_LEASE_SECONDS,
+            max_attempts=JOB_MAX_ATTEMPTS,
+            on_abandoned=refund_abandoned_job,
+        )
+        await app.state.jobs.start()
     
     print("✅ All services ready")
     
@@ -94,8 +400,37 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     print("👋 Shutting down...")
+    if app.state.jobs:
+        await app.state.jobs.stop()
+    if app.state.stripe_events:
+        await app.state.stripe_events.stop()
+    if app.state.mailer:
+        await app.state.mailer.stop()
+    if app.state.usage_flusher:
+        app.state.usage_flusher.cancel()
+        try:
+            flushed = await run_in_threadpool(app.state.usage.flush)
+            print(f"💾 Flushed {flushed} usage increments")
+        except Exception as e:
+            print(f"⚠️  Final usage flush failed: {e}")
+    if app.state.usage_sweeper:
+        app.state.usage_sweeper.cancel()
+    for task in app.state.analytics_tasks:
+        task.cancel()
+    if app.state.usage_events:
+        try:
+            flushed = await run_in_threadpool(app.state.usage_events.flush)
+            print(f"💾 Flushed {flushed} usage events")
+        except Exception as e:
+            print(f"⚠️  Final usage event flush failed: {e}")
+    if app.state.license_cache:
+        app.state.license_cache.stop()
     if hasattr(app.state, 'redis') and app.state.redis:
         app.state.redis.close()
+    if app.state.claude:
+        await app.state.claude.close()
+    if app.state.db:
+        app.state.db.closeall()
 
 app = FastAPI(
     title="Go Bot API",
@@ -113,6 +448,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Stage timings per request: Server-Timing header, slow request log, opt-in profiles
+app.state.profiler = None
+if ENABLE_SERVER_TIMING:
+    if PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+        app.state.profiler = SamplingProfiler(
+            interval=PROFILE_INTERVAL,
+            sample_rate=PROFILE_SAMPLE_RATE,
+            token=PROFILE_TOKEN,
+            slow_ms=PROFILE_SLOW_MS,
+            output_dir=PROFILE_DIR,
+        )
+    app.add_middleware(ServerTimingMiddleware, log_min_ms=TIMING_LOG_MIN_MS, profiler=app.state.profiler)
+
+# Request latency histograms for /metrics (outermost, so it sees every response)
+app.add_middleware(HTTPMetricsMiddleware)
+
 app.mount("/files", StaticFiles(directory="static"), "static")
 
 # ============================================================================
@@ -127,15 +478,30 @@ class CodeGenInput(BaseModel):
     # Custom prompt for guidance
     customPrompt: str = Field(default="", description="Custom prompt for code generation (e.g., 'Use Python', 'Include TypeScript types')")
     
+    # Generation mode
+    mode: Literal["single", "parallel"] = Field(default="single", description="'parallel' plans the files first, then generates them concurrently")
+    parallelism: Optional[int] = Field(default=None, ge=1, description="Max files generated at once in parallel mode (capped server-side)")
+    
     # Auth
     install: Optional[str] = Field(default=None, description="Organization ID for auth")
     accessKey: Optional[str] = Field(default=None, description="License Key")
 
+class FileTiming(BaseModel):
+    """Per-file timing for a parallel code generation"""
+    path: str
+    seconds: float
+    continuations: int = 0
+
 class CodeGenOutput(BaseModel):
     """Output from code generation"""
     implementation: str = Field(..., description="Full implementation as markdown-formatted text")
     summary: str = Field(default="", description="Brief summary of what was built")
     processingTime: Optional[float] = Field(default=None, description="Processing time in seconds")
+    continuations: int = Field(default=0, description="Continuation requests needed after max_tokens truncation")
+    tokenUsage: Optional[Dict[str, int]] = Field(default=None, description="Claude tokens used by this generation")
+    planningTime: Optional[float] = Field(default=None, description="Seconds spent planning files (parallel mode)")
+    files: Optional[List[FileTiming]] = Field(default=None, description="Per-file generation timings (parallel mode)")
+    reusedSimilarity: Optional[float] = Field(default=None, description="Set when a similar past ticket's stored result was returned instead of generating")
 
 
 class TicketInput(BaseModel):
@@ -144,6 +510,7 @@ class TicketInput(BaseModel):
     customPrompt: str = Field(default="", description="Custom Prompt for the ticket clarification step.")
     issueType: Optional[str] = Field(default="Task", description="Issue type (Bug, Task, Story)")
     priority: Optional[str] = Field(default="Medium", description="Priority level")
+    mode: Literal["single", "sections"] = Field(default="single", description="'sections' generates the four sections concurrently")
     install: Optional[str] = Field(default=None, description="Organization ID for auth")
     accessKey: Optional[str] = Field(default=None, description="Licence Key")
 
@@ -154,6 +521,11 @@ class ClarifiedOutput(BaseModel):
     testScenarios: List[str] = Field(default_factory=list)
     confidence: Optional[float] = Field(default=None, description="AI confidence score")
     processingTime: Optional[float] = Field(default=None, description="Processing time in seconds")
+    continuations: int = Field(default=0, description="Continuation requests needed after max_tokens truncation")
+    tokenUsage: Optional[Dict[str, int]] = Field(default=None, description="Claude tokens used by this generation")
+    status: str = Field(default="complete", description="'partial' when generation was cut short and only the finished items are returned")
+    failedSections: List[str] = Field(default_factory=list, description="Sections that failed or timed out (sections mode)")
+    reusedSimilarity: Optional[float] = Field(default=None, description="Set when a similar past ticket's stored result was returned instead of generating")
 
 class CreateFreeKeyInput(BaseModel):
     email: str = Field(..., description="Customer email address")
@@ -174,6 +546,14 @@ class AccessKeyResponse(BaseModel):
 class InstallData(BaseModel):
     install: str
  
+class JobInput(BaseModel):
+    type: str = Field(..., description="Job type: 'clarify' or 'gen-code'")
+    data: Dict[str, Any] = Field(..., description="TicketInput for clarify, CodeGenInput for gen-code")
+
+class JobSubmitted(BaseModel):
+    jobId: str
+    status: str = "queued"
+
 class CreatePaymentIntentInput(BaseModel):
     planId: str = Field(..., description="Plan ID (pro or team)")
 
@@ -182,73 +562,42 @@ class CreatePaymentIntentInput(BaseModel):
 # ============================================================================
 
 def get_db_connection():
-    """Get PostgreSQL connection"""
-    if not DATABASE_URL:
+    """Check out a pooled PostgreSQL connection (hand it back with release_db_connection)"""
+    db = getattr(app.state, 'db', None)
+    if not db:
         return None
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
+        return db.getconn()
     except Exception as e:
         print(f"Database connection error: {e}")
         return None
 
-def init_database():
-    """Initialize database schema"""
+def release_db_connection(conn):
+    """Return a connection to the pool"""
+    app.state.db.putconn(conn)
+
+def check_schema():
+    """
+    Check the database is migrated (migrations run before deploy with
+    `python -m go_bot_backend.migrate`, or here when RUN_MIGRATIONS_ON_STARTUP is set)
+    """
     conn = get_db_connection()
     if not conn:
         return
     
     try:
-        cur = conn.cursor()
- 
-        """Add these table creations to your init_database() function"""
-        
-        # Update license_keys table for subscriptions
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS license_keys (
-                id SERIAL PRIMARY KEY,
-                key_code VARCHAR(255) UNIQUE NOT NULL,
-                customer_email VARCHAR(255) NOT NULL,
-                plan VARCHAR(50) NOT NULL,
-                install VARCHAR(255),
-                
-                -- Subscription fields
-                stripe_subscription_id VARCHAR(255),
-                stripe_customer_id VARCHAR(255),
-                stripe_payment_intent_id VARCHAR(255),
-                    
-                -- Usage tracking
-                gobot_limit INTEGER NOT NULL,
-                gobot_used INTEGER DEFAULT 0,
-                usage_resets_at TIMESTAMP,
-                
-                -- Status
-                is_active BOOLEAN DEFAULT true,
-                subscription_status VARCHAR(50) DEFAULT 'active',
-                activated_at TIMESTAMP,
-                expires_at TIMESTAMP,
-                
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Create indexes
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_license_key_code ON license_keys(key_code)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_license_email ON license_keys(customer_email)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_license_subscription ON license_keys(stripe_subscription_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_license_customer ON license_keys(stripe_customer_id)")
-        
-        conn.commit()
-        print("✅ Database initialized")
+        if RUN_MIGRATIONS_ON_STARTUP:
+            for migration in migrate(conn):
+                print(f"✅ Applied migration {migration.version} ({migration.name})")
+        version = schema_version(conn)
+        if version < SCHEMA_VERSION:
+            print(f"⚠️  Database schema is at version {version}, expected {SCHEMA_VERSION}; run python -m go_bot_backend.migrate")
+        else:
+            print(f"✅ Database schema at version {version}")
     except Exception as e:
-        print(f"Database init error: {e}")
+        print(f"Database schema check error: {e}")
     finally:
-        conn.close()
-
-# Initialize on startup
-if DATABASE_URL:
-    init_database()
+        release_db_connection(conn)
 
 # ============================================================================
 # User & Auth Helpers
@@ -264,38 +613,287 @@ def get_plan_limits(plan_id: str) -> int:
     }
     return limits.get(plan_id, 5)
 
-def reset_monthly_usage():
+def sweep_usage_windows() -> int:
     """
-    Reset usage counters for all active subscriptions
-    This should be run as a cron job on the 1st of each month
+    Roll over usage windows that ended without the key being used since,
+    in small keyset-paginated batches. Housekeeping only: reserve_usage and
+    the usage counters roll a window over on the key's next metered call.
     """
     conn = get_db_connection()
     if not conn:
-        return
+        return 0
     
+    swept = 0
+    after = (datetime(1970, 1, 1), 0)
     try:
         cur = conn.cursor()
+        while True:
+            with timed_query("usage window sweep"):
+                cur.execute(USAGE_SWEEP_SQL, (*after, USAGE_SWEEP_BATCH_SIZE))
+            rows = cur.fetchall()
+            conn.commit()
+            if not rows:
+                break
+            
+            key_codes = [row['key_code'] for row in rows]
+            invalidate_usage_counters(key_codes, discard_pending=True)
+            invalidate_license_cache(key_codes)
+            swept += len(rows)
+            after = max((row['swept_from'], row['id']) for row in rows)
+            if len(rows) < USAGE_SWEEP_BATCH_SIZE:
+                break
         
-        # Reset usage for active subscriptions where reset date has passed
+        return swept
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+async def sweep_usage_windows_periodically():
+    """Background task: roll over idle keys' usage windows now and then"""
+    while True:
+        try:
+            swept = await run_in_threadpool(sweep_usage_windows)
+            if swept:
+                print(f"✅ Rolled over usage for {swept} idle keys")
+        except Exception as e:
+            print(f"⚠️  Usage window sweep failed: {e}")
+        await asyncio.sleep(USAGE_SWEEP_INTERVAL)
+
+async def flush_usage_periodically():
+    """Background task: write Redis usage increments behind to license_keys"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            flushed = await run_in_threadpool(app.state.usage.flush)
+            if flushed:
+                print(f"💾 Flushed {flushed} usage increments")
+        except Exception as e:
+            print(f"⚠️  Usage flush failed: {e}")
+
+async def flush_usage_events_periodically():
+    """Background task: batch-insert buffered usage_events rows"""
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        try:
+            await run_in_threadpool(app.state.usage_events.flush)
+        except Exception as e:
+            print(f"⚠️  Usage event flush failed: {e}")
+
+def rollup_usage_once():
+    """Create/drop usage_events partitions and fold new events into usage_rollups"""
+    with app.state.db.connection() as conn:
+        partitions = maintain_partitions(conn, retention_months=ANALYTICS_RETENTION_MONTHS)
+        for name in partitions["created"]:
+            print(f"🗓️  Created partition {name}")
+        for name in partitions["dropped"]:
+            print(f"🗑️  Dropped partition {name}")
+        return rollup_usage_events(conn, lag_seconds=ANALYTICS_ROLLUP_LAG)
+
+async def rollup_usage_periodically():
+    """Background task: keep usage_events partitions and rollups current"""
+    while True:
+        try:
+            events = await run_in_threadpool(rollup_usage_once)
+            if events > 0:
+                print(f"📈 Rolled up {events} usage events")
+        except Exception as e:
+            print(f"⚠️  Usage rollup failed: {e}")
+        await asyncio.sleep(ANALYTICS_ROLLUP_INTERVAL)
+
+def invalidate_usage_counters(key_codes: List[str], discard_pending: bool = False):
+    """Drop Redis usage counters after their license_keys rows changed"""
+    if not app.state.usage or not key_codes:
+        return
+    try:
+        app.state.usage.invalidate(key_codes, discard_pending=discard_pending)
+    except Exception as e:
+        print(f"⚠️  Could not invalidate usage counters: {e}")
+
+def invalidate_license_cache(key_codes: List[str] = (), installs: List[str] = ()):
+    """Drop cached license rows (on every replica) after license_keys changed"""
+    if app.state.license_cache:
+        app.state.license_cache.invalidate(key_codes, installs)
+
+def get_license_row(key_code: str) -> Optional[Dict[str, Any]]:
+    """Look up a license_keys row by key code, through the license cache"""
+    if app.state.license_cache:
+        return app.state.license_cache.get_by_key(key_code)
+    with app.state.db.connection() as conn:
+        return fetch_license_by_key(conn, key_code)
+
+def get_license_row_by_install(install: str) -> Optional[Dict[str, Any]]:
+    """Look up the newest active license_keys row for an install, through the license cache"""
+    if app.state.license_cache:
+        return app.state.license_cache.get_by_install(install)
+    with app.state.db.connection() as conn:
+        key_code = fetch_key_code_by_install(conn, install)
+        return fetch_license_by_key(conn, key_code) if key_code else None
+
+def live_usage(row: Dict[str, Any]) -> int:
+    """
+    Usage count in the key's current window, including increments not yet
+    written behind to Postgres (0 once the window has ended; it rolls over
+    on the next metered call)
+    """
+    if row['subscription_status'] == 'active' and row['usage_resets_at'] and row['usage_resets_at'] <= datetime.now():
+        return 0
+    if not app.state.usage:
+        return row['gobot_used']
+    live = app.state.usage.peek(row['key_code'])
+    return live if live is not None else row['gobot_used']
+
+@span("usage")
+def reserve_usage(license_key: str) -> bool:
+    """
+    Reserve one metered call against the key's monthly limit before any
+    Claude call is made. Raises 429 at the limit; returns True if a call was
+    counted (and must be refunded if the generation fails).
+    """
+    if app.state.usage:
+        try:
+            counted = app.state.usage.increment(license_key)
+            if counted:
+                print(f"📊 Usage: {counted[0]}/{counted[1]} for {license_key}")
+            return counted is not None
+        except UsageLimitExceeded as e:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Monthly limit of {e.limit} reached. Please upgrade or wait for reset."
+            )
+        except redis.RedisError as e:
+            print(f"⚠️  Usage counter unavailable, falling back to database: {e}")
+        except Exception as e:
+            print(f"Error tracking usage: {e}")
+            return False
+    
+    conn = get_db_connection()
+    if not conn:
+        return False
+    
+    try:
+        cur = conn.cursor()
+
+        # Check and increment in one statement, so concurrent calls can't race
+        # past the limit; a usage window that has ended rolls over right here
+        with timed_query("reserve usage"):
+            cur.execute(RESERVE_USAGE_SQL, (license_key,))
+
+        reserved = cur.fetchone()
+        conn.commit()
+
+        if reserved:
+            invalidate_license_cache([license_key])
+            print(f"📊 Usage: {reserved['gobot_used']}/{reserved['gobot_limit']} for {license_key}")
+            return True
+
+        # Nothing reserved: either the key is at its limit or it isn't an active key
         cur.execute("""
-            UPDATE license_keys
-            SET gobot_used = 0,
-                usage_resets_at = usage_resets_at + INTERVAL '1 month',
-                updated_at = NOW()
-            WHERE is_active = true
-            AND subscription_status = 'active'
-            AND usage_resets_at <= NOW()
-        """)
-        
-        rows_updated = cur.rowcount
+            SELECT gobot_limit
+            FROM license_keys
+            WHERE key_code = %s
+            AND is_active = true
+        """, (license_key,))
+
+        at_limit = cur.fetchone()
+        conn.commit()
+
+        if at_limit:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Monthly limit of {at_limit['gobot_limit']} reached. Please upgrade or wait for reset."
+            )
+        return False
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error tracking usage: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn)
+
+@span("usage")
+def refund_usage(license_key: str):
+    """Give back a call reserved by reserve_usage after its generation failed"""
+    if app.state.usage:
+        try:
+            if app.state.usage.refund(license_key):
+                print(f"↩️  Usage refunded for {license_key}")
+                return
+        except redis.RedisError as e:
+            print(f"⚠️  Usage counter unavailable, refunding in database: {e}")
+    
+    conn = get_db_connection()
+    if not conn:
+        print(f"⚠️  Could not refund usage for {license_key}: database unavailable")
+        return
+    
+    try:
+        cur = conn.cursor()
+        with timed_query("refund usage"):
+            cur.execute("""
+                UPDATE license_keys
+                SET gobot_used = GREATEST(gobot_used - 1, 0),
+                    updated_at = NOW()
+                WHERE key_code = %s
+            """, (license_key,))
         conn.commit()
+        invalidate_license_cache([license_key])
+        print(f"↩️  Usage refunded for {license_key}")
+    except Exception as e:
+        print(f"Error refunding usage: {e}")
+        conn.rollback()
+    finally:
+        release_db_connection(conn)
+
+async def refund_reservation(license_key: Optional[str]):
+    """Refund a reservation from async code; no-op when nothing was reserved"""
+    if license_key:
+        await run_in_threadpool(refund_usage, license_key)
+
+def activate_license_key(key_code: str, install: str, first_use: bool):
+    """Activate a key on an install, deactivating the install's old keys"""
+    conn = get_db_connection()
+    if not conn:
+        raise RuntimeError("Database unavailable")
+    
+    try:
+        cur = conn.cursor()
         
-        print(f"✅ Reset usage for {rows_updated} subscriptions")
+        # Deactivate any OLD keys for this install (user is switching to new key)
+        with timed_query("deactivate install's old keys"):
+            cur.execute(DEACTIVATE_OLD_KEYS_SQL, (install, key_code))
+        deactivated_keys = [row['key_code'] for row in cur.fetchall()]
         
-    except Exception as e:
-        print(f"Error resetting usage: {e}")
+        deactivated_count = cur.rowcount
+        if deactivated_count > 0:
+            print(f"🔒 Deactivated {deactivated_count} old key(s) for install {install}")
+        
+        # Mark as activated if first use
+        if first_use:
+            with timed_query("activate license"):
+                cur.execute("""
+                    UPDATE license_keys 
+                    SET activated_at = NOW(), 
+                        updated_at = NOW(), 
+                        is_active=true,
+                        install = %s
+                    WHERE key_code = %s
+                """, (install, key_code))
+            print(f"🎉 License key activated: {key_code} for {install}")
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        release_db_connection(conn)
+    
+    invalidate_usage_counters(deactivated_keys)
+    invalidate_license_cache(deactivated_keys + [key_code], [install])
 
 def generate_license_key() -> str:
     """Generate a unique license key in format GOBOT-XXXX-XXXX-XXXX"""
@@ -310,22 +908,11 @@ def generate_license_key() -> str:
     
     return f"GOBOT-{'-'.join(parts)}"
 
-def send_license_key_email(email: str, license_key: str, plan_name: str, gobot_limit: int) -> bool:
-    """
-    Send license key via Mailgun email
-    Returns True if sent successfully, False otherwise
-    """
-    
-    # Check if Mailgun is configured
-    if not MAILGUN_API_KEY or not MAILGUN_DOMAIN:
-        print("⚠️ Mailgun not configured. Set MAILGUN_API_KEY and MAILGUN_DOMAIN env vars.")
-        _print_email_fallback(email, license_key, plan_name, gobot_limit)
-        return False
-    
-    subject = f"Your GoBot {plan_name} License Key 🎉"
-    
+# Parsed once at import; the mailer sends them as Mailgun batch templates
+LICENSE_KEY_EMAIL = EmailTemplates(
+    subject=EmailTemplate("Your GoBot {plan_name} License Key 🎉"),
     # Plain text version
-    text_body = f"""
+    text=EmailTemplate("""
 Hi there!
 
 Welcome to GoBot {plan_name}!
@@ -352,10 +939,9 @@ Need help? Just reply to this email.
 
 Happy clarifying! ✨
 The GoBot Team
-"""
-
+"""),
     # HTML version
-    html_body = f"""
+    html=EmailTemplate("""
 <!DOCTYPE html>
 <html>
 <head>
@@ -429,34 +1015,57 @@ The GoBot Team
     
 </body>
 </html>
-"""
+"""),
+)
 
-    try:
-        response = requests.post(
-            f"https://api.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-            auth=("api", MAILGUN_API_KEY),
-            data={
-                "from": MAILGUN_FROM_EMAIL,
-                "to": email,
-                "subject": subject,
-                "text": text_body,
-                "html": html_body
-            },
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            print(f"✅ License key email sent to {email}")
-            return True
-        else:
-            print(f"❌ Mailgun error: {response.status_code} - {response.text}")
-            _print_email_fallback(email, license_key, plan_name, gobot_limit)
-            return False
-            
-    except requests.RequestException as e:
-        print(f"❌ Failed to send email: {e}")
+
+def send_license_key_email(email: str, license_key: str, plan_name: str, gobot_limit: int) -> bool:
+    """
+    Queue the license key email for background delivery via Mailgun
+    Returns True if queued, False otherwise
+    """
+    mailer = app.state.mailer
+    
+    # Check if Mailgun is configured
+    if not mailer:
+        print("⚠️ Mailgun not configured. Set MAILGUN_API_KEY and MAILGUN_DOMAIN env vars.")
+        _print_email_fallback(email, license_key, plan_name, gobot_limit)
+        return False
+    
+    if not mailer.send("license_key", email, license_key=license_key, plan_name=plan_name, gobot_limit=gobot_limit):
+        print(f"⚠️  Email queue full, not sending to {email}")
         _print_email_fallback(email, license_key, plan_name, gobot_limit)
         return False
+    
+    return True
+
+
+def send_purchased_key_email(conn, email: str, license_key: str, plan: str, gobot_limit: int):
+    """
+    Deliver a purchased key's email and record that it was sent (blocking -
+    run by Stripe event workers). Raises if Mailgun didn't accept it, so the
+    outbox retries the event and the email survives restarts.
+    """
+    mailer = app.state.mailer
+    if not mailer:
+        print("⚠️ Mailgun not configured. Set MAILGUN_API_KEY and MAILGUN_DOMAIN env vars.")
+        _print_email_fallback(email, license_key, plan.capitalize(), gobot_limit)
+        return
+    
+    if not mailer.deliver("license_key", email, timeout=EMAIL_DELIVERY_TIMEOUT,
+                          license_key=license_key, plan_name=plan.capitalize(), gobot_limit=gobot_limit):
+        raise RuntimeError(f"License key email to {email} was not delivered")
+    
+    cur = conn.cursor()
+    cur.execute("UPDATE license_keys SET key_email_sent_at = NOW() WHERE key_code = %s", (license_key,))
+    conn.commit()
+    print(f"📧 License key email sent to {email}")
+
+
+def email_delivery_failed(email: Email):
+    """Mailer on_failure hook: log the email that could not be delivered"""
+    if email.template == "license_key":
+        _print_email_fallback(email.to, **email.values)
 
 
 def _print_email_fallback(email: str, license_key: str, plan_name: str, gobot_limit: int):
@@ -467,7 +1076,7 @@ def _print_email_fallback(email: str, license_key: str, plan_name: str, gobot_li
     ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
     
     To: {email}
-    Subject: Your GoBot {plan_name} License Key 🎉
+    Subject: {LICENSE_KEY_EMAIL.subject.render(plan_name=plan_name)}
     
     License Key: {license_key}
     Plan: {plan_name}
@@ -477,23 +1086,287 @@ def _print_email_fallback(email: str, license_key: str, plan_name: str, gobot_li
     """)
 
 # ============================================================================
-# AI Processing
+# Rate Limiting
 # ============================================================================
 
-async def generate_code(input: CodeGenInput) -> CodeGenOutput:
-    """Generate MVP code implementation using Claude AI with continuation support"""
-    start_time = datetime.now()
+def client_ip(request: Request) -> str:
+    """Caller's address (first X-Forwarded-For hop when behind the proxy)"""
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def check_rate_limit(scope: str, buckets: List[Bucket]):
+    """Raise 429 with Retry-After if any of the request's token buckets is empty"""
+    if not app.state.rate_limiter or not buckets:
+        return
+    retry_after = app.state.rate_limiter.hit(scope, buckets)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please slow down and retry shortly.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def get_request_rate(plan_id: str) -> int:
+    """Get AI requests per minute based on plan"""
+    rates = {
+        'free': REQUEST_RATE_FREE,
+        'pro': REQUEST_RATE_PRO,
+        'team': REQUEST_RATE_TEAM
+    }
+    return rates.get(plan_id, REQUEST_RATE_FREE)
+
+
+def lookup_plan(license_key: str) -> str:
+    """Plan of a license key, through the license cache ('free' if unknown)"""
+    if license_key == "free_user" or not app.state.db:
+        return 'free'
+    try:
+        row = get_license_row(license_key)
+    except Exception as e:
+        print(f"⚠️  Could not look up plan: {e}")
+        return 'free'
+    return row['plan'] if row else 'free'
+
+
+def ai_request_buckets(install: Optional[str], license_key: str, rate: int) -> List[Bucket]:
+    """Per-key and per-install buckets of an AI request at rate per minute"""
+    buckets = []
+    if license_key != "free_user":
+        buckets.append((f"key:{license_key}", rate, 60))
+    if install:
+        buckets.append((f"install:{install}", rate, 60))
+    return buckets
+
+
+@span("ratelimit")
+def limit_ai_request(install: Optional[str], license_key: str) -> str:
+    """
+    Rate limit an AI request per access key and per install, before it
+    reaches the usage counters or Claude. The buckets are checked at the
+    highest plan's rate first, which needs no plan, so a client over it
+    (or one cycling made-up keys from one install) is turned away without
+    a license lookup; what passes is then held to its plan's rate.
+    Returns the plan.
+    """
+    ceiling = max(REQUEST_RATE_FREE, REQUEST_RATE_PRO, REQUEST_RATE_TEAM)
+    check_rate_limit("ai", ai_request_buckets(install, license_key, ceiling))
+    plan = lookup_plan(license_key)
+    rate = get_request_rate(plan)
+    if rate < ceiling:
+        check_rate_limit("ai-plan", ai_request_buckets(install, license_key, rate))
+    return plan
+
+# ============================================================================
+# Usage Analytics
+# ============================================================================
+
+# usage_events row being built for the current request (Claude tokens are added as they're recorded)
+current_usage_event: ContextVar[Optional[Dict[str, Any]]] = ContextVar("current_usage_event", default=None)
+
+
+def begin_usage_event(endpoint: str, install: Optional[str], license_key: str, plan: str) -> Optional[Dict[str, Any]]:
+    """Start timing a metered request for the usage_events ledger"""
+    if not app.state.usage_events:
+        return None
+    event = {
+        "endpoint": endpoint,
+        "key_code": None if license_key == "free_user" else license_key,
+        "install": install,
+        "plan": plan,
+        "started": time.perf_counter(),
+    }
+    current_usage_event.set(event)
+    return event
+
+
+def finish_usage_event(event: Optional[Dict[str, Any]], status: int):
+    """Buffer the request's usage_events row (never waits on Postgres)"""
+    if not event:
+        return
+    tokens = event.get("tokenUsage", {})
+    app.state.usage_events.record(
+        endpoint=event["endpoint"],
+        key_code=event["key_code"],
+        install=event["install"],
+        plan=event["plan"],
+        status=status,
+        latency_ms=int((time.perf_counter() - event["started"]) * 1000),
+        input_tokens=tokens.get("input", 0),
+        output_tokens=tokens.get("output", 0),
+        cache_read_tokens=tokens.get("cacheRead", 0),
+        cache_creation_tokens=tokens.get("cacheCreation", 0),
+    )
+
+# ============================================================================
+# Metrics
+# ============================================================================
+
+LLM_CALL_SECONDS = REGISTRY.histogram(
+    "gobot_llm_call_seconds", "Claude call duration (admission slot held), by call site", ("call",),
+)
+LLM_ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "gobot_llm_admission_wait_seconds", "Time a Claude call waited for an admission slot", ("call",),
+)
+LLM_TOKENS = REGISTRY.counter("gobot_llm_tokens_total", "Claude tokens by type", ("type",))
+LLM_CONTINUATIONS = REGISTRY.histogram(
+    "gobot_llm_continuations", "max_tokens continuations per generation", ("call",), buckets=(0, 1, 2, 3, 4, 5),
+)
+
+TOKEN_METRIC_TYPES = {"input": "input", "output": "output", "cacheRead": "cache_read", "cacheCreation": "cache_creation"}
+
+
+def collect_service_metrics():
+    """Pool, cache and queue figures read from the components' stats() at scrape time"""
+    def family(name, kind, help, samples):
+        return (name, kind, help, [(labels, value) for labels, value in samples if value is not None])
     
-    if not app.state.claude:
-        raise HTTPException(status_code=500, detail="AI service not configured")
+    state = app.state
+    if getattr(state, 'db', None):
+        pool = state.db.stats()
+        yield family("gobot_db_pool_connections", "gauge", "Database connections by state", [
+            ({"state": "in_use"}, pool["inUse"]),
+            ({"state": "idle"}, pool["idle"]),
+        ])
+        yield family("gobot_db_pool_max_connections", "gauge", "Database pool size limit", [({}, pool["maxSize"])])
+        yield family("gobot_db_pool_waiting", "gauge", "Threads waiting for a database connection", [({}, pool["waiting"])])
+        yield family("gobot_db_pool_timeouts_total", "counter", "Database checkouts that timed out", [({}, pool["timeouts"])])
     
-    prompt = f"""You are a senior software engineer. Generate a clean, well-documented MVP implementation based on this Jira ticket.
+    if getattr(state, 'result_cache', None):
+        cache = state.result_cache.stats()
+        yield family("gobot_result_cache_lookups_total", "counter", "Generation result cache lookups by outcome", [
+            ({"result": "hit"}, cache["hits"]),
+            ({"result": "miss"}, cache["misses"]),
+            ({"result": "coalesced"}, cache["coalesced"]),
+        ])
+    
+    if getattr(state, 'license_cache', None):
+        cache = state.license_cache.stats()
+        yield family("gobot_license_cache_lookups_total", "counter", "License lookups by the tier that answered", [
+            ({"tier": "local"}, cache["localHits"]),
+            ({"tier": "redis"}, cache["redisHits"]),
+            ({"tier": "database"}, cache["misses"]),
+        ])
+    
+    if getattr(state, 'admission', None):
+        admission = state.admission.stats()
+        yield family("gobot_llm_in_flight", "gauge", "Claude calls holding an admission slot", [({}, admission["inFlight"])])
+        yield family("gobot_llm_queued", "gauge", "Claude calls waiting for an admission slot", [({}, admission["queued"])])
+        yield family("gobot_llm_rejected_total", "counter", "Claude calls rejected by admission control", [
+            ({"reason": "queue_full"}, admission["rejected"]),
+            ({"reason": "timeout"}, admission["timeouts"]),
+        ])
+    
+    queues = []
+    if getattr(state, 'jobs', None):
+        try:
+            depth = state.jobs.queue_depth()
+            queues += [({"queue": "jobs"}, depth["queued"]), ({"queue": "jobs_running"}, depth["running"])]
+        except Exception as e:
+            print(f"⚠️  Job queue depth unavailable for metrics: {e}")
+    if getattr(state, 'mailer', None):
+        queues.append(({"queue": "email"}, state.mailer.stats()["queued"]))
+    if getattr(state, 'usage_events', None):
+        queues.append(({"queue": "usage_events"}, state.usage_events.stats()["buffered"]))
+    yield family("gobot_queue_depth", "gauge", "Items waiting in background queues", queues)
+    
+    if getattr(state, 'rate_limiter', None):
+        limits = state.rate_limiter.stats()
+        yield family("gobot_rate_limit_decisions_total", "counter", "Rate limit decisions by scope", [
+            ({"scope": scope, "result": result}, count)
+            for result in ("allowed", "rejected")
+            for scope, count in limits[result].items()
+        ])
 
-## Jira Ticket
 
-{input.jiraDescription}
+REGISTRY.add_collector(collect_service_metrics)
 
-{f"## Extra important context to take into account{chr(10)}{input.customPrompt}" if input.customPrompt else ""}
+# ============================================================================
+# AI Processing
+# ============================================================================
+
+# Install and plan weight the current request's Claude calls are queued under
+llm_tenant: ContextVar[Optional[tuple]] = ContextVar("llm_tenant", default=None)
+
+
+async def admit(install: Optional[str], license_key: str, plan: Optional[str] = None, background: bool = False):
+    """
+    Queue this request's Claude calls under its install, weighted by plan.
+    Interactive requests fail fast with 429/503 when the queue is already
+    full; background jobs wait their turn.
+    """
+    if plan is None:
+        plan = await run_in_threadpool(lookup_plan, license_key)
+    
+    tenant = install or license_key
+    if not background:
+        app.state.admission.check(tenant)
+    llm_tenant.set((tenant, float(get_plan_limits(plan)), not background))
+
+
+@asynccontextmanager
+async def llm_slot(call: str):
+    """Hold an admission slot for one Claude call (call names it in /metrics)"""
+    tenant, weight, bounded = llm_tenant.get() or ("free_user", float(get_plan_limits('free')), True)
+    queued_at = time.perf_counter()
+    async with app.state.admission.slot(tenant, weight, bounded):
+        started = time.perf_counter()
+        LLM_ADMISSION_WAIT_SECONDS.observe(started - queued_at, call=call)
+        record_span("llm_queue", started - queued_at)
+        try:
+            with span("claude"):
+                yield
+        finally:
+            LLM_CALL_SECONDS.observe(time.perf_counter() - started, call=call)
+
+
+def record_token_usage(message) -> Dict[str, int]:
+    """Record token and prompt cache usage for one Claude response"""
+    counts = app.state.llm_usage.record(message.usage)
+    for name, count in counts.items():
+        LLM_TOKENS.inc(count, type=TOKEN_METRIC_TYPES[name])
+    event = current_usage_event.get()
+    if event:
+        add_token_usage(event, counts)
+    print(f"💾 Tokens: {counts['input']} in, {counts['output']} out, "
+          f"{counts['cacheRead']} cache read, {counts['cacheCreation']} cache write")
+    return counts
+
+
+def add_token_usage(stats: Dict[str, Any], counts: Dict[str, int]):
+    """Add one response's token counts to a request's running totals"""
+    totals = stats.setdefault("tokenUsage", {})
+    for name, count in counts.items():
+        totals[name] = totals.get(name, 0) + count
+
+
+# Bump whenever a prompt template changes so cached results are not reused
+PROMPT_TEMPLATE_VERSION = "3"
+
+# Tail of a truncated answer re-sent as the prefill for its continuation
+CONTINUATION_CONTEXT_CHARS = 8000
+
+
+def code_max_tokens(prompt: str) -> int:
+    """max_tokens for a code generation, sized from the ticket"""
+    return adaptive_max_tokens(prompt, floor=4000, ceiling=16000, ratio=8)
+
+
+def clarify_max_tokens(prompt: str) -> int:
+    """max_tokens for a clarification, sized from the ticket"""
+    return adaptive_max_tokens(prompt, floor=1500, ceiling=4000, ratio=2)
+
+
+def section_max_tokens(prompt: str) -> int:
+    """max_tokens for a single clarification section, sized from the ticket"""
+    return adaptive_max_tokens(prompt, floor=600, ceiling=1500, ratio=0.5)
+
+# Static instructions go in the system prompt so they form a cacheable prefix;
+# the per-ticket part is sent as the user turn after it.
+CODE_SYSTEM_PROMPT = """You are a senior software engineer. Generate a clean, well-documented MVP implementation based on the Jira ticket you are given.
 
 ## Your Task
 
@@ -538,172 +1411,927 @@ Structure your response EXACTLY like this (use markdown formatting):
 - Write complete, runnable code (not pseudocode)
 - Include extensive comments explaining the logic
 - Handle edge cases mentioned in the ticket
-- Use clear variable/function names
+- Use clear variable/function names"""
+
+def build_code_prompt(input: CodeGenInput) -> str:
+    """Build the per-ticket part of the code generation prompt"""
+    return f"""## Jira Ticket
+
+{input.jiraDescription}
+
+{f"## Extra important context to take into account{chr(10)}{input.customPrompt}" if input.customPrompt else ""}
 
 Generate the implementation now:"""
 
-    try:
-        # Initial request
-        messages = [{"role": "user", "content": prompt}]
-        full_response = ""
-        max_continuations = 5  # Safety limit to prevent infinite loops
-        continuation_count = 0
-        
-        while continuation_count < max_continuations:
-            message = app.state.claude.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=8000,
+
+@span("parse")
+def extract_summary(implementation: str) -> str:
+    """Pull the first paragraph of the '## 📋 Summary' section out of an implementation"""
+    summary = "Implementation generated successfully."
+    if "## 📋 Summary" in implementation:
+        try:
+            summary_section = implementation.split("## 📋 Summary")[1]
+            summary_end = summary_section.find("##")
+            if summary_end > 0:
+                summary = summary_section[:summary_end].strip()
+            else:
+                summary = summary_section.strip()
+            summary = summary.split("\n\n")[0].strip()
+        except:
+            pass
+    return summary
+
+
+CLARIFY_SECTIONS = {
+    "acceptanceCriteria": "Specific, testable conditions, using Given-When-Then format where appropriate",
+    "edgeCases": "Potential issues and boundary conditions to consider",
+    "successMetrics": "Measurable outcomes and KPIs",
+    "testScenarios": "Specific test cases for QA",
+}
+
+# Clarifications are returned as a forced tool call, so the answer always
+# matches ClarifiedOutput instead of being JSON parsed out of free text
+CLARIFY_TOOL = list_fields_tool(
+    "record_clarification",
+    "Record the clarified acceptance criteria, edge cases, success metrics and test scenarios for the ticket.",
+    CLARIFY_SECTIONS,
+)
+
+# One single-section tool per section, for the concurrent "sections" mode
+CLARIFY_SECTION_TOOLS = {
+    section: list_fields_tool(
+        "record_clarification",
+        f"Record the {section} for the ticket.",
+        {section: description},
+    )
+    for section, description in CLARIFY_SECTIONS.items()
+}
+
+CLARIFY_SYSTEM_PROMPT = """You are a senior software engineer helping to clarify Jira tickets. Given the ticket information you are sent, provide clear, actionable acceptance criteria and additional details.
+
+Record your answer with the record_clarification tool:
+1. acceptanceCriteria - specific, testable conditions (Given-When-Then format where appropriate)
+2. edgeCases - potential issues, boundary conditions
+3. successMetrics - measurable outcomes, KPIs
+4. testScenarios - specific test cases for QA
+
+Focus on being practical and actionable. Provide at least 3-5 items for each category."""
+
+CLARIFY_SECTION_SYSTEM_PROMPT = """You are a senior software engineer helping to clarify Jira tickets. Given the ticket information you are sent, provide clear, actionable items for the one section of the clarification you are asked for, and record them with the record_clarification tool.
+
+Focus on being practical and actionable. Provide 3-5 items."""
+
+def build_clarification_prompt(ticket: TicketInput) -> str:
+    """Build the per-ticket part of the clarification prompt"""
+    return f"""Ticket Title: {ticket.title}
+Description: {ticket.description or 'No description provided'}
+Issue Type: {ticket.issueType}
+Priority: {ticket.priority}
+
+{f"For more important context please take this into account: {ticket.customPrompt}" if ticket.customPrompt else ""}
+"""
+
+
+async def complete_with_continuations(system: str, prompt: str, max_tokens: int, max_continuations: int, stats: Dict[str, Any]) -> str:
+    """
+    Run a Claude completion, continuing past max_tokens truncation by
+    prefilling the assistant turn with the tail of the answer so far.
+    The request's continuation count and token usage are put in stats.
+    """
+    messages = with_cache_breakpoint([{"role": "user", "content": prompt}])
+    answer = ""
+    trimmed = ""  # Whitespace cut off the last prefill, which Claude may repeat
+    stats.update(continuations=0, maxTokens=max_tokens)
+    
+    while True:
+        async with llm_slot("completion"):
+            message = await app.state.claude.messages.create(
+                model=CLAUDE_MODEL,
+                max_tokens=max_tokens,
+                system=cached_system(system),
                 messages=messages
             )
-            
-            # Get the response text
-            response_text = message.content[0].text
-            full_response += response_text
-            
-            print(f"📝 Response chunk {continuation_count + 1}: {len(response_text)} chars, stop_reason: {message.stop_reason}")
-            
-            # Check if Claude finished naturally
-            if message.stop_reason == "end_turn":
-                print("✅ Claude finished naturally")
-                break
-            
-            # If stopped due to max_tokens, continue the conversation
-            if message.stop_reason == "max_tokens":
-                print("⏳ Response truncated, requesting continuation...")
-                continuation_count += 1
-                
-                # Add assistant's partial response and ask to continue
-                messages.append({"role": "assistant", "content": response_text})
-                messages.append({"role": "user", "content": "Please continue exactly where you left off. Do not repeat any content, just continue from the exact point you stopped."})
-            else:
-                # Unknown stop reason, break to be safe
-                print(f"⚠️ Unknown stop_reason: {message.stop_reason}")
-                break
+        add_token_usage(stats, record_token_usage(message))
+        
+        # Get the response text
+        response_text = strip_seam(trimmed, "".join(block.text for block in message.content if block.type == "text"))
+        answer += response_text
+        
+        print(f"📝 Response chunk {stats['continuations'] + 1}: {len(response_text)} chars, stop_reason: {message.stop_reason}")
+        
+        # Check if Claude finished naturally
+        if message.stop_reason == "end_turn":
+            print("✅ Claude finished naturally")
+            break
         
-        if continuation_count >= max_continuations:
+        if message.stop_reason != "max_tokens":
+            # Unknown stop reason, break to be safe
+            print(f"⚠️ Unknown stop_reason: {message.stop_reason}")
+            break
+        
+        if stats["continuations"] >= max_continuations:
             print(f"⚠️ Reached max continuations ({max_continuations})")
+            break
+        
+        # Truncated: prefill the answer so far and let Claude carry on from there
+        print("⏳ Response truncated, requesting continuation...")
+        stats["continuations"] += 1
+        messages, trimmed = continuation_messages(prompt, answer, CONTINUATION_CONTEXT_CHARS)
+    
+    LLM_CONTINUATIONS.observe(stats["continuations"], call="completion")
+    print(f"📊 Request used {stats['continuations']} continuation(s), tokens: {stats['tokenUsage']}")
+    return answer
+
+
+async def generate_code(input: CodeGenInput, context: str = "") -> CodeGenOutput:
+    """Generate MVP code implementation using Claude AI with continuation support"""
+    start_time = datetime.now()
+    
+    if not app.state.claude:
+        raise HTTPException(status_code=500, detail="AI service not configured")
+    
+    prompt = context + build_code_prompt(input)
+
+    try:
+        stats = {}
+        full_response = await complete_with_continuations(
+            CODE_SYSTEM_PROMPT,
+            prompt,
+            code_max_tokens(prompt),
+            max_continuations=5,  # Safety limit to prevent infinite loops
+            stats=stats
+        )
         
         implementation = full_response.strip()
         
-        # Extract summary
-        summary = "Implementation generated successfully."
-        if "## 📋 Summary" in implementation:
-            try:
-                summary_section = implementation.split("## 📋 Summary")[1]
-                summary_end = summary_section.find("##")
-                if summary_end > 0:
-                    summary = summary_section[:summary_end].strip()
-                else:
-                    summary = summary_section.strip()
-                summary = summary.split("\n\n")[0].strip()
-            except:
-                pass
+        summary = extract_summary(implementation)
         
         processing_time = (datetime.now() - start_time).total_seconds()
         
         return CodeGenOutput(
             implementation=implementation,
             summary=summary,
-            processingTime=processing_time
+            processingTime=processing_time,
+            continuations=stats["continuations"],
+            tokenUsage=stats["tokenUsage"]
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"AI generation error: {e}")
         raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
 
 
-async def generate_clarification(ticket: TicketInput) -> ClarifiedOutput:
-    """Generate clarification using Claude AI with continuation support"""
-    start_time = datetime.now()
-    
-    if not app.state.claude:
-        raise HTTPException(status_code=500, detail="AI service not configured")
-    
-    prompt = f"""You are a senior software engineer helping to clarify Jira tickets. Given the following ticket information, provide clear, actionable acceptance criteria and additional details.
+def generate_code_for_mode(input: CodeGenInput, context: str = ""):
+    """Code generation coroutine for the requested mode (context: similar past tickets)"""
+    if input.mode == "parallel":
+        return generate_code_parallel(input, context)
+    return generate_code(input, context)
+
+
+# Plan-then-fan-out code generation: one short planning call, then every
+# planned file generated concurrently, so wall-clock time tracks the slowest
+# file rather than the sum of all of them.
+
+PLAN_TOOL = {
+    "name": "plan_implementation",
+    "description": "Record the plan for an MVP implementation of the ticket.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string", "description": "2-3 sentences describing what will be built and the approach taken"},
+            "techStack": {"type": "array", "items": {"type": "string"}},
+            "files": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "path": {"type": "string", "description": "File path, e.g. src/app.py"},
+                        "language": {"type": "string", "description": "Language for the code block, e.g. python"},
+                        "purpose": {"type": "string", "description": "One or two sentences on what this file contains"},
+                    },
+                    "required": ["path", "language", "purpose"],
+                },
+            },
+            "setupSteps": {"type": "array", "items": {"type": "string"}},
+            "nextSteps": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["summary", "techStack", "files", "setupSteps", "nextSteps"],
+    },
+}
+
+PLAN_SYSTEM_PROMPT = """You are a senior software engineer planning a clean, well-documented MVP implementation of the Jira ticket you are given.
+
+Record the plan with the plan_implementation tool: a short summary, the tech stack, every file the MVP needs (path, language and what it contains), setup & run steps, and suggested next steps. Only plan files the MVP actually needs."""
+
+FILE_SYSTEM_PROMPT = """You are a senior software engineer implementing one file of a planned MVP. You are given the Jira ticket and the plan for every file, so the file you write agrees with the others on names and interfaces.
+
+Respond with only the complete contents of the requested file: no markdown code fences and no explanation before or after it.
+
+## Guidelines
+
+- Write complete, runnable code (not pseudocode)
+- Include extensive comments explaining the logic
+- Handle edge cases mentioned in the ticket
+- Use clear variable/function names"""
+
+MAX_PLANNED_FILES = 12
+
+
+def build_file_prompt(input: CodeGenInput, plan: Dict[str, Any], file: Dict[str, str]) -> str:
+    """Build the prompt for one planned file"""
+    file_plan = "\n".join(f"- {f['path']} ({f['language']}): {f['purpose']}" for f in plan['files'])
+    return f"""{build_code_prompt(input).rsplit("Generate the implementation now:", 1)[0].rstrip()}
+
+## Implementation plan
+
+{plan['summary']}
+
+Tech stack: {", ".join(plan['techStack'])}
+
+Files:
+{file_plan}
+
+Write the complete contents of `{file['path']}` now:"""
+
+
+def strip_outer_fence(code: str) -> str:
+    """Remove a markdown fence wrapped around a whole file, if Claude added one anyway"""
+    lines = code.strip().split("\n")
+    if len(lines) >= 2 and lines[0].startswith("```") and lines[-1].strip() == "```":
+        lines = lines[1:-1]
+    return "\n".join(lines)
+
+
+def assemble_implementation(plan: Dict[str, Any], files: List[Dict[str, Any]]) -> str:
+    """Lay out a planned, generated implementation in the single-pass markdown format"""
+    sections = [
+        f"## 📋 Summary\n\n{plan['summary']}",
+        "## 🛠️ Tech Stack\n\n" + "\n".join(f"- {tech}" for tech in plan['techStack']),
+        "## 💻 Implementation",
+    ]
+    for file in files:
+        sections.append(f"### {file['path']}\n\n{file['purpose']}\n```{file['language']}\n{file['code']}\n```")
+    sections.append("## 🚀 Setup & Run\n\n" + "\n".join(f"{i}. {step}" for i, step in enumerate(plan['setupSteps'], 1)))
+    sections.append("## 📌 Next Steps\n\n" + "\n".join(f"- {step}" for step in plan['nextSteps']))
+    return "\n\n".join(sections)
+
+
+async def plan_implementation(input: CodeGenInput, stats: Dict[str, Any], context: str = "") -> Dict[str, Any]:
+    """Ask Claude for the file plan as a forced plan_implementation tool call"""
+    async with llm_slot("plan"):
+        message = await app.state.claude.messages.create(
+            model=CLAUDE_MODEL,
+            max_tokens=2000,
+            system=cached_system(PLAN_SYSTEM_PROMPT),
+            tools=[PLAN_TOOL],
+            tool_choice=forced_tool_choice(PLAN_TOOL),
+            messages=with_cache_breakpoint([{"role": "user", "content": context + build_code_prompt(input)}])
+        )
+    add_token_usage(stats, record_token_usage(message))
+    
+    plan = next(block.input for block in message.content if block.type == "tool_use")
+    if not plan.get('files'):
+        raise ValueError("Plan contains no files")
+    plan['files'] = plan['files'][:MAX_PLANNED_FILES]
+    for key in ('techStack', 'setupSteps', 'nextSteps'):
+        plan.setdefault(key, [])
+    plan.setdefault('summary', "Implementation generated successfully.")
+    return plan
+
+
+async def generate_planned_file(input: CodeGenInput, plan: Dict[str, Any], file: Dict[str, str], slots: asyncio.Semaphore) -> Dict[str, Any]:
+    """Generate one planned file, waiting for a free parallelism slot first"""
+    async with slots:
+        start = time.monotonic()
+        prompt = build_file_prompt(input, plan, file)
+        stats = {}
+        code = await complete_with_continuations(FILE_SYSTEM_PROMPT, prompt, code_max_tokens(prompt), 2, stats)
+        return {
+            **file,
+            "code": strip_outer_fence(code),
+            "seconds": round(time.monotonic() - start, 3),
+            "continuations": stats['continuations'],
+            "tokenUsage": stats['tokenUsage'],
+        }
+
+
+async def generate_code_parallel(input: CodeGenInput, context: str = "") -> CodeGenOutput:
+    """Generate code by planning the files first, then generating them concurrently"""
+    start_time = datetime.now()
+    
+    if not app.state.claude:
+        raise HTTPException(status_code=500, detail="AI service not configured")
+    
+    parallelism = max(1, min(input.parallelism or CODEGEN_MAX_PARALLELISM, CODEGEN_MAX_PARALLELISM))
+    
+    try:
+        stats = {}
+        plan = await plan_implementation(input, stats, context)
+        planning_time = (datetime.now() - start_time).total_seconds()
+        print(f"🗺️  Planned {len(plan['files'])} files in {planning_time:.1f}s, generating {parallelism} at a time")
+        
+        slots = asyncio.Semaphore(parallelism)
+        tasks = [asyncio.create_task(generate_planned_file(input, plan, file, slots)) for file in plan['files']]
+        try:
+            files = await asyncio.gather(*tasks)
+        finally:
+            # One failed file fails the request: stop generating the others
+            for task in tasks:
+                task.cancel()
+        
+        for file in files:
+            add_token_usage(stats, file['tokenUsage'])
+        
+        return CodeGenOutput(
+            implementation=assemble_implementation(plan, files),
+            summary=plan['summary'],
+            processingTime=(datetime.now() - start_time).total_seconds(),
+            continuations=sum(file['continuations'] for file in files),
+            tokenUsage=stats['tokenUsage'],
+            planningTime=planning_time,
+            files=[
+                FileTiming(path=file['path'], seconds=file['seconds'], continuations=file['continuations'])
+                for file in files
+            ]
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"AI generation error: {e}")
+        raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
+
+
+async def stream_clarification_items(
+    prompt: str,
+    max_tokens: int,
+    max_continuations: int,
+    stats: Dict[str, Any],
+    system: str = CLARIFY_SYSTEM_PROMPT,
+    tool: Dict[str, Any] = CLARIFY_TOOL,
+):
+    """
+    Yield (section, item) pairs from a forced record_clarification tool call
+    as each item completes. A truncated call is continued by asking for only
+    the items still missing. If generation fails part-way, the items parsed
+    so far are kept and stats["status"] is set to "partial".
+    """
+    items = {section: [] for section in tool["input_schema"]["properties"]}
+    stats.update(continuations=0, maxTokens=max_tokens, status="complete", failedSections=[], items=items)
+    request_prompt = prompt
+    
+    while True:
+        parser = StreamingArrayParser()
+        try:
+            async with llm_slot("clarify"), app.state.claude.messages.stream(
+                model=CLAUDE_MODEL,
+                max_tokens=max_tokens,
+                system=cached_system(system),
+                tools=[tool],
+                tool_choice=forced_tool_choice(tool),
+                messages=with_cache_breakpoint([{"role": "user", "content": request_prompt}])
+            ) as stream:
+                async for event in stream:
+                    if event.type == "content_block_delta" and event.delta.type == "input_json_delta":
+                        with span("parse"):
+                            completed = parser.feed(event.delta.partial_json)
+                        for section, item in completed:
+                            # Continuations are told not to repeat items, but don't rely on it
+                            if section in items and item not in items[section]:
+                                items[section].append(item)
+                                yield section, item
+                message = await stream.get_final_message()
+        except Exception as e:
+            if not any(items.values()):
+                raise
+            print(f"⚠️ Clarification cut short, returning the items parsed so far: {e}")
+            stats["status"] = "partial"
+            break
+        add_token_usage(stats, record_token_usage(message))
+        
+        print(f"📝 Clarify chunk {stats['continuations'] + 1}: {sum(len(v) for v in parser.items.values())} items, stop_reason: {message.stop_reason}")
+        
+        if message.stop_reason != "max_tokens":
+            break
+        
+        if stats["continuations"] >= max_continuations:
+            print(f"⚠️ Reached max continuations ({max_continuations}), returning the items parsed so far")
+            stats["status"] = "partial"
+            break
+        
+        # Truncated: ask for the rest only, items already parsed are kept
+        print("⏳ Response truncated, requesting the remaining items...")
+        stats["continuations"] += 1
+        request_prompt = f"""{prompt}
+These items were already recorded, do not repeat them. Record only additional items, focusing on sections that have fewer than 3:
+{json.dumps(items, indent=2)}"""
+    
+    LLM_CONTINUATIONS.observe(stats["continuations"], call="clarify")
+    print(f"📊 Request used {stats['continuations']} continuation(s), tokens: {stats.get('tokenUsage')}")
+
+
+async def stream_clarification_sections(prompt: str, stats: Dict[str, Any]):
+    """
+    Yield (section, item) pairs from one small concurrent tool call per
+    section, interleaved as items complete. A section that fails or times
+    out is listed in stats["failedSections"] (keeping any items it finished)
+    and the others are still returned, with stats["status"] set to "partial".
+    """
+    section_stats = {section: {} for section in CLARIFY_SECTIONS}
+    failed = []
+    rejections = []
+    queue = asyncio.Queue()
+    
+    async def run_section(section: str):
+        section_prompt = f"""{prompt}
+Record only the {section} section: {CLARIFY_SECTIONS[section]}."""
+        
+        async def produce():
+            async for pair in stream_clarification_items(
+                section_prompt,
+                section_max_tokens(section_prompt),
+                1,
+                section_stats[section],
+                system=CLARIFY_SECTION_SYSTEM_PROMPT,
+                tool=CLARIFY_SECTION_TOOLS[section]
+            ):
+                await queue.put(pair)
+        
+        try:
+            await asyncio.wait_for(produce(), timeout=CLARIFY_SECTION_TIMEOUT)
+        except Exception as e:
+            print(f"⚠️ Clarify section {section} failed: {e!r}")
+            failed.append(section)
+            if isinstance(e, AdmissionRejected):
+                rejections.append(e)
+        finally:
+            await queue.put(None)
+    
+    tasks = [asyncio.create_task(run_section(section)) for section in CLARIFY_SECTIONS]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            pair = await queue.get()
+            if pair is None:
+                remaining -= 1
+            else:
+                yield pair
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    items = {section: section_stats[section].get('items', {}).get(section, []) for section in CLARIFY_SECTIONS}
+    if not any(items.values()):
+        if rejections:
+            raise rejections[0]
+        raise RuntimeError("Every clarification section failed")
+    
+    stats.update(
+        items=items,
+        continuations=sum(s.get('continuations', 0) for s in section_stats.values()),
+        failedSections=[section for section in CLARIFY_SECTIONS if section in failed],
+        status="partial" if failed or any(s.get('status') == "partial" for s in section_stats.values()) else "complete",
+    )
+    for s in section_stats.values():
+        if s.get('tokenUsage'):
+            add_token_usage(stats, s['tokenUsage'])
+
+
+def clarification_items(ticket: TicketInput, prompt: str, stats: Dict[str, Any]):
+    """(section, item) stream for the requested clarification mode"""
+    if ticket.mode == "sections":
+        return stream_clarification_sections(prompt, stats)
+    return stream_clarification_items(prompt, clarify_max_tokens(prompt), 2, stats)
+
+
+async def generate_clarification(ticket: TicketInput, context: str = "") -> ClarifiedOutput:
+    """Generate clarification using Claude AI (structured tool output with continuation support)"""
+    start_time = datetime.now()
+    
+    if not app.state.claude:
+        raise HTTPException(status_code=500, detail="AI service not configured")
+    
+    prompt = context + build_clarification_prompt(ticket)
+
+    try:
+        stats = {}
+        async for _ in clarification_items(ticket, prompt, stats):
+            pass
+        
+        processing_time = (datetime.now() - start_time).total_seconds()
+        
+        output = ClarifiedOutput(
+            **stats["items"],
+            processingTime=processing_time,
+            continuations=stats["continuations"],
+            tokenUsage=stats.get("tokenUsage"),
+            status=stats["status"],
+            failedSections=stats["failedSections"]
+        )
+        
+        return output
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"AI generation error: {e}")
+        raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
+
+
+def clarification_cache_key(ticket: TicketInput) -> str:
+    """Result cache key for a clarification request"""
+    return content_hash_key("clarify", PROMPT_TEMPLATE_VERSION, {
+        "title": ticket.title,
+        "description": ticket.description,
+        "issueType": ticket.issueType,
+        "priority": ticket.priority,
+        "customPrompt": ticket.customPrompt,
+        "mode": ticket.mode,
+    })
+
+
+def code_cache_key(input: CodeGenInput) -> str:
+    """Result cache key for a code generation request"""
+    return content_hash_key("gen-code", PROMPT_TEMPLATE_VERSION, {
+        "jiraDescription": input.jiraDescription,
+        "customPrompt": input.customPrompt,
+        "mode": input.mode,
+    })
+
+
+async def cached_generation(key: str, compute, model, cacheable=None):
+    """Serve a generation from the result cache, coalescing identical in-flight requests"""
+    if not app.state.result_cache:
+        return await compute()
+    return await app.state.result_cache.get_or_compute(key, compute, model, cacheable)
+
+
+def is_complete(output: ClarifiedOutput) -> bool:
+    """Partial clarifications are served but never cached"""
+    return output.status == "complete"
+
+# ============================================================================
+# Similar Ticket Retrieval (RAG)
+# ============================================================================
+
+# Of each similar past ticket's text shown in the prompt
+SIMILAR_TICKET_CHARS = 1500
+
+
+def init_similar_tickets():
+    """Build the retrieval index for ENABLE_RAG and reload it if it's in-process (blocking)"""
+    from go_bot_backend.rag import HashingEmbedder, LocalVectorIndex, PineconeVectorIndex, SimilarTickets
+    
+    if RAG_INDEX == "pinecone":
+        if not PINECONE_API_KEY:
+            raise ValueError("RAG_INDEX=pinecone needs PINECONE_API_KEY")
+        index = PineconeVectorIndex(PINECONE_API_KEY, PINECONE_INDEX)
+    else:
+        index = LocalVectorIndex(RAG_EMBEDDING_DIM, max_per_namespace=RAG_MAX_PER_INSTALL)
+    
+    rag = SimilarTickets(
+        HashingEmbedder(RAG_EMBEDDING_DIM),
+        index,
+        app.state.db,
+        top_k=RAG_TOP_K,
+        min_similarity=RAG_MIN_SIMILARITY,
+        reuse_similarity=RAG_REUSE_SIMILARITY,
+        max_per_install=RAG_MAX_PER_INSTALL,
+    )
+    loaded = rag.load()
+    print(f"✅ Similar ticket retrieval enabled ({RAG_INDEX} index, {loaded} tickets loaded)")
+    return rag
+
+
+def clarification_text(ticket: TicketInput) -> str:
+    """What a clarification is matched against past tickets by"""
+    return "\n".join(part for part in (ticket.issueType, ticket.title, ticket.description, ticket.customPrompt) if part)
+
+
+def code_text(input: CodeGenInput) -> str:
+    """What a code generation is matched against past tickets by"""
+    return "\n".join(part for part in (input.jiraDescription, input.customPrompt) if part)
+
+
+def similar_tickets_context(kind: str, similar) -> str:
+    """Prompt section with an install's similar past tickets and what was produced for them"""
+    if not similar:
+        return ""
+    parts = ["""## Similar tickets from this team, for reference
+
+Stay consistent with how these were handled, but work from the ticket below and don't copy details that don't apply to it.
+"""]
+    for ticket in similar:
+        output = json.loads(ticket.output)
+        if kind == "clarify":
+            result = "Acceptance criteria:\n" + "\n".join(f"- {item}" for item in output.get("acceptanceCriteria", [])[:5])
+        else:
+            result = f"Implementation summary: {output.get('summary', '')}"
+        parts.append(f"""### Past ticket (similarity {ticket.score:.2f})
+{ticket.text[:SIMILAR_TICKET_CHARS]}
+
+{result}
+""")
+    return "\n".join(parts) + "\n"
+
+
+async def find_similar(kind: str, install: Optional[str], text: str):
+    """
+    (reusable, prompt context) for a new ticket: a past ticket whose result
+    can be returned as is, and the similar tickets section for the prompt.
+    (None, "") when retrieval is off, the ticket has no install or it fails.
+    """
+    if not app.state.rag or not install:
+        return None, ""
+    try:
+        with span("rag"):
+            reusable, similar = await run_in_threadpool(app.state.rag.search, install, kind, text)
+    except Exception as e:
+        print(f"⚠️  Similar ticket search failed: {e}")
+        return None, ""
+    if reusable:
+        print(f"♻️  Reusing the result of a past {kind} ticket ({reusable.score:.3f} similar)")
+        return reusable, ""
+    return None, similar_tickets_context(kind, similar)
+
+
+def reused_output(model, output: str, similarity: float, start_time: datetime):
+    """A past ticket's stored result (JSON) as this request's output"""
+    return model.model_validate_json(output).model_copy(update={
+        "processingTime": (datetime.now() - start_time).total_seconds(),
+        "continuations": 0,
+        "tokenUsage": None,
+        "reusedSimilarity": round(similarity, 4),
+    })
+
+
+async def near_duplicate_output(kind: str, install: Optional[str], text: str, model, start_time: datetime):
+    """The cached result of a near-duplicate of this ticket the install sent before, or None"""
+    if not app.state.near_duplicates or not install:
+        return None
+    with span("near_duplicate"):
+        match = app.state.near_duplicates.find(f"{kind}:{install}", text)
+    if not match:
+        return None
+    key, similarity = match
+    with span("cache"):
+        cached = await asyncio.to_thread(app.state.result_cache.get, key)
+    if not cached:
+        return None  # Evicted or expired since
+    print(f"♻️  Serving the cached result of a near-duplicate {kind} ticket ({similarity:.2f} similar)")
+    return reused_output(model, cached, similarity, start_time)
+
+
+async def remember_ticket(kind: str, install: Optional[str], text: str, output: BaseModel):
+    """Store a finished result so similar tickets of the install can find it"""
+    if not app.state.rag or not install:
+        return
+    try:
+        await run_in_threadpool(app.state.rag.add, install, kind, text, output.model_dump_json())
+    except Exception as e:
+        print(f"⚠️  Storing the ticket for retrieval failed: {e}")
+
+
+async def generate_with_retrieval(kind: str, install: Optional[str], text: str, key: str, generate, model, cacheable=None):
+    """
+    Return a near-identical past ticket's result for the same install, or
+    generate one with the similar past tickets in the prompt. The cheap
+    check runs first: a near-duplicate (MinHash) of a ticket whose result
+    is in the result cache. Without similar tickets the prompt is the same
+    for everyone, so it goes through the shared result cache; with them
+    it's specific to the install and doesn't. Results that fail
+    `cacheable` are neither cached nor stored.
+    """
+    start_time = datetime.now()
+    duplicate = await near_duplicate_output(kind, install, text, model, start_time)
+    if duplicate:
+        return duplicate
+    
+    reusable, context = await find_similar(kind, install, text)
+    if reusable:
+        return reused_output(model, reusable.output, reusable.score, start_time)
+    
+    if context:
+        output = await generate(context)
+    else:
+        output = await cached_generation(key, lambda: generate(""), model, cacheable)
+    
+    if cacheable is None or cacheable(output):
+        await remember_ticket(kind, install, text, output)
+        if not context and app.state.near_duplicates and install:
+            app.state.near_duplicates.add(f"{kind}:{install}", text, key)
+    return output
+
+
+async def run_clarify_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Job handler for 'clarify' jobs"""
+    ticket = TicketInput(**payload)
+    license_key = ticket.accessKey or "free_user"
+    plan = await run_in_threadpool(lookup_plan, license_key)
+    await admit(ticket.install, license_key, plan, background=True)
+    event = begin_usage_event("jobs/clarify", ticket.install, license_key, plan)
+    try:
+        output = await generate_with_retrieval(
+            "clarify",
+            ticket.install,
+            clarification_text(ticket),
+            clarification_cache_key(ticket),
+            lambda context: generate_clarification(ticket, context),
+            ClarifiedOutput,
+            cacheable=is_complete
+        )
+    except Exception as e:
+        finish_usage_event(event, getattr(e, "status_code", 500))
+        await refund_reservation(ticket.accessKey if payload.get("usageReserved") else None)
+        raise
+    finish_usage_event(event, 200)
+    return output.model_dump()
+
+
+async def run_code_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Job handler for 'gen-code' jobs"""
+    input = CodeGenInput(**payload)
+    license_key = input.accessKey or "free_user"
+    plan = await run_in_threadpool(lookup_plan, license_key)
+    await admit(input.install, license_key, plan, background=True)
+    event = begin_usage_event("jobs/gen-code", input.install, license_key, plan)
+    try:
+        output = await generate_with_retrieval(
+            "gen-code",
+            input.install,
+            code_text(input),
+            code_cache_key(input),
+            lambda context: generate_code_for_mode(input, context),
+            CodeGenOutput
+        )
+    except Exception as e:
+        finish_usage_event(event, getattr(e, "status_code", 500))
+        await refund_reservation(input.accessKey if payload.get("usageReserved") else None)
+        raise
+    finish_usage_event(event, 200)
+    return output.model_dump()
+
+
+def refund_abandoned_job(payload: Dict[str, Any]):
+    """Refund the call reserved for a job whose worker kept dying before it finished (blocking)"""
+    if payload.get("usageReserved"):
+        refund_usage(payload["accessKey"])
 
-Ticket Title: {ticket.title}
-Description: {ticket.description or 'No description provided'}
-Issue Type: {ticket.issueType}
-Priority: {ticket.priority}
+# ============================================================================
+# Streaming (Server-Sent Events)
+# ============================================================================
 
-Please provide a structured response with:
-1. Acceptance Criteria (specific, testable conditions using Given-When-Then format where appropriate)
-2. Edge Cases to Consider (potential issues, boundary conditions)
-3. Success Metrics (measurable outcomes, KPIs)
-4. Test Scenarios (specific test cases for QA)
+SUMMARY_SCAN_CHARS = 8000  # The summary section sits at the top of the answer
 
-Format your response as valid JSON with these exact keys:
-{{
-  "acceptanceCriteria": ["criterion 1", "criterion 2", ...],
-  "edgeCases": ["edge case 1", "edge case 2", ...],
-  "successMetrics": ["metric 1", "metric 2", ...],
-  "testScenarios": ["scenario 1", "scenario 2", ...]
-}}
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-Focus on being practical and actionable. Provide at least 3-5 items for each category.
 
-{f"For more important context please take this into account: {ticket.customPrompt}" if ticket.customPrompt else ""}
-"""
+async def stream_completion(system: str, prompt: str, max_tokens: int, max_continuations: int, stats: Dict[str, Any]):
+    """
+    Yield Claude text deltas as they arrive, stitching max_tokens continuations
+    into one seamless stream. Continuations prefill only the tail of the
+    answer, so memory per request stays bounded instead of growing with it.
+    """
+    messages = with_cache_breakpoint([{"role": "user", "content": prompt}])
+    tail = ""  # Last part of the answer, for the next continuation's prefill
+    trimmed = ""
+    stats.update(continuations=0, maxTokens=max_tokens)
+    
+    while True:
+        chunk_chars = 0
+        async with llm_slot("stream"), app.state.claude.messages.stream(
+            model=CLAUDE_MODEL,
+            max_tokens=max_tokens,
+            system=cached_system(system),
+            messages=messages
+        ) as stream:
+            async for text in stream.text_stream:
+                if trimmed:
+                    # Skip whitespace the continuation repeats from the trimmed prefill
+                    seam_text = strip_seam(trimmed, text)
+                    trimmed = trimmed[len(text) - len(seam_text):] if not seam_text else ""
+                    text = seam_text
+                if not text:
+                    continue
+                chunk_chars += len(text)
+                tail = (tail + text)[-2 * CONTINUATION_CONTEXT_CHARS:]
+                yield text
+            message = await stream.get_final_message()
+        add_token_usage(stats, record_token_usage(message))
+        
+        print(f"📝 Stream chunk {stats['continuations'] + 1}: {chunk_chars} chars, stop_reason: {message.stop_reason}")
+        
+        if message.stop_reason != "max_tokens":
+            break
+        
+        if stats["continuations"] >= max_continuations:
+            print(f"⚠️ Reached max continuations ({max_continuations})")
+            break
+        
+        print("⏳ Response truncated, streaming continuation...")
+        stats["continuations"] += 1
+        messages, trimmed = continuation_messages(prompt, tail, CONTINUATION_CONTEXT_CHARS)
+    
+    LLM_CONTINUATIONS.observe(stats["continuations"], call="stream")
+    print(f"📊 Request used {stats['continuations']} continuation(s), tokens: {stats['tokenUsage']}")
+
 
+async def stream_code(input: CodeGenInput, reserved_key: Optional[str] = None, event: Optional[Dict[str, Any]] = None):
+    """
+    Yield SSE events for a code generation: `delta` events, then a final
+    `done` event. Streamed answers are never held in full, so unlike
+    /gen-code they aren't stored for retrieval; they do use it.
+    """
+    start_time = datetime.now()
+    head = ""  # Only the start of the answer is kept, for the summary
+    stats = {}
+    current_usage_event.set(event)  # Token counts from this generator's Claude calls
+    
     try:
-        messages = [{"role": "user", "content": prompt}]
-        full_response = ""
-        max_continuations = 3
-        continuation_count = 0
-        
-        while continuation_count < max_continuations:
-            message = app.state.claude.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=4000,
-                messages=messages
-            )
-            
-            response_text = message.content[0].text
-            full_response += response_text
-            
-            print(f"📝 Clarify chunk {continuation_count + 1}: {len(response_text)} chars, stop_reason: {message.stop_reason}")
-            
-            if message.stop_reason == "end_turn":
-                print("✅ Claude finished naturally")
-                break
-            
-            if message.stop_reason == "max_tokens":
-                print("⏳ Response truncated, requesting continuation...")
-                continuation_count += 1
-                messages.append({"role": "assistant", "content": response_text})
-                messages.append({"role": "user", "content": "Continue the JSON exactly where you left off. Do not restart or repeat content."})
-            else:
-                break
-        
-        content = full_response.strip()
-        
-        # Handle potential markdown code blocks
-        if '```json' in content:
-            content = content.split('```json')[1].split('```')[0].strip()
-        elif '```' in content:
-            content = content.split('```')[1].split('```')[0].strip()
-        
-        parsed = json.loads(content)
+        reusable, context = await find_similar("gen-code", input.install, code_text(input))
+        if reusable:
+            output = reused_output(CodeGenOutput, reusable.output, reusable.score, start_time)
+            yield sse_event("delta", {"text": output.implementation})
+            yield sse_event("done", {
+                "summary": output.summary,
+                "processingTime": output.processingTime,
+                "continuations": 0,
+                "tokenUsage": None,
+                "reusedSimilarity": output.reusedSimilarity
+            })
+            finish_usage_event(event, 200)
+            return
+        
+        prompt = context + build_code_prompt(input)
+        async for text in stream_completion(CODE_SYSTEM_PROMPT, prompt, code_max_tokens(prompt), 5, stats):
+            if len(head) < SUMMARY_SCAN_CHARS:
+                head += text
+            yield sse_event("delta", {"text": text})
         
         processing_time = (datetime.now() - start_time).total_seconds()
+        yield sse_event("done", {
+            "summary": extract_summary(head.strip()),
+            "processingTime": processing_time,
+            "continuations": stats.get("continuations", 0),
+            "tokenUsage": stats.get("tokenUsage")
+        })
+        finish_usage_event(event, 200)
+        
+    except Exception as e:
+        print(f"AI streaming error: {e}")
+        finish_usage_event(event, getattr(e, "status_code", 500))
+        await refund_reservation(reserved_key)
+        yield sse_event("error", {"error": f"AI processing failed: {str(e)}"})
+
+
+async def stream_clarification(ticket: TicketInput, reserved_key: Optional[str] = None, event: Optional[Dict[str, Any]] = None):
+    """Yield SSE events for a clarification: an `item` event per finished item, then `done` with the output"""
+    start_time = datetime.now()
+    stats = {}
+    current_usage_event.set(event)  # Token counts from this generator's Claude calls
+    
+    try:
+        text = clarification_text(ticket)
+        context = ""
+        output = await near_duplicate_output("clarify", ticket.install, text, ClarifiedOutput, start_time)
+        if not output:
+            reusable, context = await find_similar("clarify", ticket.install, text)
+            if reusable:
+                output = reused_output(ClarifiedOutput, reusable.output, reusable.score, start_time)
+        if output:
+            for section in CLARIFY_SECTIONS:
+                for item in getattr(output, section):
+                    yield sse_event("item", {"section": section, "text": item})
+            yield sse_event("done", output.model_dump())
+            finish_usage_event(event, 200)
+            return
+        
+        prompt = context + build_clarification_prompt(ticket)
+        async for section, item in clarification_items(ticket, prompt, stats):
+            yield sse_event("item", {"section": section, "text": item})
         
         output = ClarifiedOutput(
-            acceptanceCriteria=parsed.get('acceptanceCriteria', []),
-            edgeCases=parsed.get('edgeCases', []),
-            successMetrics=parsed.get('successMetrics', []),
-            testScenarios=parsed.get('testScenarios', []),
-            processingTime=processing_time
+            **stats["items"],
+            processingTime=(datetime.now() - start_time).total_seconds(),
+            continuations=stats["continuations"],
+            tokenUsage=stats.get("tokenUsage"),
+            status=stats["status"],
+            failedSections=stats["failedSections"]
         )
+        yield sse_event("done", output.model_dump())
+        finish_usage_event(event, 200)
+        if is_complete(output):
+            await remember_ticket("clarify", ticket.install, text, output)
         
-        return output
-        
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {e}")
-        print(f"Content: {content}")
-        raise HTTPException(status_code=500, detail="Failed to parse AI response")
     except Exception as e:
-        print(f"AI generation error: {e}")
-        raise HTTPException(status_code=500, detail=f"AI processing failed: {str(e)}")
+        print(f"AI streaming error: {e}")
+        finish_usage_event(event, getattr(e, "status_code", 500))
+        await refund_reservation(reserved_key)
+        yield sse_event("error", {"error": f"AI processing failed: {str(e)}"})
 
 
 # ============================================================================
@@ -735,51 +2363,66 @@ async def health_check():
             "claude": app.state.claude is not None,
             "redis": hasattr(app.state, 'redis') and app.state.redis is not None,
             "database": DATABASE_URL is not None,
-        }
+        },
+        "databasePool": app.state.db.stats() if app.state.db else None,
+        "resultCache": app.state.result_cache.stats() if app.state.result_cache else None,
+        "licenseCache": app.state.license_cache.stats() if app.state.license_cache else None,
+        "rateLimits": app.state.rate_limiter.stats() if app.state.rate_limiter else None,
+        "usageEvents": app.state.usage_events.stats() if app.state.usage_events else None,
+        "llmUsage": app.state.llm_usage.stats(),
+        "llmAdmission": app.state.admission.stats(),
+        "jobs": app.state.jobs.stats() if app.state.jobs else None,
+        "stripeEvents": app.state.stripe_events.stats() if app.state.stripe_events else None,
+        "email": app.state.mailer.stats() if app.state.mailer else None,
+        "rag": app.state.rag.stats() if app.state.rag else None,
+        "nearDuplicates": app.state.near_duplicates.stats() if app.state.near_duplicates else None,
+        "profiler": app.state.profiler.stats() if app.state.profiler else None,
     }
     return health
 
+@app.get("/metrics")
+def metrics(authorization: Optional[str] = Header(default=None)):
+    """Prometheus metrics (runs in the threadpool: the job queue depth is a query)"""
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=403, detail="Invalid metrics token")
+    return Response(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
 @app.post("/clarify", response_model=ClarifiedOutput)
 async def clarify_ticket(ticket: TicketInput):
     """
     Clarify ticket and increment usage counter
     """
     license_key = ticket.accessKey or "free_user"
+    plan = await run_in_threadpool(limit_ai_request, ticket.install, license_key)
+    await admit(ticket.install, license_key, plan)
     
-    # For paid users, check and increment usage
-    if license_key != "free_user":
-        conn = get_db_connection()
-        if conn:
-            try:
-                cur = conn.cursor()
-                
-                # Increment usage counter
-                cur.execute("""
-                    UPDATE license_keys
-                    SET gobot_used = gobot_used + 1,
-                        updated_at = NOW()
-                    WHERE key_code = %s
-                    AND is_active = true
-                    RETURNING gobot_used, gobot_limit
-                """, (license_key,))
-                
-                result = cur.fetchone()
-                conn.commit()
-                
-                if result:
-                    print(f"📊 Usage: {result['gobot_used']}/{result['gobot_limit']} for {license_key}")
-                
-            except Exception as e:
-                print(f"Error tracking usage: {e}")
-            finally:
-                conn.close()
+    # For paid users, reserve a call against the monthly limit (refunded on failure)
+    reserved_key = None
+    if license_key != "free_user" and await run_in_threadpool(reserve_usage, license_key):
+        reserved_key = license_key
     
     # Generate clarification (existing logic)
+    event = begin_usage_event("clarify", ticket.install, license_key, plan)
     try:
-        output = await generate_clarification(ticket)        
+        output = await generate_with_retrieval(
+            "clarify",
+            ticket.install,
+            clarification_text(ticket),
+            clarification_cache_key(ticket),
+            lambda context: generate_clarification(ticket, context),
+            ClarifiedOutput,
+            cacheable=is_complete
+        )
+        finish_usage_event(event, 200)
         return output
         
+    except HTTPException as e:
+        finish_usage_event(event, e.status_code)
+        await refund_reservation(reserved_key)
+        raise
     except Exception as e:
+        finish_usage_event(event, 500)
+        await refund_reservation(reserved_key)
         print(f"Clarification error: {e}")
         raise HTTPException(status_code=500, detail="Failed to clarify ticket")
 
@@ -802,91 +2445,186 @@ async def generate_code_endpoint(input: CodeGenInput):
     license_key = input.accessKey or "free_user"
     print("LICENCE KEY: ")
     print(license_key)
+    plan = await run_in_threadpool(limit_ai_request, input.install, license_key)
+    await admit(input.install, license_key, plan)
 
-    # For paid users, check and increment usage
-    if license_key != "free_user":
-        conn = get_db_connection()
-        if conn:
-            try:
-                cur = conn.cursor()
-                
-                # Check usage limit before generating
-                cur.execute("""
-                    SELECT gobot_used, gobot_limit, plan
-                    FROM license_keys
-                    WHERE key_code = %s
-                    AND is_active = true
-                """, (license_key,))
-                
-                result = cur.fetchone()
-                
-                if result:
-                    if result['gobot_used'] >= result['gobot_limit']:
-                        raise HTTPException(
-                            status_code=429,
-                            detail=f"Monthly limit of {result['gobot_limit']} reached. Please upgrade or wait for reset."
-                        )
-                    
-                    # Increment usage counter
-                    cur.execute("""
-                        UPDATE license_keys
-                        SET gobot_used = gobot_used + 1,
-                            updated_at = NOW()
-                        WHERE key_code = %s
-                        AND is_active = true
-                        RETURNING gobot_used, gobot_limit
-                    """, (license_key,))
-                    
-                    updated = cur.fetchone()
-                    conn.commit()
-                    
-                    if updated:
-                        print(f"📊 Code Gen Usage: {updated['gobot_used']}/{updated['gobot_limit']} for {license_key}")
-                
-            except HTTPException:
-                raise
-            except Exception as e:
-                print(f"Error tracking usage: {e}")
-            finally:
-                conn.close()
+    # For paid users, reserve a call against the monthly limit (refunded on failure)
+    reserved_key = None
+    if license_key != "free_user" and await run_in_threadpool(reserve_usage, license_key):
+        reserved_key = license_key
     
     # Generate code
+    event = begin_usage_event("gen-code", input.install, license_key, plan)
     try:
-        output = await generate_code(input)
+        output = await generate_with_retrieval(
+            "gen-code",
+            input.install,
+            code_text(input),
+            code_cache_key(input),
+            lambda context: generate_code_for_mode(input, context),
+            CodeGenOutput
+        )
+        finish_usage_event(event, 200)
         return output
         
-    except HTTPException:
+    except HTTPException as e:
+        finish_usage_event(event, e.status_code)
+        await refund_reservation(reserved_key)
         raise
     except Exception as e:
+        finish_usage_event(event, 500)
+        await refund_reservation(reserved_key)
         print(f"Code generation error: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate code")
 
 
-@app.post("/webhook/stripe")
-async def stripe_webhook_handler(request: Request):
-    """Handle Stripe webhook events"""
-    if not ENABLE_PAYMENTS or not STRIPE_WEBHOOK_SECRET:
-        raise HTTPException(status_code=404, detail="Payments not enabled")
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/clarify/stream")
+async def clarify_ticket_stream(ticket: TicketInput):
+    """
+    Streaming variant of /clarify (Server-Sent Events).
     
-    payload = await request.body()
-    sig_header = request.headers.get('stripe-signature')
+    Emits an `item` event ({section, text}) for each clarification item as
+    soon as it is parsed, then a final `done` event carrying the
+    ClarifiedOutput (or an `error` event). A reused result is sent the same
+    way, all at once.
+    """
+    if not app.state.claude:
+        raise HTTPException(status_code=500, detail="AI service not configured")
     
-    if not sig_header:
-        raise HTTPException(status_code=400, detail="Missing signature header")
+    license_key = ticket.accessKey or "free_user"
+    plan = await run_in_threadpool(limit_ai_request, ticket.install, license_key)
+    await admit(ticket.install, license_key, plan)
+    reserved_key = None
+    if license_key != "free_user" and await run_in_threadpool(reserve_usage, license_key):
+        reserved_key = license_key
+    
+    event = begin_usage_event("clarify/stream", ticket.install, license_key, plan)
+    return StreamingResponse(stream_clarification(ticket, reserved_key, event), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/gen-code/stream")
+async def generate_code_stream_endpoint(input: CodeGenInput):
+    """
+    Streaming variant of /gen-code (Server-Sent Events).
+    
+    Emits `delta` events with the markdown implementation as it is generated
+    (continuations are stitched in seamlessly) and a final `done` event with
+    `summary` and `processingTime` (or an `error` event).
+    """
+    if not app.state.claude:
+        raise HTTPException(status_code=500, detail="AI service not configured")
+    
+    if input.mode == "parallel":
+        raise HTTPException(status_code=400, detail="Parallel mode is not streamed; use /gen-code or /jobs")
+    
+    license_key = input.accessKey or "free_user"
+    plan = await run_in_threadpool(limit_ai_request, input.install, license_key)
+    await admit(input.install, license_key, plan)
+    reserved_key = None
+    if license_key != "free_user" and await run_in_threadpool(reserve_usage, license_key):
+        reserved_key = license_key
+    
+    event = begin_usage_event("gen-code/stream", input.install, license_key, plan)
+    return StreamingResponse(stream_code(input, reserved_key, event), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/jobs", response_model=JobSubmitted, status_code=202)
+async def submit_job(job: JobInput):
+    """
+    Queue a clarification or code generation and return its job id immediately.
+    
+    Usage is reserved at submit time (and refunded if the job fails); poll
+    GET /jobs/{job_id} for the result.
+    """
+    if not app.state.jobs:
+        raise HTTPException(status_code=503, detail="Job queue unavailable")
     
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, STRIPE_WEBHOOK_SECRET
-        )
-    except Exception as e:
-        print(f"❌ Webhook signature verification failed: {e}")
-        raise HTTPException(status_code=400, detail=str(e))
+        if job.type == "clarify":
+            ticket = TicketInput(**job.data)
+            license_key, install = ticket.accessKey or "free_user", ticket.install
+            payload = ticket.model_dump()
+        elif job.type == "gen-code":
+            input = CodeGenInput(**job.data)
+            license_key, install = input.accessKey or "free_user", input.install
+            payload = input.model_dump()
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown job type: {job.type}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid job data: {e.errors()[0]['msg']}")
+    
+    await run_in_threadpool(limit_ai_request, install, license_key)
+    
+    if license_key != "free_user":
+        payload["usageReserved"] = await run_in_threadpool(reserve_usage, license_key)
+    
+    try:
+        job_id = await run_in_threadpool(app.state.jobs.submit, job.type, payload, install)
+    except Exception:
+        await refund_reservation(license_key if payload.get("usageReserved") else None)
+        raise
+    app.state.jobs.notify()
+    print(f"📥 Queued job {job_id} ({job.type})")
+    
+    return JobSubmitted(jobId=job_id)
+
+
+@app.get("/jobs/metrics")
+async def job_metrics():
+    """Queue depth, wait time and worker metrics"""
+    if not app.state.jobs:
+        raise HTTPException(status_code=503, detail="Job queue unavailable")
+    
+    return {
+        **await run_in_threadpool(app.state.jobs.queue_depth),
+        **app.state.jobs.stats()
+    }
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """Get the status and (once finished) the result of a job"""
+    if not app.state.jobs:
+        raise HTTPException(status_code=503, detail="Job queue unavailable")
+    
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
     
-    print(f"🔔 Received event: {event['type']}")
+    job = app.state.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
     
+    return {
+        "jobId": str(job['id']),
+        "type": job['job_type'],
+        "status": job['status'],
+        "result": job['result'],
+        "error": job['error'],
+        "attempts": job['attempts'],
+        "createdAt": job['created_at'].isoformat() if job['created_at'] else None,
+        "startedAt": job['started_at'].isoformat() if job['started_at'] else None,
+        "finishedAt": job['finished_at'].isoformat() if job['finished_at'] else None
+    }
+
+
+def stripe_sdk():
+    """The Stripe SDK, imported and configured on first use"""
+    import stripe
+    if not stripe.api_key:
+        stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+
+def process_stripe_event(event) -> Dict[str, Any]:
+    """Apply a stored Stripe event to license_keys (run by the outbox workers; raises to retry)"""
+    stripe = stripe_sdk()
     conn = get_db_connection()
     if not conn:
-        return {"status": "error", "message": "Database unavailable"}
+        raise RuntimeError("Database unavailable")
     
     try:
         cur = conn.cursor()
@@ -917,20 +2655,24 @@ async def stripe_webhook_handler(request: Request):
             print(f"   Payment Method: {payment_method_id}")
             
             # Check if we already created a subscription for this payment
-            cur.execute("""
-                SELECT key_code FROM license_keys 
-                WHERE stripe_payment_intent_id = %s
-            """, (payment_intent_id,))
+            with timed_query("license by payment intent"):
+                cur.execute(LICENSE_BY_PAYMENT_INTENT_SQL, (payment_intent_id,))
             
             existing = cur.fetchone()
             if existing:
+                if existing['key_email_sent_at'] is None:
+                    # A crash, deploy or failed delivery came between the key and its email
+                    send_purchased_key_email(conn, existing['customer_email'], existing['key_code'], existing['plan'], existing['gobot_limit'])
                 print(f"ℹ️  Already processed: {existing['key_code']}")
                 return {"status": "success", "keyCode": existing['key_code']}
             
-            # Attach payment method to customer as default
+            # The outbox retries this event if anything below fails, so every
+            # Stripe write is keyed to the payment: a retry gets the original
+            # response back instead of a second subscription (and charge)
             stripe.Customer.modify(
                 customer_id,
-                invoice_settings={'default_payment_method': payment_method_id}
+                invoice_settings={'default_payment_method': payment_method_id},
+                idempotency_key=f"pm-default-{payment_intent_id}",
             )
             
             print(f"✅ Attached payment method to customer")
@@ -946,9 +2688,12 @@ async def stripe_webhook_handler(request: Request):
                 print(f"❌ No price ID for plan: {plan_id}")
                 raise Exception(f"No price ID for plan: {plan_id}")
             
-            # Calculate trial end (30 days from now)
-            # This is their "paid" first month - subscription billing starts after
-            trial_end = int(time.time()) + (30 * 24 * 60 * 60)  # 30 days
+            # Calculate trial end (30 days from the payment)
+            # This is their "paid" first month - subscription billing starts after.
+            # Anchored to the payment, not now, so a retry sends the same parameters
+            # with its idempotency key
+            paid_at = payment_intent.get('created') or event.get('created') or int(time.time())
+            trial_end = int(paid_at) + (30 * 24 * 60 * 60)  # 30 days
             
             # Create subscription with trial (first month already paid via PaymentIntent)
             subscription = stripe.Subscription.create(
@@ -957,6 +2702,7 @@ async def stripe_webhook_handler(request: Request):
                 default_payment_method=payment_method_id,
                 metadata={'planId': plan_id},
                 trial_end=trial_end,  # First charge happens in 30 days
+                idempotency_key=f"sub-create-{payment_intent_id}",
             )
             
             print(f"✅ Created subscription: {subscription.id}")
@@ -989,11 +2735,11 @@ async def stripe_webhook_handler(request: Request):
             ))
             
             conn.commit()
+            invalidate_license_cache([license_key])
             print(f"🔑 License key generated: {license_key}")
             
-            # Send email
-            send_license_key_email(customer_email, license_key, plan_id.capitalize(), gobot_limit)
-            print(f"📧 Email sent to {customer_email}")
+            # Send email (the event stays unprocessed until Mailgun accepts it)
+            send_purchased_key_email(conn, customer_email, license_key, plan_id, gobot_limit)
             
             return {"status": "success", "keyCode": license_key}
         
@@ -1012,16 +2758,12 @@ async def stripe_webhook_handler(request: Request):
             if billing_reason in ['subscription_cycle', 'subscription_update']:
                 print(f"🔄 Renewal for subscription: {subscription_id}")
                 
-                cur.execute("""
-                    UPDATE license_keys
-                    SET gobot_used = 0,
-                        usage_resets_at = NOW() + INTERVAL '1 month',
-                        subscription_status = 'active',
-                        updated_at = NOW()
-                    WHERE stripe_subscription_id = %s
-                """, (subscription_id,))
+                cur.execute(RENEW_SUBSCRIPTION_SQL, (subscription_id,))
+                key_codes = [row['key_code'] for row in cur.fetchall()]
                 
                 conn.commit()
+                invalidate_usage_counters(key_codes, discard_pending=True)
+                invalidate_license_cache(key_codes)
                 print(f"✅ Usage reset")
         
         # ============================================
@@ -1031,15 +2773,13 @@ async def stripe_webhook_handler(request: Request):
             subscription = event['data']['object']
             subscription_id = subscription.get('id')
             
-            cur.execute("""
-                UPDATE license_keys
-                SET is_active = false,
-                    subscription_status = 'canceled',
-                    updated_at = NOW()
-                WHERE stripe_subscription_id = %s
-            """, (subscription_id,))
+            cur.execute(CANCEL_SUBSCRIPTION_SQL, (subscription_id,))
+            rows = cur.fetchall()
+            key_codes = [row['key_code'] for row in rows]
             
             conn.commit()
+            invalidate_usage_counters(key_codes)
+            invalidate_license_cache(key_codes, [row['install'] for row in rows])
             print(f"🔒 Subscription canceled: {subscription_id}")
         
         # ============================================
@@ -1050,15 +2790,13 @@ async def stripe_webhook_handler(request: Request):
             subscription_id = subscription.get('id')
             status = subscription.get('status')
             
-            cur.execute("""
-                UPDATE license_keys
-                SET subscription_status = %s,
-                    is_active = %s IN ('active', 'trialing'),
-                    updated_at = NOW()
-                WHERE stripe_subscription_id = %s
-            """, (status, status, subscription_id))
+            cur.execute(SUBSCRIPTION_STATUS_SQL, (status, status, subscription_id))
+            rows = cur.fetchall()
+            key_codes = [row['key_code'] for row in rows]
             
             conn.commit()
+            invalidate_usage_counters(key_codes)
+            invalidate_license_cache(key_codes, [row['install'] for row in rows])
             print(f"📝 Subscription status: {status}")
         
         else:
@@ -1071,14 +2809,57 @@ async def stripe_webhook_handler(request: Request):
         print(f"❌ Webhook error: {e}")
         import traceback
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
+        raise
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
+@app.post("/webhook/stripe")
+async def stripe_webhook_handler(request: Request):
+    """Handle Stripe webhook events"""
+    if not ENABLE_PAYMENTS or not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Payments not enabled")
+    
+    payload = await request.body()
+    sig_header = request.headers.get('stripe-signature')
+    
+    if not sig_header:
+        raise HTTPException(status_code=400, detail="Missing signature header")
+    
+    stripe = stripe_sdk()
+    try:
+        stripe.Webhook.construct_event(
+            payload, sig_header, STRIPE_WEBHOOK_SECRET
+        )
+    except Exception as e:
+        print(f"❌ Webhook signature verification failed: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Store the event (as the plain JSON Stripe signed) and acknowledge; the
+    # outbox workers apply it, so a burst of webhooks costs one INSERT each
+    # on the request path
+    outbox = app.state.stripe_events
+    if not outbox:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    
+    event = json.loads(payload)
+    try:
+        stored = await run_in_threadpool(outbox.record, event)
+    except Exception as e:
+        print(f"❌ Could not store webhook event {event['id']}: {e}")
+        raise HTTPException(status_code=503, detail="Could not store event")
+    
+    if stored:
+        outbox.notify()
+        print(f"🔔 Received event: {event['type']} ({event['id']})")
+    else:
+        print(f"ℹ️  Duplicate event ignored: {event['id']}")
+    
+    return {"status": "success", "duplicate": not stored}
+
 
 @app.post("/create-free-key")
-async def create_free_key(input: CreateFreeKeyInput):
+def create_free_key(request: Request, input: CreateFreeKeyInput):
     """
     Create a free license key for a new user
     """
@@ -1087,6 +2868,11 @@ async def create_free_key(input: CreateFreeKeyInput):
     if not email or '@' not in email:
         raise HTTPException(status_code=400, detail="Valid email required")
     
+    check_rate_limit("free-key", [
+        (f"ip:{client_ip(request)}", FREE_KEY_RATE_PER_IP, 3600),
+        (f"email:{email}", FREE_KEY_RATE_PER_EMAIL, 3600),
+    ])
+    
     conn = get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database unavailable")
@@ -1094,63 +2880,44 @@ async def create_free_key(input: CreateFreeKeyInput):
     try:
         cur = conn.cursor()
         
-        # Check if email already has a free key
-        cur.execute("""
-            SELECT key_code, is_active, plan
-            FROM license_keys
-            WHERE customer_email = %s AND plan = 'free'
-        """, (email,))
-        
-        existing = cur.fetchone()
-        
-        if existing:
-            if existing['is_active']:
-                # Return existing key
-                return {
-                    "keyCode": existing['key_code'],
-                    "email": email,
-                    "plan": "free",
-                    "isExisting": True,
-                    "message": "You already have a free license key. Check your email or use the key below."
-                }
-            else:
-                # Reactivate existing key
-                cur.execute("""
-                    UPDATE license_keys
-                    SET is_active = true,
-                        gobot_used = 0,
-                        usage_resets_at = NOW() + INTERVAL '1 month',
-                        updated_at = NOW()
-                    WHERE key_code = %s
-                    RETURNING key_code
-                """, (existing['key_code'],))
-                conn.commit()
-                
-                # Send email with existing key
-                send_license_key_email(email, existing['key_code'], "Free", 5)
-                
-                return {
-                    "keyCode": existing['key_code'],
-                    "email": email,
-                    "plan": "free",
-                    "isExisting": True,
-                    "message": "Your free license key has been reactivated."
-                }
-        
-        # Generate new license key
-        license_key = generate_license_key()
+        # One statement creates the key, reactivates an inactive one or
+        # returns the active one (uq_license_free_email allows one free key
+        # per email). The no-op update on an active key is what makes
+        # RETURNING give its row back. xmax = 0 means the row was inserted;
+        # updated_at = NOW() (this transaction's start) means it was reactivated.
         gobot_limit = get_plan_limits('free')
+        with timed_query("free key upsert"):
+            cur.execute(FREE_KEY_UPSERT_SQL, (generate_license_key(), email, gobot_limit))
+        key = cur.fetchone()
+        conn.commit()
         
-        # Insert new license key
-        cur.execute("""
-            INSERT INTO license_keys 
-            (key_code, customer_email, plan, gobot_limit, gobot_used, 
-             usage_resets_at, subscription_status, is_active)
-            VALUES (%s, %s, 'free', %s, 0, NOW() + INTERVAL '1 month', 'active', true)
-            RETURNING id
-        """, (license_key, email, gobot_limit))
+        if not key['inserted'] and not key['reactivated']:
+            # Return existing key
+            return {
+                "keyCode": key['key_code'],
+                "email": email,
+                "plan": "free",
+                "isExisting": True,
+                "message": "You already have a free license key. Check your email or use the key below."
+            }
         
-        conn.commit()
+        if key['reactivated']:
+            invalidate_usage_counters([key['key_code']], discard_pending=True)
+            invalidate_license_cache([key['key_code']], [key['install']])
+            
+            # Send email with existing key
+            send_license_key_email(email, key['key_code'], "Free", key['gobot_limit'])
+            
+            return {
+                "keyCode": key['key_code'],
+                "email": email,
+                "plan": "free",
+                "isExisting": True,
+                "message": "Your free license key has been reactivated."
+            }
+        
+        license_key = key['key_code']
+        invalidate_license_cache([license_key])
         
         print(f"🆓 Free license key created: {license_key} for {email}")
         
@@ -1172,11 +2939,11 @@ async def create_free_key(input: CreateFreeKeyInput):
         print(f"Error creating free key: {e}")
         raise HTTPException(status_code=500, detail="Failed to create license key")
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 @app.get("/license-key/payment-intent/{payment_intent_id}")
-async def get_license_key_by_payment_intent(payment_intent_id: str):
+def get_license_key_by_payment_intent(payment_intent_id: str):
     """
     Get license key by Stripe payment intent ID
     Used by success page after embedded checkout
@@ -1188,18 +2955,7 @@ async def get_license_key_by_payment_intent(payment_intent_id: str):
     try:
         cur = conn.cursor()
         
-        cur.execute("""
-            SELECT 
-                key_code,
-                customer_email,
-                plan,
-                gobot_limit,
-                gobot_used,
-                created_at,
-                usage_resets_at
-            FROM license_keys
-            WHERE stripe_payment_intent_id = %s
-        """, (payment_intent_id,))
+        cur.execute(LICENSE_BY_PAYMENT_INTENT_SQL, (payment_intent_id,))
         
         result = cur.fetchone()
         
@@ -1221,45 +2977,31 @@ async def get_license_key_by_payment_intent(payment_intent_id: str):
     except Exception as e:
         print("Error getting licence key.")
     finally:
-        conn.close()
+        release_db_connection(conn)
   
  
 @app.post("/validate-key", response_model=AccessKeyResponse)
-async def validate_license_key(request: Request, key_input: AccessKeyInput):
+def validate_license_key(request: Request, key_input: AccessKeyInput):
     """
     Validate a license key and check usage limits
     """
     key_code = key_input.accessKey.strip().upper()
     install = key_input.install
     
-    conn = get_db_connection()
-    if not conn:
+    check_rate_limit("validate", [
+        (f"key:{key_code}", VALIDATE_RATE, 60),
+        (f"install:{install}", VALIDATE_RATE, 60),
+    ])
+    
+    if not app.state.db:
         return AccessKeyResponse(
             valid=False,
             message="Service temporarily unavailable"
         )
     
     try:
-        cur = conn.cursor()
-        
-        # Get the key being validated
-        cur.execute("""
-            SELECT 
-                key_code,
-                customer_email,
-                plan,
-                is_active,
-                subscription_status,
-                gobot_limit,
-                gobot_used,
-                usage_resets_at,
-                activated_at,
-                install
-            FROM license_keys
-            WHERE key_code = %s
-        """, (key_code,))
-        
-        key_data = cur.fetchone()
+        # Get the key being validated (from the license cache on repeat panel loads)
+        key_data = get_license_row(key_code)
         
         if not key_data:
             return AccessKeyResponse(
@@ -1267,6 +3009,8 @@ async def validate_license_key(request: Request, key_input: AccessKeyInput):
                 message="Invalid license key. Please check and try again."
             )
         
+        key_data['gobot_used'] = live_usage(key_data)
+        
         # Check if active
         if not key_data['is_active'] and key_data['activated_at']:
             return AccessKeyResponse(
@@ -1304,34 +3048,9 @@ async def validate_license_key(request: Request, key_input: AccessKeyInput):
                 gobotsRemaining=remaining
             )
         
-        # Deactivate any OLD keys for this install (user is switching to new key)
-        cur.execute("""
-            UPDATE license_keys
-            SET is_active = false,
-                updated_at = NOW(),
-                activated_at = NULL
-            WHERE install = %s 
-            AND key_code != %s
-            AND activated_at IS NOT NULL
-        """, (install, key_code))
-        
-        deactivated_count = cur.rowcount
-        if deactivated_count > 0:
-            print(f"🔒 Deactivated {deactivated_count} old key(s) for install {install}")
-        
-        # Mark as activated if first use
-        if not key_data['activated_at']:
-            cur.execute("""
-                UPDATE license_keys 
-                SET activated_at = NOW(), 
-                    updated_at = NOW(), 
-                    is_active=true,
-                    install = %s
-                WHERE key_code = %s
-            """, (install, key_code))
-            print(f"🎉 License key activated: {key_code} for {install}")
-        
-        conn.commit()
+        # Activation only writes when the key isn't already activated on this install
+        if not (key_data['activated_at'] and key_data['install'] == install):
+            activate_license_key(key_code, install, first_use=not key_data['activated_at'])
         
         # Calculate remaining
         remaining = key_data['gobot_limit'] - key_data['gobot_used']
@@ -1348,94 +3067,127 @@ async def validate_license_key(request: Request, key_input: AccessKeyInput):
         
     except Exception as e:
         print(f"Error validating key: {e}")
-        conn.rollback()
         return AccessKeyResponse(
             valid=False,
             message="Error validating key. Please try again."
         )
-    finally:
-        conn.close()
 
 
 @app.get("/usage/{key_code}")
-async def get_key_usage(key_code: str):
+def get_key_usage(key_code: str):
     """
     Get usage statistics for a license key
     """
+    if not app.state.db:
+        raise HTTPException(status_code=500, detail="Database unavailable")
+    
+    key = get_license_row(key_code)
+    
+    if not key:
+        raise HTTPException(status_code=404, detail="License key not found")
+    
+    key['gobot_used'] = live_usage(key)
+    
+    return {
+        "keyCode": key_code,
+        "plan": key['plan'],
+        "email": key['customer_email'],
+        "gobotUsed": key['gobot_used'],
+        "gobotLimit": key['gobot_limit'],
+        "gobotsRemaining": max(0, key['gobot_limit'] - key['gobot_used']),
+        "usageResetsAt": key['usage_resets_at'].isoformat() if key['usage_resets_at'] else None,
+        "subscriptionStatus": key['subscription_status'],
+        "isActive": key['is_active'],
+        "activatedAt": key['activated_at'].isoformat() if key['activated_at'] else None
+    }
+
+
+# groupBy values of /analytics/usage -> usage_rollups expression
+ANALYTICS_GROUPS = {
+    "endpoint": "endpoint",
+    "plan": "plan",
+    "install": "install",
+    "key": "key_code",
+    "hour": "hour",
+    "day": "date_trunc('day', hour)",
+}
+
+@app.get("/analytics/usage")
+def get_usage_analytics(
+    groupBy: Literal["endpoint", "plan", "install", "key", "hour", "day"] = "endpoint",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    keyCode: Optional[str] = None,
+    install: Optional[str] = None,
+    plan: Optional[str] = None,
+    endpoint: Optional[str] = None,
+    x_admin_token: Optional[str] = Header(default=None),
+):
+    """
+    Usage totals for capacity planning, read from the hourly rollups only
+    (they trail live traffic by ANALYTICS_ROLLUP_LAG plus one rollup interval).
+    Requires X-Admin-Token to match ANALYTICS_API_TOKEN.
+    """
+    if not ENABLE_ANALYTICS or not ANALYTICS_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Analytics not enabled")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ANALYTICS_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    
+    until = until or datetime.now()
+    since = since or until - timedelta(days=7)
+    
+    filters = []
+    params = [since, until]
+    for column, value in (("key_code", keyCode), ("install", install), ("plan", plan), ("endpoint", endpoint)):
+        if value is not None:
+            filters.append(column)
+            params.append(value)
+    
+    group = ANALYTICS_GROUPS[groupBy]
+    order = "1" if groupBy in ("hour", "day") else "requests DESC"
+    
     conn = get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database unavailable")
     
     try:
         cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT 
-                key_code,
-                plan,
-                customer_email,
-                gobot_limit,
-                gobot_used,
-                usage_resets_at,
-                subscription_status,
-                is_active,
-                activated_at
-            FROM license_keys
-            WHERE key_code = %s
-        """, (key_code,))
-        
-        key = cur.fetchone()
-        
-        if not key:
-            raise HTTPException(status_code=404, detail="License key not found")
-        
-        return {
-            "keyCode": key_code,
-            "plan": key['plan'],
-            "email": key['customer_email'],
-            "gobotUsed": key['gobot_used'],
-            "gobotLimit": key['gobot_limit'],
-            "gobotsRemaining": max(0, key['gobot_limit'] - key['gobot_used']),
-            "usageResetsAt": key['usage_resets_at'].isoformat() if key['usage_resets_at'] else None,
-            "subscriptionStatus": key['subscription_status'],
-            "isActive": key['is_active'],
-            "activatedAt": key['activated_at'].isoformat() if key['activated_at'] else None
-        }
-        
+        cur.execute(usage_report_sql(group, filters, order), params)
+        rows = cur.fetchall()
     finally:
-        conn.close()
+        release_db_connection(conn)
+    
+    return {
+        "groupBy": groupBy,
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "rows": [
+            {
+                "group": row['group_value'],
+                "requests": int(row['requests']),
+                "errors": int(row['errors']),
+                "avgLatencyMs": round(row['latency_ms_total'] / row['requests'], 1) if row['requests'] else 0.0,
+                "maxLatencyMs": row['latency_ms_max'],
+                "inputTokens": int(row['input_tokens']),
+                "outputTokens": int(row['output_tokens']),
+                "cacheReadTokens": int(row['cache_read_tokens']),
+                "cacheCreationTokens": int(row['cache_creation_tokens']),
+            }
+            for row in rows
+        ],
+    }
 
 
 @app.post("/find-key-by-install")
-async def get_key_by_install(install: InstallData):
+def get_key_by_install(install: InstallData):
     """
     Get active license key by install ID
     """
-    conn = get_db_connection()
-    if not conn:
+    if not app.state.db:
         raise HTTPException(status_code=500, detail="Database unavailable")
     
     try:
-        cur = conn.cursor()
-        
-        cur.execute("""
-            SELECT 
-                key_code, 
-                plan, 
-                created_at, 
-                expires_at, 
-                is_active, 
-                gobot_limit, 
-                gobot_used, 
-                usage_resets_at
-            FROM license_keys
-            WHERE install = %s 
-            AND is_active = true
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (install.install,))
-        
-        result = cur.fetchone()
+        result = get_license_row_by_install(install.install)
         
         if not result:
             return {
@@ -1443,6 +3195,8 @@ async def get_key_by_install(install: InstallData):
                 "message": "No active license key found for this install."
             }
         
+        result['gobot_used'] = live_usage(result)
+        
         return {
             "keyCode": result['key_code'],
             "plan": result['plan'],
@@ -1457,8 +3211,6 @@ async def get_key_by_install(install: InstallData):
     except Exception as e:
         print(f"Error finding key by install: {e}")
         raise HTTPException(status_code=500, detail="Failed to find license key")
-    finally:
-        conn.close()
 
 
 
@@ -1468,9 +3220,10 @@ async def create_payment_intent(input: CreatePaymentIntentInput):
     Create a PaymentIntent for subscription payment using Elements
     Subscription is created after payment succeeds (in webhook)
     """
-    if not ENABLE_PAYMENTS or not stripe.api_key:
+    if not ENABLE_PAYMENTS or not STRIPE_SECRET_KEY:
         raise HTTPException(status_code=503, detail="Payments not available")
     
+    stripe = stripe_sdk()
     try:
         plan_id = input.planId.lower()
         
@@ -1538,7 +3291,8 @@ async def create_payment_intent(input: CreatePaymentIntentInput):
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"error": exc.detail}
+        content={"error": exc.detail},
+        headers=exc.headers
     )
 
 @app.exception_handler(Exception)
@@ -0,0 +1,170 @@
+# cache.py - Content-hash result cache for Claude generations
+import time
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Type
+
+from pydantic import BaseModel
+
+from go_bot_backend.timing import span
+
+
+def content_hash_key(namespace: str, version: str, fields: Dict[str, Any]) -> str:
+    """Build a cache key from a normalized hash of the request fields"""
+    # Collapse whitespace so cosmetic edits to a ticket still hit the cache
+    normalized = {name: " ".join(str(value or "").split()) for name, value in sorted(fields.items())}
+    digest = hashlib.sha256(json.dumps([version, normalized]).encode()).hexdigest()
+    return f"gobot:result:{namespace}:{digest}"
+
+
+class LocalLRU:
+    """Small thread-safe in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultCache:
+    """
+    Generation result cache backed by Redis, falling back to an in-process
+    LRU when Redis is not configured or unreachable.
+
+    Concurrent identical requests are coalesced (single-flight): the first
+    one runs the generation, the rest await the same task.
+    """
+
+    INDEX_KEY = "gobot:result:index"  # sorted set of cached keys by insert time, for the size cap
+
+    def __init__(self, redis_client=None, ttl: int = 86400, max_entries: int = 10000, local_max_entries: int = 1000):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = LocalLRU(local_max_entries)
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Look up a cached JSON result (blocking - call from a thread)"""
+        if self.redis:
+            try:
+                return self.redis.get(key)
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️  Result cache read failed, using local cache: {e}")
+        return self.local.get(key)
+
+    def set(self, key: str, value: str):
+        """Store a JSON result and enforce the size cap (blocking - call from a thread)"""
+        if self.redis:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.set(key, value, ex=self.ttl)
+                pipe.zadd(self.INDEX_KEY, {key: time.time()})
+                pipe.zremrangebyscore(self.INDEX_KEY, "-inf", time.time() - self.ttl)
+                pipe.zcard(self.INDEX_KEY)
+                size = pipe.execute()[-1]
+                if size > self.max_entries:
+                    evicted = [member for member, _ in self.redis.zpopmin(self.INDEX_KEY, size - self.max_entries)]
+                    if evicted:
+                        self.redis.delete(*evicted)
+                return
+            except Exception as e:
+                self.errors += 1
+                print(f"⚠️  Result cache write failed, using local cache: {e}")
+        self.local.set(key, value, self.ttl)
+
+    async def _compute_and_store(self, key: str, compute: Callable[[], Awaitable[BaseModel]], cacheable: Optional[Callable[[BaseModel], bool]]) -> BaseModel:
+        result = await compute()
+        if cacheable is None or cacheable(result):
+            with span("cache"):
+                await asyncio.to_thread(self.set, key, result.model_dump_json())
+        return result
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[BaseModel]],
+        model: Type[BaseModel],
+        cacheable: Optional[Callable[[BaseModel], bool]] = None,
+    ) -> BaseModel:
+        """
+        Return the cached result for key, or run compute once for all
+        concurrent callers. Results that fail `cacheable` are returned but
+        not stored.
+        """
+        task = self._inflight.get(key)
+
+        if task is None:
+            with span("cache"):
+                cached = await asyncio.to_thread(self.get, key)
+            if cached is not None:
+                self.hits += 1
+                return model.model_validate_json(cached)
+            # Another request may have started the same generation while we looked
+            task = self._inflight.get(key)
+
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.create_task(self._compute_and_store(key, compute, cacheable))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._finish(key, t))
+        # Shielded so a disconnecting client doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved even if every waiter went away
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters (exposed on /health)"""
+        lookups = self.hits + self.misses
+        return {
+            "backend": "redis" if self.redis else "memory",
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "inflight": len(self._inflight),
+            "localEntries": len(self.local),
+        }
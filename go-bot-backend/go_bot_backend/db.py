@@ -0,0 +1,233 @@
+# db.py - Pooled PostgreSQL access for Go Bot
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+from go_bot_backend.metrics import DB_BUCKETS, REGISTRY
+from go_bot_backend.timing import record_span
+
+
+POOL_WAIT_SECONDS = REGISTRY.histogram(
+    "gobot_db_pool_wait_seconds", "Time spent waiting to check out a database connection", buckets=DB_BUCKETS,
+)
+# Hot queries, timed by name: `with timed_query("license by key"): cur.execute(...)`
+QUERY_SECONDS = REGISTRY.histogram(
+    "gobot_db_query_seconds", "Database query execution time by named query", ("query",), buckets=DB_BUCKETS,
+)
+
+
+@contextmanager
+def timed_query(name: str):
+    """Observe a named query in QUERY_SECONDS and the current request's "db" span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        QUERY_SECONDS.observe(elapsed, query=name)
+        record_span("db", elapsed)
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection frees up within the checkout timeout"""
+
+
+class DatabasePool:
+    """
+    Bounded, thread-safe PostgreSQL connection pool.
+
+    Connections are opened lazily up to max_size and kept warm afterwards
+    (idle ones beyond min_size are closed after max_idle_time). A connection
+    that sat idle longer than health_check_interval is pinged before being
+    handed out, so a dropped server connection never reaches a handler.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = 1,
+        max_size: int = 10,
+        checkout_timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+        max_idle_time: float = 300.0,
+    ):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.max_idle_time = max_idle_time
+
+        self._idle = deque()  # (conn, last_used) - newest on the right
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Statistics
+        self._opened = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._connects = 0
+        self._health_check_failures = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def open(self):
+        """Pre-open min_size connections so the first requests don't pay for setup"""
+        while len(self._idle) < self.min_size:
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=RealDictCursor)
+        with self._lock:
+            self._opened += 1
+            self._connects += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._opened -= 1
+
+    def _is_healthy(self, conn, last_used: float) -> bool:
+        """Ping connections that have been idle past the health check interval"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            with self._lock:
+                self._health_check_failures += 1
+            print(f"⚠️  Dropping unhealthy database connection: {e}")
+            return False
+
+    def getconn(self):
+        """Check out a connection, waiting up to checkout_timeout for a free slot"""
+        if self._closed:
+            raise PoolTimeoutError("Database pool is closed")
+
+        start = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.checkout_timeout)
+        waited = time.monotonic() - start
+
+        with self._lock:
+            self._waiting -= 1
+            if acquired:
+                self._checkouts += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            else:
+                self._timeouts += 1
+
+        POOL_WAIT_SECONDS.observe(waited)
+        record_span("db_pool", waited)
+        if not acquired:
+            raise PoolTimeoutError(f"No database connection available after {self.checkout_timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None  # LIFO keeps hot connections hot
+                if item is None:
+                    return self._connect()
+                conn, last_used = item
+                if self._is_healthy(conn, last_used):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Return a connection to the pool, rolling back any open transaction"""
+        try:
+            if conn.closed:
+                with self._lock:
+                    self._opened -= 1
+                return
+
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                # Server connection lost
+                self._discard(conn)
+                return
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            with self._lock:
+                if not self._closed:
+                    self._idle.append((conn, time.monotonic()))
+                    conn = None
+            if conn is not None:
+                self._discard(conn)
+
+            self._trim_idle()
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def _trim_idle(self):
+        """Close connections idle past max_idle_time, keeping min_size warm"""
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            while len(self._idle) > self.min_size and now - self._idle[0][1] > self.max_idle_time:
+                expired.append(self._idle.popleft()[0])
+        for conn in expired:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks out a connection and always returns it"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close idle connections; checked-out ones are closed when returned"""
+        with self._lock:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        """Pool statistics for sizing (exposed on /health)"""
+        with self._lock:
+            idle = len(self._idle)
+            return {
+                "minSize": self.min_size,
+                "maxSize": self.max_size,
+                "open": self._opened,
+                "inUse": self._opened - idle,
+                "idle": idle,
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "connectsTotal": self._connects,
+                "healthCheckFailures": self._health_check_failures,
+                "avgWaitMs": round(self._wait_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "maxWaitMs": round(self._wait_max * 1000, 3),
+            }
@@ -0,0 +1,298 @@
+# jobs.py - Postgres-backed generation job queue with a bounded worker pool
+import time
+import uuid
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from psycopg2.extras import Json
+
+from go_bot_backend.db import DatabasePool, timed_query
+
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+CLAIM_JOB_SQL = """
+    UPDATE generation_jobs
+    SET status = 'running',
+        attempts = attempts + 1,
+        started_at = NOW(),
+        lease_expires_at = NOW() + make_interval(secs => %s)
+    WHERE id = (
+        SELECT id FROM generation_jobs
+        WHERE status = 'queued'
+        OR (status = 'running' AND lease_expires_at < NOW())
+        ORDER BY created_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id, job_type, payload, attempts,
+              EXTRACT(EPOCH FROM started_at - created_at) AS wait_seconds
+"""
+
+
+class JobQueue:
+    """
+    Durable job queue for long-running generations.
+
+    Jobs are rows in generation_jobs, so they survive restarts. Workers claim
+    jobs with FOR UPDATE SKIP LOCKED and hold a lease that a heartbeat keeps
+    extending; if a worker (or the whole replica) dies, the lease expires and
+    the job is picked up again, up to max_attempts. Jobs given up on that
+    way are passed to on_abandoned (their payload), since no handler ran to
+    completion to clean up after them.
+    """
+
+    def __init__(
+        self,
+        db: DatabasePool,
+        handlers: Dict[str, JobHandler],
+        workers: int = 4,
+        lease_seconds: int = 900,
+        max_attempts: int = 3,
+        poll_interval: float = 2.0,
+        on_abandoned: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ):
+        self.db = db
+        self.handlers = handlers
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.on_abandoned = on_abandoned
+
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._running_ids = set()
+
+        # Metrics
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._failed = 0
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+
+    # ------------------------------------------------------------------
+    # Database operations (blocking - run in a thread)
+    # ------------------------------------------------------------------
+
+    def submit(self, job_type: str, payload: Dict[str, Any], install: Optional[str] = None) -> str:
+        """Persist a new queued job and return its id"""
+        job_id = str(uuid.uuid4())
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            with timed_query("submit job"):
+                cur.execute("""
+                    INSERT INTO generation_jobs (id, job_type, payload, install, status)
+                    VALUES (%s, %s, %s, %s, 'queued')
+                """, (job_id, job_type, Json(payload), install))
+            conn.commit()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch a job row by id"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, job_type, status, result, error, attempts,
+                       created_at, started_at, finished_at
+                FROM generation_jobs
+                WHERE id = %s
+            """, (job_id,))
+            return cur.fetchone()
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Claim the oldest queued job (or one whose lease expired)"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+
+            # Jobs that keep crashing their worker are given up on
+            cur.execute("""
+                UPDATE generation_jobs
+                SET status = 'failed',
+                    error = 'Worker lease expired too many times',
+                    finished_at = NOW()
+                WHERE status = 'running'
+                AND lease_expires_at < NOW()
+                AND attempts >= %s
+                RETURNING id, payload
+            """, (self.max_attempts,))
+            abandoned = cur.fetchall()
+
+            with timed_query("claim next job"):
+                cur.execute(CLAIM_JOB_SQL, (self.lease_seconds,))
+            job = cur.fetchone()
+            conn.commit()
+
+        for row in abandoned:
+            print(f"❌ Job {row['id']} failed: worker lease expired too many times")
+            if self.on_abandoned:
+                try:
+                    self.on_abandoned(row['payload'])
+                except Exception as e:
+                    print(f"⚠️  Cleanup failed for abandoned job {row['id']}: {e}")
+        return job
+
+    def _extend_lease(self, job_id: str):
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE generation_jobs
+                SET lease_expires_at = NOW() + make_interval(secs => %s)
+                WHERE id = %s AND status = 'running'
+            """, (self.lease_seconds, job_id))
+            conn.commit()
+
+    def _finish(self, job_id: str, result: Optional[Dict[str, Any]], error: Optional[str]):
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE generation_jobs
+                SET status = %s,
+                    result = %s,
+                    error = %s,
+                    finished_at = NOW(),
+                    lease_expires_at = NULL
+                WHERE id = %s
+            """, ('failed' if error else 'completed', Json(result) if result is not None else None, error, job_id))
+            conn.commit()
+
+    def _requeue(self, job_ids):
+        """Hand jobs interrupted by a graceful shutdown back to the queue"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE generation_jobs
+                SET status = 'queued',
+                    attempts = GREATEST(attempts - 1, 0),
+                    lease_expires_at = NULL
+                WHERE id = ANY(%s::uuid[]) AND status = 'running'
+            """, (list(job_ids),))
+            conn.commit()
+
+    def queue_depth(self) -> Dict[str, Any]:
+        """Queued/running counts and the age of the oldest queued job"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT
+                    COUNT(*) FILTER (WHERE status = 'queued') AS queued,
+                    COUNT(*) FILTER (WHERE status = 'running') AS running,
+                    EXTRACT(EPOCH FROM NOW() - MIN(created_at) FILTER (WHERE status = 'queued')) AS oldest_queued_seconds
+                FROM generation_jobs
+                WHERE status IN ('queued', 'running')
+            """)
+            row = cur.fetchone()
+        return {
+            "queued": row['queued'],
+            "running": row['running'],
+            "oldestQueuedSeconds": float(row['oldest_queued_seconds']) if row['oldest_queued_seconds'] is not None else None,
+        }
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+
+    def notify(self):
+        """Wake idle workers after a local submit instead of waiting for the next poll"""
+        self._wakeup.set()
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"✅ Job queue started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._running_ids:
+            try:
+                await asyncio.to_thread(self._requeue, set(self._running_ids))
+                print(f"↩️  Requeued {len(self._running_ids)} interrupted job(s)")
+            except Exception as e:
+                print(f"⚠️  Could not requeue jobs (their lease will expire instead): {e}")
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._extend_lease, job_id)
+            except Exception as e:
+                print(f"⚠️  Lease renewal failed for job {job_id}: {e}")
+
+    async def _worker(self, worker_id: int):
+        while True:
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                print(f"⚠️  Job worker {worker_id} could not claim: {e}")
+                job = None
+
+            if not job:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._run(job)
+            except Exception as e:
+                # Its lease expires and the job is retried; this worker carries on
+                print(f"⚠️  Job worker {worker_id} could not finish job {job['id']}: {e}")
+
+    async def _run(self, job: Dict[str, Any]):
+        job_id = str(job['id'])
+        wait_seconds = max(0.0, float(job['wait_seconds'] or 0))
+        with self._lock:
+            self._wait_count += 1
+            self._wait_total += wait_seconds
+            self._wait_max = max(self._wait_max, wait_seconds)
+
+        print(f"🛠️  Running job {job_id} ({job['job_type']}, attempt {job['attempts']}, waited {wait_seconds:.1f}s)")
+        self._running_ids.add(job_id)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        start = time.monotonic()
+        result, error = None, None
+        try:
+            handler = self.handlers.get(job['job_type'])
+            if handler is None:
+                raise ValueError(f"Unknown job type: {job['job_type']}")
+            result = await handler(job['payload'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(getattr(e, 'detail', None) or e)
+            print(f"❌ Job {job_id} failed: {error}")
+        finally:
+            heartbeat.cancel()
+
+        try:
+            await asyncio.to_thread(self._finish, job_id, result, error)
+        finally:
+            self._running_ids.discard(job_id)
+
+        with self._lock:
+            self._run_total += time.monotonic() - start
+            if error:
+                self._failed += 1
+            else:
+                self._completed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """In-process worker metrics (exposed on /health and /jobs/metrics)"""
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "workers": self.workers,
+                "busyWorkers": len(self._running_ids),
+                "completed": self._completed,
+                "failed": self._failed,
+                "avgWaitSeconds": round(self._wait_total / self._wait_count, 3) if self._wait_count else 0.0,
+                "maxWaitSeconds": round(self._wait_max, 3),
+                "avgRunSeconds": round(self._run_total / finished, 3) if finished else 0.0,
+            }
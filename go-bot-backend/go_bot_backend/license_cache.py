@@ -0,0 +1,269 @@
+# license_cache.py - Two-tier cache for license_keys lookups
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from go_bot_backend.cache import LocalLRU
+from go_bot_backend.db import DatabasePool, timed_query
+
+
+LICENSE_COLUMNS = """
+    key_code,
+    customer_email,
+    plan,
+    install,
+    is_active,
+    subscription_status,
+    gobot_limit,
+    gobot_used,
+    usage_resets_at,
+    activated_at,
+    expires_at,
+    created_at
+"""
+
+TIMESTAMP_COLUMNS = ("usage_resets_at", "activated_at", "expires_at", "created_at")
+
+MISSING = ""  # Cached marker for "no such key / no active key for this install"
+
+
+# KEYS[1] = cache key, KEYS[2] = its invalidation version
+# ARGV[1] = version read before the database query, ARGV[2] = value, ARGV[3] = TTL
+# Returns 1 if stored, 0 if the key was invalidated since (the value may be stale)
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+LICENSE_BY_KEY_SQL = f"""
+    SELECT {LICENSE_COLUMNS}
+    FROM license_keys
+    WHERE key_code = %s
+"""
+
+KEY_BY_INSTALL_SQL = """
+    SELECT key_code
+    FROM license_keys
+    WHERE install = %s
+    AND is_active = true
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+
+def fetch_license_by_key(conn, key_code: str) -> Optional[Dict[str, Any]]:
+    """Load one license_keys row by key code"""
+    cur = conn.cursor()
+    with timed_query("license by key"):
+        cur.execute(LICENSE_BY_KEY_SQL, (key_code,))
+    return cur.fetchone()
+
+
+def fetch_key_code_by_install(conn, install: str) -> Optional[str]:
+    """Find the newest active key code for an install"""
+    cur = conn.cursor()
+    with timed_query("active key by install"):
+        cur.execute(KEY_BY_INSTALL_SQL, (install,))
+    row = cur.fetchone()
+    return row['key_code'] if row else None
+
+
+def _encode(row: Optional[Dict[str, Any]]) -> str:
+    if row is None:
+        return MISSING
+    return json.dumps(row, default=lambda value: value.isoformat())
+
+
+def _decode(value: str) -> Optional[Dict[str, Any]]:
+    if value == MISSING:
+        return None
+    row = json.loads(value)
+    for column in TIMESTAMP_COLUMNS:
+        if row.get(column):
+            row[column] = datetime.fromisoformat(row[column])
+    return row
+
+
+class LicenseCache:
+    """
+    License rows cached in-process (TTL/LRU) in front of Redis, keyed by
+    key_code, plus an install -> key_code mapping.
+
+    Entries are invalidated explicitly by every code path that writes
+    license_keys. Invalidations are also published on a Redis channel so
+    other replicas drop their in-process copies, which is what lets the
+    TTLs stay long without serving stale rows.
+
+    A miss is filled only if nothing was invalidated while the row was
+    being read: invalidate() bumps a per-key version in Redis (and an
+    in-process generation), and the fill is a compare-and-set against the
+    values seen before the query. Otherwise a read racing an activation
+    could cache the old row, or "no key", for the whole TTL.
+    """
+
+    CHANNEL = "gobot:license:invalidate"
+    KEY_PREFIX = "gobot:license:key:"
+    INSTALL_PREFIX = "gobot:license:install:"
+    VERSION_PREFIX = "gobot:license:version:"
+    VERSION_TTL = 86400  # Far longer than any read, so a version can't expire mid-fill
+
+    def __init__(
+        self,
+        db: DatabasePool,
+        redis_client=None,
+        local_ttl: int = 300,
+        redis_ttl: int = 3600,
+        missing_ttl: int = 60,
+        local_max_entries: int = 10000,
+    ):
+        self.db = db
+        self.redis = redis_client
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.missing_ttl = missing_ttl  # "No key" answers expire sooner, in case one slips through
+        self.local = LocalLRU(local_max_entries)
+        self._listener = None
+        self._generation = 0  # Bumped on every local invalidation
+        self._fill = redis_client.register_script(FILL_SCRIPT) if redis_client else None
+
+        # Counters
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_fills = 0
+
+    # ------------------------------------------------------------------
+    # Cross-replica invalidation
+    # ------------------------------------------------------------------
+
+    def start(self):
+        """Subscribe to invalidations published by other replicas"""
+        if not self.redis:
+            return
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+        self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stop(self):
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+    def _on_invalidate(self, message):
+        try:
+            keys = json.loads(message['data'])
+        except (TypeError, ValueError):
+            return
+        self._drop_local(keys)
+
+    def _drop_local(self, keys: Iterable[str]):
+        self._generation += 1
+        for key in keys:
+            self.local.delete(key)
+
+    # ------------------------------------------------------------------
+    # Lookups (blocking - call from a thread)
+    # ------------------------------------------------------------------
+
+    def _get(self, key: str) -> Tuple[Optional[str], Optional[Tuple[int, str]]]:
+        """Cached value, or None plus the (generation, version) to fill it with"""
+        generation = self._generation
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value, None
+        version = None
+        if self.redis:
+            try:
+                value, version = self.redis.mget(key, f"{self.VERSION_PREFIX}{key}")
+            except Exception as e:
+                print(f"⚠️  License cache read failed: {e}")
+            if value is not None:
+                self.redis_hits += 1
+                if self._generation == generation:
+                    self.local.set(key, value, self._ttl(value, self.local_ttl))
+                return value, None
+        return None, (generation, version or "0")
+
+    def _ttl(self, value: str, ttl: int) -> int:
+        return min(ttl, self.missing_ttl) if value == MISSING else ttl
+
+    def _set(self, key: str, value: str, guard: Tuple[int, str]):
+        """Fill a miss unless the key was invalidated since _get"""
+        generation, version = guard
+        if self.redis:
+            try:
+                stored = self._fill(keys=[key, f"{self.VERSION_PREFIX}{key}"], args=[version, value, self._ttl(value, self.redis_ttl)])
+            except Exception as e:
+                print(f"⚠️  License cache write failed: {e}")
+                stored = True  # Redis is down: the local generation still guards this replica
+            if not stored:
+                self.stale_fills += 1
+                return
+        if self._generation == generation:
+            self.local.set(key, value, self._ttl(value, self.local_ttl))
+        else:
+            self.stale_fills += 1
+
+    def get_by_key(self, key_code: str) -> Optional[Dict[str, Any]]:
+        """license_keys row for a key code, or None if there is none"""
+        cache_key = f"{self.KEY_PREFIX}{key_code}"
+        value, guard = self._get(cache_key)
+        if value is None:
+            self.misses += 1
+            with self.db.connection() as conn:
+                value = _encode(fetch_license_by_key(conn, key_code))
+            self._set(cache_key, value, guard)
+        return _decode(value)
+
+    def get_by_install(self, install: str) -> Optional[Dict[str, Any]]:
+        """Row of the newest active key for an install, or None"""
+        cache_key = f"{self.INSTALL_PREFIX}{install}"
+        key_code, guard = self._get(cache_key)
+        if key_code is None:
+            self.misses += 1
+            with self.db.connection() as conn:
+                key_code = fetch_key_code_by_install(conn, install) or MISSING
+            self._set(cache_key, key_code, guard)
+        if key_code == MISSING:
+            return None
+        return self.get_by_key(key_code)
+
+    def invalidate(self, key_codes: Iterable[str] = (), installs: Iterable[str] = ()):
+        """Drop cached rows/mappings everywhere after license_keys changed"""
+        keys = [f"{self.KEY_PREFIX}{key_code}" for key_code in key_codes if key_code]
+        keys += [f"{self.INSTALL_PREFIX}{install}" for install in installs if install]
+        if not keys:
+            return
+        self.invalidations += 1
+        self._drop_local(keys)
+        if self.redis:
+            try:
+                pipe = self.redis.pipeline()
+                for key in keys:
+                    pipe.incr(f"{self.VERSION_PREFIX}{key}")
+                    pipe.expire(f"{self.VERSION_PREFIX}{key}", self.VERSION_TTL)
+                pipe.delete(*keys)
+                pipe.execute()
+                self.redis.publish(self.CHANNEL, json.dumps(keys))
+            except Exception as e:
+                print(f"⚠️  License cache invalidation failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit counters per tier (exposed on /health)"""
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "backend": "memory+redis" if self.redis else "memory",
+            "localHits": self.local_hits,
+            "redisHits": self.redis_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "staleFills": self.stale_fills,
+            "hitRate": round((self.local_hits + self.redis_hits) / lookups, 4) if lookups else 0.0,
+            "localEntries": len(self.local),
+        }
@@ -0,0 +1,116 @@
+# llm.py - Claude request helpers shared by the generation paths
+import threading
+from typing import Any, Dict, List, Tuple
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def cached_system(text: str) -> List[Dict[str, Any]]:
+    """System prompt block marked as a prompt-cache breakpoint"""
+    return [{"type": "text", "text": text, "cache_control": CACHE_CONTROL}]
+
+
+def with_cache_breakpoint(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Copy of messages with a cache breakpoint on the last turn, so the next
+    continuation reads the whole conversation so far from the prompt cache
+    instead of paying for it again.
+    """
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = CACHE_CONTROL
+    return messages[:-1] + [{**last, "content": content}]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for English and code (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+
+def adaptive_max_tokens(prompt: str, floor: int, ceiling: int, ratio: float) -> int:
+    """
+    max_tokens sized from the expected output: floor plus `ratio` output
+    tokens per prompt token, capped at ceiling. Long tickets get room to
+    finish without continuations; short ones don't reserve output tokens
+    against the rate limit that they will never use.
+    """
+    return max(floor, min(ceiling, floor + int(estimate_tokens(prompt) * ratio)))
+
+
+def continuation_messages(prompt: str, answer: str, context_chars: int) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Messages that continue a truncated answer by prefilling the assistant
+    turn with it, so Claude picks up mid-sentence with no seam. Only the last
+    context_chars of the answer are re-sent (starting at a line boundary),
+    keeping each continuation's input to the prompt plus a fixed window.
+
+    Returns the messages and the trailing whitespace trimmed off the prefill
+    (the API rejects a final assistant turn that ends in whitespace).
+    """
+    tail = answer[-context_chars:]
+    if len(answer) > context_chars:
+        line_start = tail.find("\n")
+        if 0 <= line_start < len(tail) - 1:
+            tail = tail[line_start + 1:]
+    prefill = tail.rstrip()
+
+    # The prompt stays the cached prefix for every continuation
+    messages = with_cache_breakpoint([{"role": "user", "content": prompt}])
+    if prefill:
+        messages.append({"role": "assistant", "content": prefill})
+    return messages, tail[len(prefill):]
+
+
+def strip_seam(trimmed: str, text: str) -> str:
+    """Drop the whitespace a continuation repeats from the trimmed end of its prefill"""
+    overlap = 0
+    while overlap < min(len(trimmed), len(text)) and text[overlap] == trimmed[overlap]:
+        overlap += 1
+    return text[overlap:]
+
+
+class TokenUsageStats:
+    """Running totals of Claude token usage, including prompt cache reads/writes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.cache_creation_input_tokens = 0
+
+    def record(self, usage) -> Dict[str, int]:
+        """Add one message.usage and return its counts"""
+        counts = {
+            "input": getattr(usage, "input_tokens", 0) or 0,
+            "output": getattr(usage, "output_tokens", 0) or 0,
+            "cacheRead": getattr(usage, "cache_read_input_tokens", 0) or 0,
+            "cacheCreation": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        }
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += counts["input"]
+            self.output_tokens += counts["output"]
+            self.cache_read_input_tokens += counts["cacheRead"]
+            self.cache_creation_input_tokens += counts["cacheCreation"]
+        return counts
+
+    def stats(self) -> Dict[str, Any]:
+        """Token totals and prompt cache hit rate (exposed on /health)"""
+        with self._lock:
+            prompt_tokens = self.input_tokens + self.cache_read_input_tokens + self.cache_creation_input_tokens
+            return {
+                "calls": self.calls,
+                "inputTokens": self.input_tokens,
+                "outputTokens": self.output_tokens,
+                "cacheReadInputTokens": self.cache_read_input_tokens,
+                "cacheCreationInputTokens": self.cache_creation_input_tokens,
+                "cacheHitRate": round(self.cache_read_input_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+            }
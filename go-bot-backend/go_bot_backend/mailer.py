@@ -0,0 +1,265 @@
+# mailer.py - Background email delivery through Mailgun batch sends
+import json
+import time
+import random
+import string
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import httpx
+
+
+class EmailTemplate:
+    """
+    A str.format-style template, parsed once at import. render() only joins
+    the pre-split parts; batch_body is the same text with every field as a
+    Mailgun %recipient.<field>% variable, so one body serves a whole batch.
+    """
+
+    def __init__(self, source: str):
+        self.parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if spec or conversion:
+                raise ValueError(f"Format specs are not supported in email templates: {{{field}}}")
+            self.parts.append((literal, field))
+        self.fields = {field for _, field in self.parts if field}
+        self.batch_body = "".join(
+            literal + (f"%recipient.{field}%" if field else "") for literal, field in self.parts
+        )
+
+    def render(self, **values) -> str:
+        return "".join(
+            literal + (str(values[field]) if field else "") for literal, field in self.parts
+        )
+
+
+class EmailTemplates(NamedTuple):
+    subject: EmailTemplate
+    text: EmailTemplate
+    html: EmailTemplate
+
+
+class Email(NamedTuple):
+    template: str
+    to: str
+    values: Dict[str, Any]
+
+
+class MailgunMailer:
+    """
+    Sends templated emails from a background task.
+
+    send() is safe to call from any thread and only appends to a queue. The
+    worker collects what arrives within batch_window (up to batch_size
+    recipients, Mailgun's limit is 1000) and sends each template's batch as
+    one Mailgun API call with recipient-variables, over a single keep-alive
+    HTTP client. 429s, 5xx and connection errors are retried with
+    exponential backoff and jitter, max_attempts in total; emails that still
+    can't be sent, or that don't fit in the queue, go to on_failure.
+
+    deliver() queues the same way but waits for Mailgun's answer, for
+    callers that keep their own durable retry (the Stripe event outbox).
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        domain: str,
+        from_email: str,
+        templates: Dict[str, EmailTemplates],
+        api_base: str = "https://api.mailgun.net/v3",
+        batch_size: int = 100,
+        batch_window: float = 0.5,
+        max_attempts: int = 4,
+        retry_base: float = 1.0,
+        max_queue: int = 10000,
+        timeout: float = 10.0,
+        on_failure: Optional[Callable[[Email], Any]] = None,
+    ):
+        self.url = f"{api_base.rstrip('/')}/{domain}/messages"
+        self.api_key = api_key
+        self.from_email = from_email
+        self.templates = templates
+        self.batch_size = min(batch_size, 1000)
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.on_failure = on_failure
+
+        self._loop = None
+        self._queue = None
+        self._client = None
+        self._task = None
+
+        # Metrics
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+        self._requests = 0
+        self._retries = 0
+        self._delivery_total = 0.0
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._client = httpx.AsyncClient(
+            auth=("api", self.api_key),
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+        )
+        self._task = asyncio.create_task(self._worker())
+        print("✅ Email delivery started")
+
+    async def stop(self, timeout: float = 10.0):
+        """Deliver what is queued (up to timeout), then close the HTTP client"""
+        if not self._task:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️  Stopping email delivery with {self._pending} email(s) unsent")
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._client.aclose()
+
+    def send(self, template: str, to: str, **values) -> bool:
+        """Queue an email; False if delivery isn't running or the queue is full"""
+        return self._enqueue(Email(template, to, values)) is not None
+
+    def deliver(self, template: str, to: str, timeout: float = 60.0, **values) -> bool:
+        """
+        Queue an email and wait until Mailgun accepted it (blocking - call
+        from a thread, not the event loop); False if it was not delivered
+        within timeout
+        """
+        done = self._enqueue(Email(template, to, values))
+        if done is None:
+            return False
+        try:
+            return done.result(timeout=timeout)
+        except FutureTimeout:
+            return False
+
+    def _enqueue(self, email: Email) -> Optional[Future]:
+        """Queue an email; returns the future of its delivery, or None if it was dropped"""
+        with self._lock:
+            if not self._task or self._pending >= self.max_queue:
+                self._dropped += 1
+                return None
+            self._pending += 1
+        done = Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (email, time.monotonic(), done))
+        return done
+
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                for group in self._group(batch):
+                    await self._deliver(group)
+            except Exception as e:
+                print(f"❌ Email delivery error: {e}")
+            finally:
+                for _, _, done in batch:
+                    if not done.done():
+                        done.set_result(False)
+                    self._queue.task_done()
+                with self._lock:
+                    self._pending -= len(batch)
+
+    @staticmethod
+    def _group(batch) -> List[List[tuple]]:
+        """Split a batch by template, with each recipient at most once per group"""
+        groups = {}
+        for item in batch:
+            email = item[0]
+            chunks = groups.setdefault(email.template, [])
+            for chunk in chunks:
+                if all(other.to != email.to for other, _, _ in chunk):
+                    chunk.append(item)
+                    break
+            else:
+                chunks.append([item])
+        return [chunk for chunks in groups.values() for chunk in chunks]
+
+    async def _deliver(self, group: List[tuple]):
+        emails = [email for email, _, _ in group]
+        templates = self.templates[emails[0].template]
+        data = {
+            "from": self.from_email,
+            "to": [email.to for email in emails],
+            "subject": templates.subject.batch_body,
+            "text": templates.text.batch_body,
+            "html": templates.html.batch_body,
+            "recipient-variables": json.dumps({email.to: email.values for email in emails}),
+        }
+
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            retry_after = 0.0
+            try:
+                with self._lock:
+                    self._requests += 1
+                response = await self._client.post(self.url, data=data)
+                if response.status_code == 200:
+                    now = time.monotonic()
+                    with self._lock:
+                        self._sent += len(group)
+                        self._delivery_total += sum(now - queued for _, queued, _ in group)
+                    for _, _, done in group:
+                        done.set_result(True)
+                    return
+                error = f"{response.status_code} - {response.text[:200]}"
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                try:
+                    retry_after = float(response.headers.get("retry-after", 0))
+                except ValueError:
+                    pass
+            except httpx.HTTPError as e:
+                error = str(e) or type(e).__name__
+
+            if attempt < self.max_attempts:
+                with self._lock:
+                    self._retries += 1
+                backoff = self.retry_base * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+                await asyncio.sleep(max(backoff, retry_after))
+
+        print(f"❌ Mailgun error sending to {len(emails)} recipient(s): {error}")
+        with self._lock:
+            self._failed += len(emails)
+        for _, _, done in group:
+            done.set_result(False)
+        if self.on_failure:
+            for email in emails:
+                self.on_failure(email)
+
+    def stats(self) -> Dict[str, Any]:
+        """Delivery counters (exposed on /health)"""
+        with self._lock:
+            return {
+                "queued": self._pending,
+                "sent": self._sent,
+                "failed": self._failed,
+                "dropped": self._dropped,
+                "requests": self._requests,
+                "retries": self._retries,
+                "avgDeliverySeconds": round(self._delivery_total / self._sent, 3) if self._sent else 0.0,
+            }
@@ -0,0 +1,63 @@
+# migrate.py - Apply schema migrations before a deploy
+#
+#   python -m go_bot_backend.migrate            apply pending migrations
+#   python -m go_bot_backend.migrate --status   show applied/pending versions
+#   python -m go_bot_backend.migrate --check-plans
+#                                               apply, then fail if a hot query would seq scan
+import os
+import sys
+import argparse
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+from go_bot_backend.migrations import MIGRATIONS, SCHEMA_VERSION, check_query_plans, migrate, schema_version
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Apply Go Bot schema migrations")
+    parser.add_argument("--status", action="store_true", help="Show the schema version and pending migrations")
+    parser.add_argument("--check-plans", action="store_true", help="After migrating, EXPLAIN the hot queries and fail on sequential scans")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        print("❌ DATABASE_URL is not set")
+        return 1
+
+    conn = psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    try:
+        if args.status:
+            version = schema_version(conn)
+            print(f"Schema version {version} (latest {SCHEMA_VERSION})")
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version <= version else "pending"
+                print(f"  {migration.version:>4}  {migration.name:<30} {state}")
+            return 0
+
+        applied = migrate(conn)
+        for migration in applied:
+            print(f"✅ Applied migration {migration.version} ({migration.name})")
+        print(f"✅ Schema at version {SCHEMA_VERSION}" if applied else f"✅ Schema up to date (version {SCHEMA_VERSION})")
+
+        if args.check_plans:
+            failed = 0
+            for name, scans in check_query_plans(conn).items():
+                if scans:
+                    failed += 1
+                    print(f"❌ {name}: sequential scan on {', '.join(scans)}")
+                else:
+                    print(f"✅ {name}")
+            return 1 if failed else 0
+        return 0
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+# migrations.py - Versioned schema migrations (applied by `python -m go_bot_backend.migrate`)
+import json
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: Tuple[str, ...]
+
+
+# Append only: never edit a migration once it has shipped, add a new one.
+# Versions 1-2 use IF NOT EXISTS so databases created by the old startup
+# init_database() adopt them without changes.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "license_keys", (
+        """
+        CREATE TABLE IF NOT EXISTS license_keys (
+            id SERIAL PRIMARY KEY,
+            key_code VARCHAR(255) UNIQUE NOT NULL,
+            customer_email VARCHAR(255) NOT NULL,
+            plan VARCHAR(50) NOT NULL,
+            install VARCHAR(255),
+
+            -- Subscription fields
+            stripe_subscription_id VARCHAR(255),
+            stripe_customer_id VARCHAR(255),
+            stripe_payment_intent_id VARCHAR(255),
+
+            -- Usage tracking
+            gobot_limit INTEGER NOT NULL,
+            gobot_used INTEGER DEFAULT 0,
+            usage_resets_at TIMESTAMP,
+
+            -- Status
+            is_active BOOLEAN DEFAULT true,
+            subscription_status VARCHAR(50) DEFAULT 'active',
+            activated_at TIMESTAMP,
+            expires_at TIMESTAMP,
+
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_license_key_code ON license_keys(key_code)",
+        "CREATE INDEX IF NOT EXISTS idx_license_email ON license_keys(customer_email)",
+        "CREATE INDEX IF NOT EXISTS idx_license_subscription ON license_keys(stripe_subscription_id)",
+        "CREATE INDEX IF NOT EXISTS idx_license_customer ON license_keys(stripe_customer_id)",
+    )),
+    Migration(2, "generation_jobs", (
+        """
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id UUID PRIMARY KEY,
+            job_type VARCHAR(50) NOT NULL,
+            payload JSONB NOT NULL,
+            install VARCHAR(255),
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            result JSONB,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_expires_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_pending ON generation_jobs(created_at) WHERE status IN ('queued', 'running')",
+    )),
+    Migration(3, "license_keys hot-path indexes", (
+        # Duplicates the index behind the key_code UNIQUE constraint
+        "DROP INDEX IF EXISTS idx_license_key_code",
+        # Success page polls by payment intent until the webhook has run
+        """
+        CREATE INDEX IF NOT EXISTS idx_license_payment_intent
+        ON license_keys(stripe_payment_intent_id)
+        WHERE stripe_payment_intent_id IS NOT NULL
+        """,
+        # find-key-by-install (newest active key) and deactivating an install's old keys
+        """
+        CREATE INDEX IF NOT EXISTS idx_license_install
+        ON license_keys(install, is_active, created_at DESC)
+        """,
+        # Monthly usage reset sweep
+        """
+        CREATE INDEX IF NOT EXISTS idx_license_usage_resets
+        ON license_keys(usage_resets_at)
+        WHERE is_active = true AND subscription_status = 'active'
+        """,
+        # One free key per email. Earlier check-then-insert races could
+        # leave duplicates; all but the one in use are moved off plan
+        # 'free' (not deleted) so the unique index can be built.
+        """
+        UPDATE license_keys
+        SET plan = 'free_duplicate',
+            updated_at = NOW()
+        WHERE plan = 'free'
+        AND id NOT IN (
+            SELECT DISTINCT ON (customer_email) id
+            FROM license_keys
+            WHERE plan = 'free'
+            ORDER BY customer_email, is_active DESC, (activated_at IS NOT NULL) DESC, created_at DESC
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_license_free_email
+        ON license_keys(customer_email)
+        WHERE plan = 'free'
+        """,
+    )),
+    Migration(4, "usage_events ledger and rollups", (
+        # Append-only, one partition per month (created by analytics.maintain_partitions)
+        """
+        CREATE TABLE IF NOT EXISTS usage_events (
+            created_at TIMESTAMP NOT NULL,
+            endpoint VARCHAR(50) NOT NULL,
+            key_code VARCHAR(255),
+            install VARCHAR(255),
+            plan VARCHAR(50) NOT NULL,
+            status SMALLINT NOT NULL,
+            latency_ms INTEGER NOT NULL,
+            input_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            cache_read_tokens INTEGER NOT NULL DEFAULT 0,
+            cache_creation_tokens INTEGER NOT NULL DEFAULT 0
+        ) PARTITION BY RANGE (created_at)
+        """,
+        # Catches rows if partition maintenance fell behind
+        "CREATE TABLE IF NOT EXISTS usage_events_default PARTITION OF usage_events DEFAULT",
+        "CREATE INDEX IF NOT EXISTS idx_usage_events_created ON usage_events USING BRIN (created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            hour TIMESTAMP NOT NULL,
+            endpoint VARCHAR(50) NOT NULL,
+            plan VARCHAR(50) NOT NULL,
+            key_code VARCHAR(255) NOT NULL DEFAULT '',
+            install VARCHAR(255) NOT NULL DEFAULT '',
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            latency_ms_total BIGINT NOT NULL,
+            latency_ms_max INTEGER NOT NULL,
+            input_tokens BIGINT NOT NULL,
+            output_tokens BIGINT NOT NULL,
+            cache_read_tokens BIGINT NOT NULL,
+            cache_creation_tokens BIGINT NOT NULL,
+            PRIMARY KEY (hour, endpoint, plan, key_code, install)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_rollup_state (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            rolled_up_to TIMESTAMP NOT NULL
+        )
+        """,
+    )),
+    Migration(5, "stripe_events outbox", (
+        # Verified webhook events: the primary key dedupes redeliveries and
+        # rows wait here until a worker has applied them (see stripe_events.py)
+        """
+        CREATE TABLE IF NOT EXISTS stripe_events (
+            event_id VARCHAR(255) PRIMARY KEY,
+            event_type VARCHAR(100) NOT NULL,
+            ordering_key VARCHAR(255) NOT NULL,
+            stripe_created TIMESTAMP NOT NULL,
+            payload JSONB NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            lease_expires_at TIMESTAMP,
+            received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+        """,
+        # Claiming the next event and checking for an unfinished predecessor
+        """
+        CREATE INDEX IF NOT EXISTS idx_stripe_events_pending
+        ON stripe_events(ordering_key, stripe_created, received_at)
+        WHERE status IN ('pending', 'processing')
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_stripe_events_processed
+        ON stripe_events(processed_at)
+        WHERE status = 'processed'
+        """,
+    )),
+    Migration(6, "similar_tickets for retrieval", (
+        # Past tickets and their results per install; vectors are in the
+        # RAG index, which is reloaded from here when it's in-process (see rag.py)
+        """
+        CREATE TABLE IF NOT EXISTS similar_tickets (
+            id VARCHAR(64) PRIMARY KEY,
+            install VARCHAR(255) NOT NULL,
+            kind VARCHAR(20) NOT NULL,
+            text TEXT NOT NULL,
+            output JSONB NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_similar_tickets_created ON similar_tickets(created_at)",
+    )),
+    Migration(7, "license key email delivery", (
+        # Set once a purchased key's email was accepted by Mailgun; a Stripe
+        # event retried after a crash sends it only while this is NULL
+        "ALTER TABLE license_keys ADD COLUMN IF NOT EXISTS key_email_sent_at TIMESTAMP",
+    )),
+    Migration(8, "usage_events insertion watermark", (
+        # Rollups follow when events were written, not when they happened, so
+        # events flushed late (after a Postgres outage) are still counted.
+        # Existing rows take their created_at, which the old watermark was on.
+        "ALTER TABLE usage_events ADD COLUMN IF NOT EXISTS inserted_at TIMESTAMP",
+        "UPDATE usage_events SET inserted_at = created_at WHERE inserted_at IS NULL",
+        "ALTER TABLE usage_events ALTER COLUMN inserted_at SET DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE usage_events ALTER COLUMN inserted_at SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_usage_events_inserted ON usage_events USING BRIN (inserted_at)",
+    )),
+    Migration(9, "similar_tickets retention", (
+        # SimilarTickets.add keeps the newest rows per install and kind
+        "CREATE INDEX IF NOT EXISTS idx_similar_tickets_namespace ON similar_tickets(install, kind, created_at DESC)",
+    )),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+# Serializes migration runs from concurrent deploys
+MIGRATION_LOCK_ID = 0x60B07
+
+
+def schema_version(conn) -> int:
+    """Highest applied migration version (0 for a database never migrated)"""
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS present")
+    if not cur.fetchone()['present']:
+        conn.rollback()
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+    version = cur.fetchone()['version']
+    conn.rollback()
+    return version
+
+
+def migrate(conn) -> List[Migration]:
+    """Apply pending migrations in order, one transaction each; returns those applied"""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row['version'] for row in cur.fetchall()}
+
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            try:
+                for statement in migration.statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (migration.version, migration.name),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(migration)
+        return applied
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        conn.commit()
+
+
+# ----------------------------------------------------------------------
+# Query plan checks
+# ----------------------------------------------------------------------
+
+def hot_queries() -> Dict[str, Tuple[str, tuple]]:
+    """
+    Hot queries that must be served by an index, with sample parameters.
+    The SQL is the constants the app executes, so the checks can't drift
+    from it; imported here so only the plan check loads the modules that
+    hold it.
+    """
+    from go_bot_backend import queries
+    from go_bot_backend.analytics import ROLLUP_SQL, usage_report_sql
+    from go_bot_backend.jobs import CLAIM_JOB_SQL
+    from go_bot_backend.license_cache import KEY_BY_INSTALL_SQL, LICENSE_BY_KEY_SQL
+    from go_bot_backend.stripe_events import CLAIM_EVENT_SQL
+    from go_bot_backend.usage import RESERVE_USAGE_SQL, USAGE_SWEEP_SQL
+
+    key_code, install, hour = "GOBOT-AAAA-BBBB-CCCC", "install-1", "2026-01-01 00:00"
+    return {
+        "license by key": (LICENSE_BY_KEY_SQL, (key_code,)),
+        "active key by install": (KEY_BY_INSTALL_SQL, (install,)),
+        "reserve usage": (RESERVE_USAGE_SQL, (key_code,)),
+        "deactivate install's old keys": (queries.DEACTIVATE_OLD_KEYS_SQL, (install, key_code)),
+        "license by payment intent": (queries.LICENSE_BY_PAYMENT_INTENT_SQL, ("pi_123",)),
+        "renew subscription": (queries.RENEW_SUBSCRIPTION_SQL, ("sub_123",)),
+        "cancel subscription": (queries.CANCEL_SUBSCRIPTION_SQL, ("sub_123",)),
+        "subscription status": (queries.SUBSCRIPTION_STATUS_SQL, ("past_due", "past_due", "sub_123")),
+        "free key upsert": (queries.FREE_KEY_UPSERT_SQL, (key_code, "user@example.com", 10)),
+        "usage window sweep": (USAGE_SWEEP_SQL, (hour, 0, 200)),
+        "usage rollup": (ROLLUP_SQL, (hour, "2026-01-01 01:00")),
+        "usage report by key": (usage_report_sql("key_code", ["key_code"]), (hour, "2026-01-08 00:00", key_code)),
+        "claim next job": (CLAIM_JOB_SQL, (900,)),
+        "claim next stripe event": (CLAIM_EVENT_SQL, (300,)),
+        "similar ticket outputs": (queries.SIMILAR_OUTPUTS_SQL, (["0" * 32],)),
+        "prune similar tickets": (queries.PRUNE_SIMILAR_SQL, (install, "clarify", 20000)),
+    }
+
+
+def _seq_scans(plan: Dict[str, Any]) -> List[str]:
+    scans = [plan.get("Relation Name", "?")] if plan.get("Node Type") == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        scans += _seq_scans(child)
+    return scans
+
+
+def check_query_plans(conn) -> Dict[str, List[str]]:
+    """
+    EXPLAIN every hot query with sequential scans disabled; any Seq Scan
+    left in a plan means no index can serve it. Returns the tables
+    seq-scanned per query (empty lists when all is well).
+    """
+    results = {}
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, (query, params) in hot_queries().items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()['QUERY PLAN']
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            results[name] = _seq_scans(plan[0]["Plan"])
+    finally:
+        conn.rollback()
+    return results
@@ -0,0 +1,181 @@
+# near_duplicates.py - MinHash/LSH index of near-duplicate tickets, per install
+import re
+import time
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def shingles(text: str, size: int = 3) -> Set[str]:
+    """Word n-grams of the text, lowercased with punctuation and spacing ignored"""
+    words = WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def lsh_bands(threshold: float, num_perm: int, false_negative_weight: float = 0.9) -> Tuple[int, int]:
+    """
+    (bands, rows) splitting num_perm hashes so that pairs at the threshold
+    similarity become candidates, minimizing the weighted false positive and
+    false negative probability mass. Candidates are verified afterwards, so a
+    false positive only costs a comparison and misses are weighted up.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        below = np.linspace(0, threshold, 100)
+        above = np.linspace(threshold, 1, 100)
+        false_positive = np.trapezoid(1 - (1 - below ** rows) ** bands, below)
+        false_negative = np.trapezoid((1 - above ** rows) ** bands, above)
+        error = (1 - false_negative_weight) * false_positive + false_negative_weight * false_negative
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """
+    num_perm MinHash values per shingle set. Each "permutation" is a
+    multiply-shift hash of the shingle's CRC32: the high 32 bits of
+    a * h + b mod 2**64, which numpy computes with wrapping uint64
+    arithmetic and no modulo.
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64, endpoint=False) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64, endpoint=False)
+
+    def signature(self, shingle_set: Set[str]) -> np.ndarray:
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingle_set), dtype=np.uint64, count=len(shingle_set))
+        permuted = (hashes[:, None] * self.a + self.b) >> np.uint64(32)
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+class _Scope:
+    def __init__(self, bands: int):
+        self.entries: "OrderedDict[bytes, Tuple[np.ndarray, Any]]" = OrderedDict()  # oldest first
+        self.buckets: List[Dict[bytes, Set[bytes]]] = [{} for _ in range(bands)]
+
+
+class NearDuplicateIndex:
+    """
+    Finds a stored ticket whose word shingles overlap a new one's by at
+    least threshold (Jaccard similarity, estimated from MinHash signatures)
+    and returns the value stored with it, e.g. its result cache key.
+
+    Templated tickets that differ in a few words miss an exact-hash cache
+    but land in the same LSH bucket in at least one band. A lookup is one
+    signature, a few dict lookups and a comparison with the bucketed
+    candidates, well under a millisecond, with no model or network call.
+    Entries are kept per scope (install), at most max_per_scope of them,
+    oldest dropped first; the index is in-process, so each replica learns
+    from the tickets it serves.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, shingle_size: int = 3, max_per_scope: int = 5000):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_per_scope = max_per_scope
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        self._scopes: Dict[str, _Scope] = {}
+        self._lock = threading.Lock()
+
+        # Counters
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_seconds = 0.0
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def _signature(self, text: str) -> Optional[Tuple[bytes, np.ndarray]]:
+        shingle_set = shingles(text, self.shingle_size)
+        if not shingle_set:
+            return None
+        # Same shingles (the same words, whatever the case and punctuation): same entry
+        entry_id = hashlib.blake2b(" ".join(sorted(shingle_set)).encode(), digest_size=16).digest()
+        return entry_id, self.hasher.signature(shingle_set)
+
+    def add(self, scope: str, text: str, value: Any):
+        """Index a ticket's text with the value to return for its near-duplicates"""
+        signed = self._signature(text)
+        if signed is None:
+            return
+        entry_id, signature = signed
+        with self._lock:
+            space = self._scopes.get(scope)
+            if space is None:
+                space = self._scopes[scope] = _Scope(self.bands)
+            if entry_id in space.entries:
+                space.entries[entry_id] = (signature, value)
+                space.entries.move_to_end(entry_id)
+                return
+            if len(space.entries) >= self.max_per_scope:
+                self._remove(space, next(iter(space.entries)))
+            space.entries[entry_id] = (signature, value)
+            for bucket, key in zip(space.buckets, self._band_keys(signature)):
+                bucket.setdefault(key, set()).add(entry_id)
+
+    def _remove(self, space: _Scope, entry_id: bytes):
+        signature, _ = space.entries.pop(entry_id)
+        for bucket, key in zip(space.buckets, self._band_keys(signature)):
+            ids = bucket.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del bucket[key]
+
+    def find(self, scope: str, text: str) -> Optional[Tuple[Any, float]]:
+        """(value, estimated similarity) of the most similar stored ticket at the threshold, or None"""
+        start = time.perf_counter()
+        signed = self._signature(text)
+        best = None
+        with self._lock:
+            space = self._scopes.get(scope)
+            if signed is not None and space is not None:
+                _, signature = signed
+                candidates = set()
+                for bucket, key in zip(space.buckets, self._band_keys(signature)):
+                    candidates.update(bucket.get(key, ()))
+                if candidates:
+                    # Templated tickets share buckets, so verify all candidates in one pass
+                    entries = [space.entries[entry_id] for entry_id in candidates]
+                    stored = np.stack([entry[0] for entry in entries])
+                    similarities = np.count_nonzero(stored == signature, axis=1) / len(signature)
+                    top = int(np.argmax(similarities))
+                    if similarities[top] >= self.threshold:
+                        best = (entries[top][1], float(similarities[top]))
+            self.lookups += 1
+            self.hits += best is not None
+            self.lookup_seconds += time.perf_counter() - start
+        return best
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "scopes": len(self._scopes),
+                "entries": sum(len(space.entries) for space in self._scopes.values()),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "avgLookupUs": round(self.lookup_seconds / self.lookups * 1e6, 1) if self.lookups else 0,
+                "threshold": self.threshold,
+                "bands": self.bands,
+                "rows": self.rows,
+            }
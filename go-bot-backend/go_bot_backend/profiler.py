@@ -0,0 +1,190 @@
+# profiler.py - Opt-in sampling profiler for individual slow requests
+import os
+import re
+import sys
+import time
+import random
+import asyncio
+import secrets
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+def _fold(frame) -> str:
+    """One stack as a folded line (root first), the flamegraph/speedscope input format"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _noop():
+    pass
+
+
+class RequestProfile:
+    """Stack samples for one request, and the tasks and threads working on it"""
+
+    def __init__(self, loop, task):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.tasks = {task} if task else set()
+        self.threads = Counter()
+        self.samples = Counter()
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """
+        Count the calling task (on the event loop) or thread (threadpool
+        calls) as working for this request; returns the function that
+        detaches a thread again. Called by timing.span().
+        """
+        ident = threading.get_ident()
+        if ident == self.loop_thread:
+            try:
+                task = asyncio.current_task()
+            except RuntimeError:
+                task = None
+            if task is not None:
+                with self._lock:
+                    self.tasks.add(task)
+            return _noop
+
+        with self._lock:
+            self.threads[ident] += 1
+
+        def release():
+            with self._lock:
+                self.threads[ident] -= 1
+                if self.threads[ident] <= 0:
+                    del self.threads[ident]
+        return release
+
+    def sample(self, frames: Dict[int, Any]):
+        with self._lock:
+            threads = list(self.threads)
+            tasks = set(self.tasks)
+        stacks = [frames.get(ident) for ident in threads]
+        # The loop is only sampled while one of this request's tasks runs on it
+        if asyncio.current_task(self.loop) in tasks:
+            stacks.append(frames.get(self.loop_thread))
+        for frame in stacks:
+            if frame is not None:
+                self.samples[_fold(frame)] += 1
+
+
+class SamplingProfiler:
+    """
+    Samples Python stacks every interval seconds from a background thread,
+    but only while a profiled request is in flight, and only the stacks
+    doing that request's work: its tasks when they run on the event loop
+    and the threadpool threads inside its timing spans.
+
+    A request is profiled when it sends `X-Profile: <token>` (always
+    dumped), or at random with probability sample_rate (dumped only if it
+    took at least slow_ms). Dumps are folded stack files in output_dir,
+    ready for flamegraph.pl or speedscope. At most max_active requests are
+    profiled at once, which bounds the overhead.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.005,
+        sample_rate: float = 0.0,
+        token: Optional[str] = None,
+        slow_ms: float = 2000,
+        output_dir: str = "profiles",
+        max_active: int = 4,
+    ):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.token = token
+        self.slow_ms = slow_ms
+        self.output_dir = output_dir
+        self.max_active = max_active
+
+        self._active = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        # Counters
+        self.profiled = 0
+        self.dumped = 0
+        self.skipped = 0
+
+    def should_profile(self, scope) -> Optional[str]:
+        """Why to profile an incoming ASGI request: "forced", "sampled" or None"""
+        if self.token:
+            for name, value in scope.get("headers", []):
+                if name == b"x-profile":
+                    if secrets.compare_digest(value, self.token.encode()):
+                        return "forced"
+                    break
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def begin(self, timer, task):
+        """Start sampling the request that owns timer"""
+        with self._lock:
+            if len(self._active) >= self.max_active:
+                self.skipped += 1
+                return
+            profile = RequestProfile(asyncio.get_running_loop(), task)
+            self._active.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        timer.profile = profile
+        self._wakeup.set()
+
+    def end(self, timer, route: str, total_ms: float, force: bool) -> Optional[str]:
+        """Stop sampling; write the profile if forced or slow and return its path"""
+        profile, timer.profile = timer.profile, None
+        if profile is None:
+            return None
+        with self._lock:
+            self._active.discard(profile)
+            self.profiled += 1
+        if not profile.samples or (not force and total_ms < self.slow_ms):
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        path = os.path.join(self.output_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{name}-{int(total_ms)}ms.folded")
+        with open(path, "w") as f:
+            for stack, count in profile.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with self._lock:
+            self.dumped += 1
+        return path
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                active = list(self._active)
+                if not active:
+                    self._wakeup.clear()
+                    continue
+            frames = sys._current_frames()
+            for profile in active:
+                profile.sample(frames)
+            del frames
+            time.sleep(self.interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """Profiled/dumped counts (exposed on /health)"""
+        with self._lock:
+            return {
+                "active": len(self._active),
+                "profiled": self.profiled,
+                "dumped": self.dumped,
+                "skipped": self.skipped,
+                "sampleRate": self.sample_rate,
+            }
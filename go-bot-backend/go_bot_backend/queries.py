@@ -0,0 +1,96 @@
+# queries.py - Statements run by app.py and rag.py, shared with the query plan checks
+#
+# Kept free of optional dependencies (rag.py needs numpy) so the deploy-time
+# plan check runs on any install.
+
+
+# An install switching keys gives up the keys it activated before (install, new key_code)
+DEACTIVATE_OLD_KEYS_SQL = """
+    UPDATE license_keys
+    SET is_active = false,
+        updated_at = NOW(),
+        activated_at = NULL
+    WHERE install = %s
+    AND key_code != %s
+    AND activated_at IS NOT NULL
+    RETURNING key_code
+"""
+
+# The key bought with a PaymentIntent (payment_intent_id)
+LICENSE_BY_PAYMENT_INTENT_SQL = """
+    SELECT
+        key_code,
+        customer_email,
+        plan,
+        gobot_limit,
+        gobot_used,
+        created_at,
+        usage_resets_at,
+        key_email_sent_at
+    FROM license_keys
+    WHERE stripe_payment_intent_id = %s
+"""
+
+# A renewal starts a new usage window (subscription_id)
+RENEW_SUBSCRIPTION_SQL = """
+    UPDATE license_keys
+    SET gobot_used = 0,
+        usage_resets_at = NOW() + INTERVAL '1 month',
+        subscription_status = 'active',
+        updated_at = NOW()
+    WHERE stripe_subscription_id = %s
+    RETURNING key_code
+"""
+
+# Deleted subscriptions deactivate their keys (subscription_id)
+CANCEL_SUBSCRIPTION_SQL = """
+    UPDATE license_keys
+    SET is_active = false,
+        subscription_status = 'canceled',
+        updated_at = NOW()
+    WHERE stripe_subscription_id = %s
+    RETURNING key_code, install
+"""
+
+# Keys follow their subscription's status (status, status, subscription_id)
+SUBSCRIPTION_STATUS_SQL = """
+    UPDATE license_keys
+    SET subscription_status = %s,
+        is_active = %s IN ('active', 'trialing'),
+        updated_at = NOW()
+    WHERE stripe_subscription_id = %s
+    RETURNING key_code, install
+"""
+
+# Creates, reactivates or returns an email's free key (key_code, email, gobot_limit)
+FREE_KEY_UPSERT_SQL = """
+    INSERT INTO license_keys
+    (key_code, customer_email, plan, gobot_limit, gobot_used,
+     usage_resets_at, subscription_status, is_active)
+    VALUES (%s, %s, 'free', %s, 0, NOW() + INTERVAL '1 month', 'active', true)
+    ON CONFLICT (customer_email) WHERE plan = 'free'
+    DO UPDATE SET
+        is_active = true,
+        gobot_used = CASE WHEN license_keys.is_active THEN license_keys.gobot_used ELSE 0 END,
+        usage_resets_at = CASE WHEN license_keys.is_active THEN license_keys.usage_resets_at
+                               ELSE NOW() + INTERVAL '1 month' END,
+        updated_at = CASE WHEN license_keys.is_active THEN license_keys.updated_at ELSE NOW() END
+    RETURNING key_code, install, gobot_limit, gobot_used,
+              (xmax = 0) AS inserted,
+              (xmax <> 0 AND updated_at = NOW()) AS reactivated
+"""
+
+# Stored results of retrieved tickets (ids)
+SIMILAR_OUTPUTS_SQL = "SELECT id, output FROM similar_tickets WHERE id = ANY(%s)"
+
+# Deletes all but the newest rows of an install and kind (install, kind, rows kept)
+PRUNE_SIMILAR_SQL = """
+    DELETE FROM similar_tickets
+    WHERE id IN (
+        SELECT id FROM similar_tickets
+        WHERE install = %s AND kind = %s
+        ORDER BY created_at DESC
+        OFFSET %s
+    )
+    RETURNING id
+"""
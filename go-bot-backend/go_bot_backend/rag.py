@@ -0,0 +1,374 @@
+# rag.py - Similar past tickets per install: embeddings, pluggable vector index, stored results
+import re
+import json
+import time
+import zlib
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from psycopg2.extras import Json
+
+from go_bot_backend.db import DatabasePool, timed_query
+from go_bot_backend.queries import PRUNE_SIMILAR_SQL, SIMILAR_OUTPUTS_SQL
+
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+# Too common in tickets to say anything about similarity
+STOP_WORDS = frozenset("""
+a all an and any are as at be by can for from has have i if in into is it not of on or our
+should so than that the then this to we when will with
+""".split())
+
+
+class HashingEmbedder:
+    """
+    Embeds text without a model or network call: word unigrams, bigrams and
+    character trigrams are hashed into dim signed buckets, then the vector
+    is L2-normalized, so a dot product is the cosine similarity. Good at
+    near-duplicates (the same ticket reworded, re-filed or edited), which is
+    what reuse needs; it knows no synonyms.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[Tuple[str, float]]:
+        words = [word for word in TOKEN.findall(text.lower()) if word not in STOP_WORDS]
+        features = [(word, 1.0) for word in words]
+        features += [(f"{a} {b}", 1.0) for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [(padded[i:i + 3], 0.25) for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """(len(texts), dim) float32 unit vectors (all zeros for empty text)"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self._features(text)
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(feature.encode()) for feature, _ in features), dtype=np.uint64, count=len(features))
+            weights = np.fromiter((weight for _, weight in features), dtype=np.float32, count=len(features))
+            signs = np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], (hashes % self.dim).astype(np.intp), signs * weights)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class IndexMatch(NamedTuple):
+    id: str
+    score: float
+    metadata: Dict[str, Any]
+
+
+class VectorIndex(ABC):
+    """
+    Nearest-neighbour index over unit vectors, partitioned by namespace.
+    Implementations: LocalVectorIndex (in-process, NumPy) and
+    PineconeVectorIndex. persistent is False when vectors are lost on
+    restart and have to be reloaded.
+    """
+
+    persistent = False
+
+    @abstractmethod
+    def upsert(self, namespace: str, items: Sequence[Tuple[str, np.ndarray, Dict[str, Any]]]):
+        """Add or replace (id, vector, metadata) items"""
+
+    @abstractmethod
+    def query(self, namespace: str, vector: np.ndarray, top_k: int) -> List[IndexMatch]:
+        """The top_k most similar vectors, best first"""
+
+    @abstractmethod
+    def delete(self, namespace: str, ids: Sequence[str]):
+        """Remove ids; ones that aren't there are ignored"""
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": type(self).__name__}
+
+
+class _Namespace:
+    def __init__(self, dim: int, capacity: int):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.rows: "OrderedDict[str, int]" = OrderedDict()  # id -> row, oldest first
+        self.ids: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+
+
+class LocalVectorIndex(VectorIndex):
+    """
+    Exact (brute-force) cosine search over a NumPy matrix per namespace.
+    One matrix-vector product scores a whole install's tickets, well under
+    a millisecond at the few thousand tickets an install has. Each
+    namespace keeps at most max_per_namespace vectors, dropping the oldest.
+    """
+
+    def __init__(self, dim: int, max_per_namespace: int = 20000):
+        self.dim = dim
+        self.max_per_namespace = max_per_namespace
+        self._namespaces: Dict[str, _Namespace] = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, namespace: str, items: Sequence[Tuple[str, np.ndarray, Dict[str, Any]]]):
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            if space is None:
+                space = self._namespaces[namespace] = _Namespace(self.dim, 16)
+            for id, vector, metadata in items:
+                row = space.rows.get(id)
+                if row is not None:
+                    space.rows.move_to_end(id)
+                else:
+                    if len(space.ids) >= self.max_per_namespace:
+                        self._remove(space, next(iter(space.rows)))
+                    row = len(space.ids)
+                    if row == len(space.vectors):
+                        grown = np.zeros((min(2 * row, self.max_per_namespace), self.dim), dtype=np.float32)
+                        grown[:row] = space.vectors
+                        space.vectors = grown
+                    space.rows[id] = row
+                    space.ids.append(id)
+                    space.metadata.append(metadata)
+                space.vectors[row] = vector
+                space.metadata[row] = metadata
+
+    def _remove(self, space: _Namespace, id: str):
+        """Delete id by moving the last row into its slot"""
+        row = space.rows.pop(id)
+        last = len(space.ids) - 1
+        if row != last:
+            moved = space.ids[last]
+            space.vectors[row] = space.vectors[last]
+            space.ids[row] = moved
+            space.metadata[row] = space.metadata[last]
+            space.rows[moved] = row
+        space.ids.pop()
+        space.metadata.pop()
+
+    def query(self, namespace: str, vector: np.ndarray, top_k: int) -> List[IndexMatch]:
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            if space is None or not space.ids:
+                return []
+            scores = space.vectors[:len(space.ids)] @ vector
+            k = min(top_k, len(scores))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [IndexMatch(space.ids[row], float(scores[row]), space.metadata[row]) for row in best]
+
+    def delete(self, namespace: str, ids: Sequence[str]):
+        with self._lock:
+            space = self._namespaces.get(namespace)
+            for id in ids:
+                if space is not None and id in space.rows:
+                    self._remove(space, id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "type": "local",
+                "namespaces": len(self._namespaces),
+                "vectors": sum(len(space.ids) for space in self._namespaces.values()),
+            }
+
+
+class PineconeVectorIndex(VectorIndex):
+    """
+    Pinecone serverless index (created with the embedder's dimension and
+    the cosine metric). Vectors survive restarts, so nothing is reloaded.
+    """
+
+    persistent = True
+
+    def __init__(self, api_key: str, index_name: str):
+        # Imported here so the SDK is only loaded when Pinecone is used; it is
+        # an optional dependency (pip install "go-bot-backend[pinecone]")
+        from pinecone import Pinecone
+        self.index_name = index_name
+        self.index = Pinecone(api_key=api_key).Index(index_name)
+
+    def upsert(self, namespace: str, items: Sequence[Tuple[str, np.ndarray, Dict[str, Any]]]):
+        self.index.upsert(
+            vectors=[{"id": id, "values": vector.tolist(), "metadata": metadata} for id, vector, metadata in items],
+            namespace=namespace,
+        )
+
+    def query(self, namespace: str, vector: np.ndarray, top_k: int) -> List[IndexMatch]:
+        result = self.index.query(namespace=namespace, vector=vector.tolist(), top_k=top_k, include_metadata=True)
+        return [IndexMatch(match.id, float(match.score), match.metadata or {}) for match in result.matches]
+
+    def delete(self, namespace: str, ids: Sequence[str]):
+        self.index.delete(ids=list(ids), namespace=namespace)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": "pinecone", "index": self.index_name}
+
+
+class SimilarTicket(NamedTuple):
+    id: str
+    score: float
+    text: str
+    output: str  # Stored result, as JSON
+
+
+class SimilarTickets:
+    """
+    Past tickets and their generated results, searchable by similarity
+    within one install and kind ("clarify", "gen-code"), so one team's
+    tickets never inform another's.
+
+    Vectors live in the index (namespace "<kind>:<install>"); texts and
+    results live in Postgres when there is a database, which is also what
+    a LocalVectorIndex is reloaded from on startup. Without a database the
+    result is kept in the vector's metadata instead. Each install and kind
+    keeps its newest max_per_install tickets; older rows are deleted, and
+    their vectors with them, as new ones are added.
+    """
+
+    TEXT_CHARS = 2000  # Of the ticket text kept for prompts and metadata
+
+    def __init__(
+        self,
+        embedder: HashingEmbedder,
+        index: VectorIndex,
+        db: Optional[DatabasePool] = None,
+        top_k: int = 3,
+        min_similarity: float = 0.5,
+        reuse_similarity: float = 0.95,
+        max_per_install: int = 20000,
+    ):
+        self.embedder = embedder
+        self.index = index
+        self.db = db
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.reuse_similarity = reuse_similarity
+        self.max_per_install = max_per_install
+        self._lock = threading.Lock()
+
+        # Counters
+        self.searches = 0
+        self.reused = 0
+        self.enriched = 0
+        self.added = 0
+        self.pruned = 0
+        self.search_seconds = 0.0
+
+    @staticmethod
+    def _namespace(install: str, kind: str) -> str:
+        return f"{kind}:{install}"
+
+    @staticmethod
+    def document_id(install: str, kind: str, text: str) -> str:
+        """Same install, kind and text (up to whitespace and case): same document"""
+        normalized = " ".join(text.lower().split())
+        return hashlib.sha256(f"{kind}\0{install}\0{normalized}".encode()).hexdigest()[:32]
+
+    def add(self, install: str, kind: str, text: str, output: str) -> str:
+        """Store a generated result (JSON) for a ticket; a repeat of the same ticket replaces it"""
+        id = self.document_id(install, kind, text)
+        metadata = {"text": text[:self.TEXT_CHARS]}
+        pruned = []
+        if self.db:
+            with self.db.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    INSERT INTO similar_tickets (id, install, kind, text, output)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (id) DO UPDATE SET output = EXCLUDED.output, created_at = NOW()
+                """, (id, install, kind, text, Json(json.loads(output))))
+                with timed_query("prune similar tickets"):
+                    cur.execute(PRUNE_SIMILAR_SQL, (install, kind, self.max_per_install))
+                pruned = [row['id'] for row in cur.fetchall()]
+                conn.commit()
+        else:
+            metadata["output"] = output
+        vector = self.embedder.embed([text])[0]
+        namespace = self._namespace(install, kind)
+        self.index.upsert(namespace, [(id, vector, metadata)])
+        if pruned:
+            self.index.delete(namespace, pruned)
+        with self._lock:
+            self.added += 1
+            self.pruned += len(pruned)
+        return id
+
+    def search(self, install: str, kind: str, text: str) -> Tuple[Optional[SimilarTicket], List[SimilarTicket]]:
+        """
+        (reusable, similar) for a new ticket: reusable is a past ticket at
+        least reuse_similarity alike, whose result can be returned as is;
+        similar are the top_k at least min_similarity alike, best first.
+        """
+        start = time.perf_counter()
+        vector = self.embedder.embed([text])[0]
+        matches = [
+            match for match in self.index.query(self._namespace(install, kind), vector, self.top_k)
+            if match.score >= self.min_similarity
+        ]
+        outputs = {match.id: match.metadata.get("output") for match in matches}
+        if matches and self.db:
+            with self.db.connection() as conn:
+                cur = conn.cursor()
+                with timed_query("similar ticket outputs"):
+                    cur.execute(SIMILAR_OUTPUTS_SQL, ([match.id for match in matches],))
+                outputs.update((row['id'], json.dumps(row['output'])) for row in cur.fetchall())
+        similar = [
+            SimilarTicket(match.id, match.score, match.metadata.get("text", ""), outputs[match.id])
+            for match in matches if outputs.get(match.id)
+        ]
+        reusable = similar[0] if similar and similar[0].score >= self.reuse_similarity else None
+
+        with self._lock:
+            self.searches += 1
+            self.search_seconds += time.perf_counter() - start
+            if reusable:
+                self.reused += 1
+            elif similar:
+                self.enriched += 1
+        return reusable, similar
+
+    def load(self, limit: int = 100000, batch_size: int = 1000) -> int:
+        """Re-embed the newest stored tickets into a non-persistent index"""
+        if not self.db or self.index.persistent:
+            return 0
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, install, kind, text FROM similar_tickets
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (limit,))
+            rows = cur.fetchall()
+        # Oldest first, so the newest are kept if a namespace overflows
+        rows.reverse()
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            vectors = self.embedder.embed([row['text'] for row in batch])
+            by_namespace: Dict[str, list] = {}
+            for row, vector in zip(batch, vectors):
+                by_namespace.setdefault(self._namespace(row['install'], row['kind']), []).append(
+                    (row['id'], vector, {"text": row['text'][:self.TEXT_CHARS]})
+                )
+            for namespace, items in by_namespace.items():
+                self.index.upsert(namespace, items)
+        return len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "index": self.index.stats(),
+                "searches": self.searches,
+                "reused": self.reused,
+                "enriched": self.enriched,
+                "added": self.added,
+                "pruned": self.pruned,
+                "avgSearchMs": round(self.search_seconds / self.searches * 1000, 2) if self.searches else 0,
+                "reuseSimilarity": self.reuse_similarity,
+            }
@@ -0,0 +1,341 @@
+# stripe_events.py - Durable outbox for verified Stripe webhook events
+import time
+import asyncio
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from psycopg2.extras import Json
+
+from go_bot_backend.db import DatabasePool, timed_query
+
+
+EventHandler = Callable[[Dict[str, Any]], Any]
+
+# The oldest runnable event whose predecessors (same ordering key) have all finished
+CLAIM_EVENT_SQL = """
+    UPDATE stripe_events
+    SET status = 'processing',
+        attempts = attempts + 1,
+        lease_expires_at = NOW() + make_interval(secs => %s)
+    WHERE event_id = (
+        SELECT e.event_id FROM stripe_events e
+        WHERE e.status IN ('pending', 'processing')
+        AND (
+            (e.status = 'pending' AND e.available_at <= NOW())
+            OR (e.status = 'processing' AND e.lease_expires_at < NOW())
+        )
+        AND NOT EXISTS (
+            SELECT 1 FROM stripe_events earlier
+            WHERE earlier.ordering_key = e.ordering_key
+            AND earlier.status IN ('pending', 'processing')
+            AND (earlier.stripe_created, earlier.received_at, earlier.event_id)
+                < (e.stripe_created, e.received_at, e.event_id)
+        )
+        ORDER BY e.stripe_created, e.received_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING event_id, event_type, payload, attempts
+"""
+
+
+def ordering_key(event: Dict[str, Any]) -> str:
+    """
+    Events sharing a key are applied one at a time, oldest first. The Stripe
+    customer covers all of its subscriptions, including the one created while
+    handling its payment_intent.succeeded, so a subscription update can't be
+    applied before the license it updates exists.
+    """
+    obj = event.get('data', {}).get('object', {}) or {}
+    customer = obj.get('customer')
+    if isinstance(customer, dict):
+        customer = customer.get('id')
+    if customer:
+        return f"customer:{customer}"
+    subscription = obj.get('subscription') or (obj.get('id') if obj.get('object') == 'subscription' else None)
+    if subscription:
+        return f"subscription:{subscription}"
+    return f"event:{event['id']}"
+
+
+class StripeEventOutbox:
+    """
+    Stripe webhook events, persisted before they are acknowledged.
+
+    The webhook handler only verifies the signature and calls record(): the
+    event id is the primary key of stripe_events, so redeliveries are
+    dropped there, and Stripe gets its 2xx after one INSERT. Workers then
+    claim events with FOR UPDATE SKIP LOCKED, but only the oldest unfinished
+    event of each ordering key, so events for one customer are applied in
+    Stripe's order while different customers proceed in parallel. A worker
+    holds a lease that a heartbeat extends while the handler runs, so only
+    a dead worker's event is claimed again. Failures are retried with
+    exponential backoff (holding back later events for the same key) until
+    max_attempts, after which the event is marked failed.
+    """
+
+    def __init__(
+        self,
+        db: DatabasePool,
+        handler: EventHandler,
+        workers: int = 2,
+        lease_seconds: int = 300,
+        max_attempts: int = 8,
+        retry_base: float = 5.0,
+        retention_days: int = 30,
+        poll_interval: float = 5.0,
+    ):
+        self.db = db
+        self.handler = handler
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retention_days = retention_days
+        self.poll_interval = poll_interval
+
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._busy = 0
+        self._last_prune = 0.0
+
+        # Metrics
+        self._lock = threading.Lock()
+        self._received = 0
+        self._duplicates = 0
+        self._processed = 0
+        self._retried = 0
+        self._failed = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    # ------------------------------------------------------------------
+    # Database operations (blocking - run in a thread)
+    # ------------------------------------------------------------------
+
+    def record(self, event: Dict[str, Any]) -> bool:
+        """Persist a verified event; False if it was already received"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            with timed_query("store stripe event"):
+                cur.execute("""
+                    INSERT INTO stripe_events (event_id, event_type, ordering_key, stripe_created, payload)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (event_id) DO NOTHING
+                    RETURNING event_id
+                """, (
+                    event['id'],
+                    event['type'],
+                    ordering_key(event),
+                    datetime.fromtimestamp(event.get('created') or time.time()),
+                    Json(event),
+                ))
+            inserted = cur.fetchone() is not None
+            conn.commit()
+
+        with self._lock:
+            if inserted:
+                self._received += 1
+            else:
+                self._duplicates += 1
+        return inserted
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Claim the oldest runnable event whose predecessors have all finished"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+
+            # Events that keep crashing their worker are given up on
+            cur.execute("""
+                UPDATE stripe_events
+                SET status = 'failed',
+                    error = 'Worker lease expired too many times',
+                    processed_at = NOW(),
+                    lease_expires_at = NULL
+                WHERE status = 'processing'
+                AND lease_expires_at < NOW()
+                AND attempts >= %s
+            """, (self.max_attempts,))
+
+            with timed_query("claim next stripe event"):
+                cur.execute(CLAIM_EVENT_SQL, (self.lease_seconds,))
+            event = cur.fetchone()
+            conn.commit()
+            return event
+
+    def _extend_lease(self, event_id: str):
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE stripe_events
+                SET lease_expires_at = NOW() + make_interval(secs => %s)
+                WHERE event_id = %s AND status = 'processing'
+            """, (self.lease_seconds, event_id))
+            conn.commit()
+
+    def _finish(self, event_id: str) -> float:
+        """Mark an event processed; returns seconds since it was received"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE stripe_events
+                SET status = 'processed',
+                    error = NULL,
+                    processed_at = NOW(),
+                    lease_expires_at = NULL
+                WHERE event_id = %s
+                RETURNING EXTRACT(EPOCH FROM processed_at - received_at) AS lag_seconds
+            """, (event_id,))
+            row = cur.fetchone()
+            conn.commit()
+        return float(row['lag_seconds']) if row else 0.0
+
+    def _fail(self, event_id: str, attempts: int, error: str) -> bool:
+        """Schedule a retry, or give up after max_attempts; True if it will be retried"""
+        retry = attempts < self.max_attempts
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            if retry:
+                cur.execute("""
+                    UPDATE stripe_events
+                    SET status = 'pending',
+                        error = %s,
+                        available_at = NOW() + make_interval(secs => %s),
+                        lease_expires_at = NULL
+                    WHERE event_id = %s
+                """, (error, self.retry_base * 2 ** (attempts - 1), event_id))
+            else:
+                cur.execute("""
+                    UPDATE stripe_events
+                    SET status = 'failed',
+                        error = %s,
+                        processed_at = NOW(),
+                        lease_expires_at = NULL
+                    WHERE event_id = %s
+                """, (error, event_id))
+            conn.commit()
+        return retry
+
+    def _prune(self) -> int:
+        """Forget processed events after retention_days (Stripe stops redelivering after 3)"""
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                DELETE FROM stripe_events
+                WHERE status = 'processed'
+                AND processed_at < NOW() - make_interval(days => %s)
+            """, (self.retention_days,))
+            conn.commit()
+            return cur.rowcount
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+
+    def notify(self):
+        """Wake idle workers after record() instead of waiting for the next poll"""
+        self._wakeup.set()
+
+    async def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"✅ Stripe event outbox started with {self.workers} workers")
+
+    async def stop(self, timeout: float = 10.0):
+        """Let in-flight events finish (up to timeout), then stop the workers"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _heartbeat(self, event_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._extend_lease, event_id)
+            except Exception as e:
+                print(f"⚠️  Lease renewal failed for Stripe event {event_id}: {e}")
+
+    async def _worker(self, worker_id: int):
+        while not self._stopping:
+            if worker_id == 0 and time.monotonic() - self._last_prune > 3600:
+                self._last_prune = time.monotonic()
+                try:
+                    pruned = await asyncio.to_thread(self._prune)
+                    if pruned:
+                        print(f"🧹 Pruned {pruned} processed Stripe events")
+                except Exception as e:
+                    print(f"⚠️  Stripe event prune failed: {e}")
+
+            try:
+                event = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                print(f"⚠️  Stripe event worker {worker_id} could not claim: {e}")
+                event = None
+
+            if not event:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._busy += 1
+            try:
+                await self._run(event)
+            except Exception as e:
+                # Its lease expires and the event is retried; this worker carries on
+                print(f"⚠️  Stripe event worker {worker_id} could not finish event {event['event_id']}: {e}")
+            finally:
+                self._busy -= 1
+
+    async def _run(self, event: Dict[str, Any]):
+        event_id = event['event_id']
+        # A handler slower than the lease must not be claimed again by another worker
+        heartbeat = asyncio.create_task(self._heartbeat(event_id))
+        error = None
+        try:
+            await asyncio.to_thread(self.handler, event['payload'])
+        except Exception as e:
+            error = str(getattr(e, 'detail', None) or e)
+        finally:
+            heartbeat.cancel()
+
+        if error is not None:
+            retry = await asyncio.to_thread(self._fail, event_id, event['attempts'], error)
+            with self._lock:
+                if retry:
+                    self._retried += 1
+                else:
+                    self._failed += 1
+            print(f"❌ Stripe event {event_id} ({event['event_type']}) failed on attempt {event['attempts']}"
+                  f"{', will retry' if retry else ', giving up'}: {error}")
+            return
+
+        lag = await asyncio.to_thread(self._finish, event_id)
+        with self._lock:
+            self._processed += 1
+            self._lag_total += lag
+            self._lag_max = max(self._lag_max, lag)
+
+    def stats(self) -> Dict[str, Any]:
+        """In-process outbox metrics (exposed on /health)"""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busyWorkers": self._busy,
+                "received": self._received,
+                "duplicates": self._duplicates,
+                "processed": self._processed,
+                "retried": self._retried,
+                "failed": self._failed,
+                "avgLagSeconds": round(self._lag_total / self._processed, 3) if self._processed else 0.0,
+                "maxLagSeconds": round(self._lag_max, 3),
+            }
@@ -0,0 +1,77 @@
+# structured.py - Tool-use structured output and incremental parsing of its JSON
+import json
+from typing import Any, Dict, List, Tuple
+
+
+def list_fields_tool(name: str, description: str, fields: Dict[str, str]) -> Dict[str, Any]:
+    """Tool definition whose input is an object of required string arrays"""
+    return {
+        "name": name,
+        "description": description,
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                field: {"type": "array", "items": {"type": "string"}, "description": field_description}
+                for field, field_description in fields.items()
+            },
+            "required": list(fields),
+        },
+    }
+
+
+def forced_tool_choice(tool: Dict[str, Any]) -> Dict[str, Any]:
+    """tool_choice that makes Claude answer with exactly this tool call"""
+    return {"type": "tool", "name": tool["name"]}
+
+
+class StreamingArrayParser:
+    """
+    Incremental parser for a JSON object of string arrays, such as the input
+    of a list_fields_tool call.
+
+    Feed it the partial_json fragments of a streamed tool call; feed()
+    returns each array item as soon as its closing quote arrives. Parsed
+    items are kept in `items`, so whatever completed before a stream was cut
+    off can still be used.
+    """
+
+    def __init__(self):
+        self.items: Dict[str, List[str]] = {}
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._raw: List[str] = []
+        self._last_key = None  # Last string seen at the top level
+        self._array_key = None  # Top-level key of the array being read
+
+    def feed(self, fragment: str) -> List[Tuple[str, str]]:
+        completed = []
+        for char in fragment:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    value = json.loads('"' + "".join(self._raw) + '"')
+                    if self._depth == 1:
+                        self._last_key = value
+                    elif self._depth == 2 and self._array_key is not None:
+                        self.items.setdefault(self._array_key, []).append(value)
+                        completed.append((self._array_key, value))
+                    continue
+                self._raw.append(char)
+            elif char == '"':
+                self._in_string = True
+                self._raw = []
+            elif char in "[{":
+                if char == "[" and self._depth == 1:
+                    self._array_key = self._last_key
+                    self.items.setdefault(self._array_key, [])
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 1:
+                    self._array_key = None
+        return completed
@@ -0,0 +1,142 @@
+# timing.py - Per-request stage timing: Server-Timing header and timing log records
+import json
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+class RequestTimer:
+    """
+    Time spent per stage (db, claude, cache, ...) by one request.
+
+    Stages are summed when they repeat (every query adds to "db") and may
+    overlap: "claude" covers the whole streamed call, including the "parse"
+    work done while it streams. Spans are recorded from the event loop and
+    from threadpool calls, which copy the request's context.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: Dict[str, list] = {}  # name -> [seconds, count]
+        self.profile = None  # set by SamplingProfiler.begin()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            totals = self.spans.get(name)
+            if totals is None:
+                self.spans[name] = [seconds, 1]
+            else:
+                totals[0] += seconds
+                totals[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Server-Timing header value; total is the time until the response started"""
+        with self._lock:
+            spans = [(name, seconds, count) for name, (seconds, count) in self.spans.items()]
+        entries = [f'{name};dur={seconds * 1000:.1f};desc="{count}x"' for name, seconds, count in spans]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                name: {"ms": round(seconds * 1000, 1), "count": count}
+                for name, (seconds, count) in self.spans.items()
+            }
+
+
+current_timer: ContextVar[Optional[RequestTimer]] = ContextVar("request_timer", default=None)
+
+
+def record_span(name: str, seconds: float):
+    """Add an already measured stage to the current request, if any"""
+    timer = current_timer.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def span(name: str):
+    """Time the with block as a stage of the current request (no-op outside one)"""
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+
+    profile = timer.profile
+    if profile is not None:
+        release = profile.attach()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+        if profile is not None:
+            release()
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware giving every HTTP request a RequestTimer. The
+    Server-Timing header carries the stages finished before the response
+    started (all of them for JSON responses, the setup for streams); the
+    timing log record, one JSON line, is written once the body is done, for
+    requests slower than log_min_ms. With a profiler, selected requests are
+    sampled and slow ones dumped.
+    """
+
+    def __init__(self, app, log_min_ms: float = 1000, profiler=None):
+        self.app = app
+        self.log_min_ms = log_min_ms
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timer = RequestTimer()
+        token = current_timer.set(timer)
+        status = 500
+        reason = self.profiler.should_profile(scope) if self.profiler else None
+        if reason:
+            self.profiler.begin(timer, asyncio.current_task())
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timer.reset(token)
+            total_ms = timer.elapsed() * 1000
+            route = getattr(scope.get("route"), "path", scope["path"])
+            profile_path = None
+            if reason:
+                profile_path = await asyncio.to_thread(self.profiler.end, timer, route, total_ms, reason == "forced")
+            if 0 <= self.log_min_ms <= total_ms or profile_path:
+                record = {
+                    "event": "request_timing",
+                    "time": datetime.now().isoformat(),
+                    "method": scope["method"],
+                    "route": route,
+                    "status": status,
+                    "totalMs": round(total_ms, 1),
+                    "spans": timer.summary(),
+                }
+                if profile_path:
+                    record["profile"] = profile_path
+                print(json.dumps(record), flush=True)
@@ -0,0 +1,376 @@
+# usage.py - Redis hot-path usage counters with write-behind to license_keys
+import time
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from go_bot_backend.db import DatabasePool, timed_query
+
+
+class UsageLimitExceeded(Exception):
+    """Raised when a metered call would go past gobot_limit"""
+
+    def __init__(self, used: int, limit: int):
+        super().__init__(f"Monthly limit of {limit} reached")
+        self.used = used
+        self.limit = limit
+
+
+# A key's monthly usage window has ended (only active subscriptions roll over)
+WINDOW_EXPIRED_SQL = "(usage_resets_at <= NOW() AND subscription_status = 'active')"
+
+# Whole months between the key's reset date and now
+_MONTHS_ELAPSED_SQL = "(EXTRACT(YEAR FROM age(NOW(), usage_resets_at)) * 12 + EXTRACT(MONTH FROM age(NOW(), usage_resets_at)))::int"
+
+# First reset date after now, keeping the key's day of the month (Jan 31 -> Feb 28 -> Mar 31).
+# age() can come up one month short around month ends, hence the second step.
+NEXT_RESET_SQL = f"""(CASE
+    WHEN usage_resets_at + make_interval(months => {_MONTHS_ELAPSED_SQL} + 1) > NOW()
+    THEN usage_resets_at + make_interval(months => {_MONTHS_ELAPSED_SQL} + 1)
+    ELSE usage_resets_at + make_interval(months => {_MONTHS_ELAPSED_SQL} + 2)
+END)"""
+
+# Counts one call unless the key is at its limit, rolling an ended window over (key_code)
+RESERVE_USAGE_SQL = f"""
+    UPDATE license_keys
+    SET gobot_used = CASE WHEN {WINDOW_EXPIRED_SQL} THEN 1 ELSE gobot_used + 1 END,
+        usage_resets_at = CASE WHEN {WINDOW_EXPIRED_SQL} THEN {NEXT_RESET_SQL} ELSE usage_resets_at END,
+        updated_at = NOW()
+    WHERE key_code = %s
+    AND is_active = true
+    AND ({WINDOW_EXPIRED_SQL} OR gobot_used < gobot_limit)
+    RETURNING gobot_used, gobot_limit
+"""
+
+# Rolls over the next batch of ended usage windows, after a (usage_resets_at, id) cursor.
+# Parameters: the cursor's usage_resets_at and id, and the batch size.
+USAGE_SWEEP_SQL = f"""
+    WITH batch AS (
+        SELECT id, usage_resets_at AS swept_from
+        FROM license_keys
+        WHERE is_active = true
+        AND {WINDOW_EXPIRED_SQL}
+        AND (usage_resets_at, id) > (%s, %s)
+        ORDER BY usage_resets_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE license_keys
+    SET gobot_used = 0,
+        usage_resets_at = {NEXT_RESET_SQL},
+        updated_at = NOW()
+    FROM batch
+    WHERE license_keys.id = batch.id
+    RETURNING license_keys.id, license_keys.key_code, batch.swept_from
+"""
+
+
+# KEYS[1] = usage hash, KEYS[2] = dirty set
+# ARGV[1] = key_code, ARGV[2] = enforce limit (1/0), ARGV[3] = max seconds between reloads
+# Returns {status, used, limit}: 1 = counted, -1 = over limit, -2 = (re)load from Postgres first,
+# -3 = usage window ended (flush, then reload so Postgres rolls it over)
+INCREMENT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {-2, 0, 0}
+end
+local used = tonumber(redis.call('HGET', KEYS[1], 'used'))
+local limit = tonumber(redis.call('HGET', KEYS[1], 'limit'))
+local pending = tonumber(redis.call('HGET', KEYS[1], 'pending'))
+local loaded_at = tonumber(redis.call('HGET', KEYS[1], 'loaded_at'))
+local resets_at = tonumber(redis.call('HGET', KEYS[1], 'resets_at') or '0')
+local now = tonumber(redis.call('TIME')[1])
+if resets_at > 0 and now >= resets_at then
+    return {-3, used, limit}
+end
+-- Fully flushed counters are re-read from Postgres now and then, so changes
+-- made behind Redis' back (e.g. while it was down) can't drift forever
+if pending == 0 and now - loaded_at > tonumber(ARGV[3]) then
+    redis.call('DEL', KEYS[1])
+    return {-2, 0, 0}
+end
+if ARGV[2] == '1' and used >= limit then
+    return {-1, used, limit}
+end
+used = redis.call('HINCRBY', KEYS[1], 'used', 1)
+redis.call('HINCRBY', KEYS[1], 'pending', 1)
+redis.call('PERSIST', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+return {1, used, limit}
+"""
+
+# KEYS[1] = usage hash; ARGV[1] = used, ARGV[2] = limit, ARGV[3] = idle ttl,
+# ARGV[4] = seconds until the usage window ends (-1 = never rolls over)
+# Seeds the hash from Postgres unless another replica got there first
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local now = tonumber(redis.call('TIME')[1])
+local resets_at = 0
+if tonumber(ARGV[4]) >= 0 then
+    resets_at = now + math.ceil(tonumber(ARGV[4]))
+end
+redis.call('HSET', KEYS[1], 'used', ARGV[1], 'limit', ARGV[2], 'pending', 0,
+           'loaded_at', now, 'resets_at', resets_at)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# KEYS[1] = usage hash, KEYS[2] = dirty set; ARGV[1] = key_code
+# Gives back one counted call; returns 0 if the counter is gone (refund in Postgres instead)
+REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if tonumber(redis.call('HGET', KEYS[1], 'used')) > 0 then
+    redis.call('HINCRBY', KEYS[1], 'used', -1)
+    redis.call('HINCRBY', KEYS[1], 'pending', -1)
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+# KEYS[1] = usage hash, KEYS[2] = dirty set; ARGV[1] = key_code, ARGV[2] = idle ttl
+# Takes the pending increments out of the hash so they can be written to Postgres
+GRAB_SCRIPT = """
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local pending = tonumber(redis.call('HGET', KEYS[1], 'pending'))
+if pending ~= 0 then
+    redis.call('HINCRBY', KEYS[1], 'pending', -pending)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return pending
+"""
+
+# KEYS[1] = usage hash, KEYS[2] = dirty set; ARGV[1] = key_code, ARGV[2] = keep pending (1/0)
+# Drops a counter so the next call reloads it; returns the pending count it held
+DROP_SCRIPT = """
+local pending = tonumber(redis.call('HGET', KEYS[1], 'pending') or '0')
+if ARGV[2] == '1' and pending ~= 0 then
+    return -1
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+return pending
+"""
+
+
+class UsageCounter:
+    """
+    Per-key usage counters kept in Redis, written behind to license_keys.
+
+    Each key has a hash gobot:usage:{key_code} with `used`, `limit` and
+    `pending` (increments not yet in Postgres). Increment-and-compare is one
+    Lua call, so counts stay correct across replicas without touching
+    Postgres. Keys with pending increments sit in a dirty set and are flushed
+    in one batched UPDATE every flush interval and at shutdown; on_flush is
+    then called with the key codes whose rows changed.
+
+    Monthly usage windows roll over lazily: the hash carries the window's
+    end, and the first increment after it flushes the old window's count
+    and reloads the key, which rolls it over in Postgres.
+    """
+
+    KEY_PREFIX = "gobot:usage:"
+    DIRTY_SET = "gobot:usage:dirty"
+
+    def __init__(
+        self,
+        redis_client,
+        db: DatabasePool,
+        idle_ttl: int = 3600,
+        reload_after: int = 300,
+        on_flush: Optional[Callable[[List[str]], None]] = None,
+    ):
+        self.redis = redis_client
+        self.db = db
+        self.idle_ttl = idle_ttl
+        self.reload_after = reload_after
+        self.on_flush = on_flush
+
+        self._increment = redis_client.register_script(INCREMENT_SCRIPT)
+        self._load = redis_client.register_script(LOAD_SCRIPT)
+        self._refund = redis_client.register_script(REFUND_SCRIPT)
+        self._grab = redis_client.register_script(GRAB_SCRIPT)
+        self._drop = redis_client.register_script(DROP_SCRIPT)
+
+        # Increments grabbed from Redis whose Postgres write failed; retried next flush
+        self._unflushed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, key_code: str) -> str:
+        return f"{self.KEY_PREFIX}{key_code}"
+
+    def _load_from_db(self, key_code: str) -> bool:
+        """
+        Seed the Redis counter from license_keys, first rolling the key's
+        usage window over if it has ended; False for unknown or inactive keys
+        """
+        with self.db.connection() as conn:
+            cur = conn.cursor()
+            with timed_query("usage window rollover"):
+                cur.execute(f"""
+                    UPDATE license_keys
+                    SET gobot_used = 0,
+                        usage_resets_at = {NEXT_RESET_SQL},
+                        updated_at = NOW()
+                    WHERE key_code = %s
+                    AND is_active = true
+                    AND {WINDOW_EXPIRED_SQL}
+                    RETURNING key_code
+                """, (key_code,))
+            rolled_over = cur.fetchone() is not None
+            with timed_query("usage counter load"):
+                cur.execute("""
+                    SELECT gobot_used,
+                           gobot_limit,
+                           CASE WHEN subscription_status = 'active'
+                                THEN EXTRACT(EPOCH FROM usage_resets_at - NOW())
+                           END AS resets_in
+                    FROM license_keys
+                    WHERE key_code = %s
+                    AND is_active = true
+                """, (key_code,))
+            row = cur.fetchone()
+            conn.commit()
+        if rolled_over and self.on_flush:
+            self.on_flush([key_code])
+        if not row:
+            return False
+        resets_in = row['resets_in']
+        args = [row['gobot_used'] or 0, row['gobot_limit'], self.idle_ttl, -1 if resets_in is None else max(0.0, float(resets_in))]
+        self._load(keys=[self._key(key_code)], args=args)
+        return True
+
+    def increment(self, key_code: str, enforce_limit: bool = True) -> Optional[Tuple[int, int]]:
+        """
+        Count one metered call. Returns (used, limit), or None for unknown or
+        inactive keys. Raises UsageLimitExceeded when enforce_limit is set and
+        the key is already at its limit.
+        """
+        keys = [self._key(key_code), self.DIRTY_SET]
+        args = [key_code, 1 if enforce_limit else 0, self.reload_after]
+
+        status, used, limit = self._increment(keys=keys, args=args)
+        if status == -3:
+            # Usage window ended: write what was counted in it, then reload
+            self.invalidate([key_code])
+            status = -2
+        if status == -2:
+            if not self._load_from_db(key_code):
+                return None
+            status, used, limit = self._increment(keys=keys, args=args)
+
+        if status == -3:
+            # The reloaded window ended in the meantime
+            return self.increment(key_code, enforce_limit)
+        if status == -1:
+            raise UsageLimitExceeded(used, limit)
+        return used, limit
+
+    def refund(self, key_code: str) -> bool:
+        """
+        Give back a call counted by increment() whose generation failed.
+        False if the counter is no longer in Redis, in which case the
+        increment already reached Postgres and must be refunded there.
+        """
+        return bool(self._refund(keys=[self._key(key_code), self.DIRTY_SET], args=[key_code]))
+
+    def peek(self, key_code: str) -> Optional[int]:
+        """Live usage count including increments not yet flushed to Postgres"""
+        try:
+            used, resets_at = self.redis.hmget(self._key(key_code), "used", "resets_at")
+        except Exception:
+            return None
+        if used is None:
+            return None
+        if resets_at and 0 < int(resets_at) <= time.time():
+            return 0  # Window ended; rolls over on the next call
+        return int(used)
+
+    def invalidate(self, key_codes: Iterable[str], discard_pending: bool = False):
+        """
+        Drop cached counters after license_keys changed underneath them.
+        Pending increments are flushed first, unless the change was a usage
+        reset that makes them meaningless (discard_pending).
+        """
+        for key_code in key_codes:
+            keys = [self._key(key_code), self.DIRTY_SET]
+            if discard_pending:
+                self._drop(keys=keys, args=[key_code, 0])
+                continue
+            # Other replicas may count calls between the flush and the drop, so
+            # only drop a counter with nothing pending and flush again otherwise
+            for _ in range(3):
+                self._flush_keys([key_code])
+                if self._drop(keys=keys, args=[key_code, 1]) != -1:
+                    break
+            else:
+                # Still busy: drop it anyway, taking what it held to Postgres
+                pending = int(self._drop(keys=keys, args=[key_code, 0]))
+                if pending:
+                    with self._lock:
+                        self._unflushed[key_code] = self._unflushed.get(key_code, 0) + pending
+                    self._flush_keys([key_code])
+
+    def _flush_keys(self, key_codes: Iterable[str]) -> int:
+        deltas: Dict[str, int] = {}
+        for key_code in key_codes:
+            pending = self._grab(keys=[self._key(key_code), self.DIRTY_SET], args=[key_code, self.idle_ttl])
+            if pending:
+                deltas[key_code] = int(pending)
+
+        with self._lock:
+            for key_code, pending in self._unflushed.items():
+                deltas[key_code] = deltas.get(key_code, 0) + pending
+            self._unflushed.clear()
+
+        if not deltas:
+            return 0
+
+        try:
+            with self.db.connection() as conn:
+                cur = conn.cursor()
+                with timed_query("usage flush"):
+                    execute_values(cur, """
+                        UPDATE license_keys AS lk
+                        SET gobot_used = GREATEST(lk.gobot_used + d.delta, 0),
+                            updated_at = NOW()
+                        FROM (VALUES %s) AS d(key_code, delta)
+                        WHERE lk.key_code = d.key_code
+                    """, list(deltas.items()))
+                conn.commit()
+        except Exception:
+            # Keep the increments so the next flush retries them
+            with self._lock:
+                for key_code, pending in deltas.items():
+                    self._unflushed[key_code] = self._unflushed.get(key_code, 0) + pending
+            raise
+
+        if self.on_flush:
+            self.on_flush(list(deltas))
+        return sum(deltas.values())
+
+    def flush(self) -> int:
+        """Write all pending increments to license_keys in one batched UPDATE"""
+        return self._flush_keys(self.redis.smembers(self.DIRTY_SET))
+
+    def reconcile(self):
+        """
+        Startup reconciliation: flush increments left behind by replicas that
+        died before flushing, then drop fully flushed counters so they are
+        re-read from Postgres.
+        """
+        flushed = self.flush()
+        dropped = 0
+        for key in self.redis.scan_iter(match=f"{self.KEY_PREFIX}*", count=500):
+            if key == self.DIRTY_SET:
+                continue
+            key_code = key[len(self.KEY_PREFIX):]
+            if self._drop(keys=[key, self.DIRTY_SET], args=[key_code, 1]) != -1:
+                dropped += 1
+        print(f"✅ Usage counters reconciled ({flushed} pending increments flushed, {dropped} counters reloaded)")
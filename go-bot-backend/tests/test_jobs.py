@@ -0,0 +1,91 @@
+import os
+import uuid
+import asyncio
+
+import pytest
+from psycopg2.extras import Json
+
+from go_bot_backend.db import DatabasePool
+from go_bot_backend.jobs import JobQueue
+from go_bot_backend.migrations import SCHEMA_VERSION, schema_version
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+
+@pytest.fixture
+def db():
+    pool = DatabasePool(DATABASE_URL, max_size=4)
+    with pool.connection() as conn:
+        if schema_version(conn) < SCHEMA_VERSION:
+            pytest.skip("Database is not migrated (python -m go_bot_backend.migrate)")
+    yield pool
+    pool.closeall()
+
+
+def delete_jobs(db, job_ids):
+    with db.connection() as conn:
+        conn.cursor().execute("DELETE FROM generation_jobs WHERE id = ANY(%s::uuid[])", (list(job_ids),))
+        conn.commit()
+
+
+def test_job_abandoned_after_max_attempts_is_handed_to_on_abandoned(db):
+    job_id = str(uuid.uuid4())
+    payload = {"accessKey": "GOBOT-TEST", "usageReserved": True}
+    with db.connection() as conn:
+        conn.cursor().execute("""
+            INSERT INTO generation_jobs (id, job_type, payload, status, attempts, lease_expires_at)
+            VALUES (%s, 'clarify', %s, 'running', 3, NOW() - INTERVAL '1 minute')
+        """, (job_id, Json(payload)))
+        conn.commit()
+
+    abandoned = []
+    queue = JobQueue(db, {}, max_attempts=3, on_abandoned=abandoned.append)
+    try:
+        assert queue._claim() is None
+        queue._claim()
+        assert abandoned == [payload]  # Once, when it's marked failed
+        job = queue.get(job_id)
+        assert job["status"] == "failed" and job["error"] == "Worker lease expired too many times"
+    finally:
+        delete_jobs(db, [job_id])
+
+
+def test_worker_survives_a_database_error_finishing_a_job(db):
+    async def handler(payload):
+        return {"ok": True}
+
+    async def main():
+        queue = JobQueue(db, {"test": handler}, workers=1, poll_interval=0.05)
+        finish = queue._finish
+        calls = []
+
+        def flaky_finish(job_id, result, error):
+            calls.append(job_id)
+            if len(calls) == 1:
+                raise RuntimeError("server closed the connection unexpectedly")
+            finish(job_id, result, error)
+
+        queue._finish = flaky_finish
+        job_ids = [queue.submit("test", {}) for _ in range(2)]
+        await queue.start()
+        try:
+            for _ in range(100):
+                if queue.get(job_ids[1])["status"] == "completed":
+                    break
+                await asyncio.sleep(0.05)
+            worker_alive = not queue._tasks[0].done()
+        finally:
+            await queue.stop()
+        return job_ids, worker_alive
+
+    job_ids, worker_alive = asyncio.run(main())
+    try:
+        assert worker_alive
+        # The first job stays claimed until its lease expires, then it's retried
+        queue = JobQueue(db, {})
+        assert [queue.get(job_id)["status"] for job_id in job_ids] == ["running", "completed"]
+    finally:
+        delete_jobs(db, job_ids)
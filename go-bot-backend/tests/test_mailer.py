@@ -0,0 +1,165 @@
+import time
+import asyncio
+
+import pytest
+
+from benchmarks.fake_mailgun import FakeMailgun
+from go_bot_backend.mailer import EmailTemplate, EmailTemplates, MailgunMailer
+
+
+TEMPLATES = {
+    "license_key": EmailTemplates(
+        subject=EmailTemplate("Your {plan_name} key"),
+        text=EmailTemplate("Key: {license_key} ({gobot_limit} a month)"),
+        html=EmailTemplate("<p>Key: <code>{license_key}</code></p>"),
+    ),
+}
+
+
+@pytest.fixture
+def fake():
+    server = FakeMailgun().start()
+    yield server
+    server.stop()
+
+
+def run_mailer(fake, scenario, **options):
+    """Run scenario(mailer) against the fake server with a started mailer"""
+    options = {"batch_window": 0.05, "retry_base": 0.01, **options}
+
+    async def main():
+        mailer = MailgunMailer("key", "mg.example.com", "GoBot <gobot@example.com>", TEMPLATES, api_base=fake.url, **options)
+        await mailer.start()
+        try:
+            return await scenario(mailer)
+        finally:
+            await mailer.stop()
+
+    return asyncio.run(main())
+
+
+def values(i: int):
+    return {"license_key": f"GOBOT-{i:04d}", "plan_name": "Pro", "gobot_limit": 500}
+
+
+def test_template_renders_and_batches_the_same_text():
+    template = EmailTemplate("Hi {name}, {count} left")
+    assert template.render(name="Ann", count=3) == "Hi Ann, 3 left"
+    assert template.batch_body == "Hi %recipient.name%, %recipient.count% left"
+    assert template.fields == {"name", "count"}
+    with pytest.raises(ValueError):
+        EmailTemplate("{count:>5}")
+
+
+def test_emails_in_one_window_are_one_batch_call(fake):
+    async def scenario(mailer):
+        for i in range(5):
+            assert mailer.send("license_key", f"user{i}@example.com", **values(i))
+        await asyncio.sleep(0.3)
+        return mailer.stats()
+
+    stats = run_mailer(fake, scenario)
+    assert fake.stats()["requests"] == 1
+    assert stats["sent"] == 5 and stats["requests"] == 1
+
+
+def test_recipient_variables_render_per_recipient(fake):
+    async def scenario(mailer):
+        for i in range(3):
+            mailer.send("license_key", f"user{i}@example.com", **values(i))
+        await asyncio.sleep(0.3)
+
+    run_mailer(fake, scenario)
+    messages = {message["to"]: message for message in fake.messages}
+    assert len(messages) == 3
+    for i in range(3):
+        message = messages[f"user{i}@example.com"]
+        assert message["subject"] == TEMPLATES["license_key"].subject.render(**values(i))
+        assert message["text"] == TEMPLATES["license_key"].text.render(**values(i))
+        assert message["html"] == TEMPLATES["license_key"].html.render(**values(i))
+
+
+def test_same_recipient_twice_is_split_into_two_calls(fake):
+    async def scenario(mailer):
+        mailer.send("license_key", "user@example.com", **values(1))
+        mailer.send("license_key", "user@example.com", **values(2))
+        await asyncio.sleep(0.3)
+
+    run_mailer(fake, scenario)
+    assert fake.stats()["requests"] == 2
+    assert sorted(message["text"] for message in fake.messages) == [
+        TEMPLATES["license_key"].text.render(**values(1)),
+        TEMPLATES["license_key"].text.render(**values(2)),
+    ]
+
+
+def test_429_is_retried_after_retry_after(fake):
+    fake.responses.append(429)
+    fake.retry_after = 0.3
+
+    async def scenario(mailer):
+        started = time.monotonic()
+        delivered = await asyncio.to_thread(mailer.deliver, "license_key", "user@example.com", **values(1))
+        return delivered, time.monotonic() - started, mailer.stats()
+
+    delivered, elapsed, stats = run_mailer(fake, scenario)
+    assert delivered
+    assert elapsed >= 0.3  # Retry-After wins over the much shorter backoff
+    assert fake.stats()["requests"] == 2 and len(fake.messages) == 1
+    assert stats["retries"] == 1 and stats["sent"] == 1
+
+
+def test_5xx_is_retried_until_it_succeeds(fake):
+    fake.responses.extend([503, 502])
+
+    async def scenario(mailer):
+        delivered = await asyncio.to_thread(mailer.deliver, "license_key", "user@example.com", **values(1))
+        return delivered, mailer.stats()
+
+    delivered, stats = run_mailer(fake, scenario)
+    assert delivered
+    assert fake.stats()["requests"] == 3
+    assert stats["retries"] == 2 and stats["failed"] == 0
+
+
+def test_gives_up_after_max_attempts_and_calls_on_failure(fake):
+    fake.responses.extend([503] * 3)
+    failed = []
+
+    async def scenario(mailer):
+        mailer.send("license_key", "a@example.com", **values(1))
+        mailer.send("license_key", "b@example.com", **values(2))
+        await asyncio.sleep(0.5)
+        return mailer.stats()
+
+    stats = run_mailer(fake, scenario, max_attempts=3, on_failure=failed.append)
+    assert fake.stats()["requests"] == 3
+    assert sorted(email.to for email in failed) == ["a@example.com", "b@example.com"]
+    assert failed[0].template == "license_key" and failed[0].values["license_key"].startswith("GOBOT-")
+    assert stats["failed"] == 2 and stats["sent"] == 0
+
+
+def test_client_errors_are_not_retried(fake):
+    failed = []
+
+    async def scenario(mailer):
+        # The fake rejects a batch that leaves a %recipient.x% variable undefined
+        return await asyncio.to_thread(mailer.deliver, "license_key", "user@example.com", license_key="GOBOT-0001")
+
+    assert run_mailer(fake, scenario, on_failure=failed.append) is False
+    assert fake.stats()["requests"] == 1 and fake.stats()["rejected"] == 1
+    assert [email.to for email in failed] == ["user@example.com"]
+
+
+def test_send_is_refused_when_not_running_or_full(fake):
+    mailer = MailgunMailer("key", "mg.example.com", "GoBot <gobot@example.com>", TEMPLATES, api_base=fake.url)
+    assert not mailer.send("license_key", "user@example.com", **values(1))
+
+    async def scenario(mailer):
+        accepted = [mailer.send("license_key", f"user{i}@example.com", **values(i)) for i in range(3)]
+        await asyncio.sleep(0.3)
+        return accepted, mailer.stats()
+
+    accepted, stats = run_mailer(fake, scenario, max_queue=2)
+    assert accepted == [True, True, False]
+    assert stats["dropped"] == 1 and stats["sent"] == 2
@@ -0,0 +1,40 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from go_bot_backend.migrations import SCHEMA_VERSION, check_query_plans, hot_queries, schema_version
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+needs_database = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def plans():
+    """Seq-scanned tables per hot query, EXPLAINed once against DATABASE_URL"""
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    try:
+        if schema_version(conn) < SCHEMA_VERSION:
+            pytest.skip("Database is not migrated (python -m go_bot_backend.migrate)")
+        return check_query_plans(conn)
+    finally:
+        conn.close()
+
+
+@needs_database
+@pytest.mark.parametrize("name", sorted(hot_queries()))
+def test_hot_query_uses_an_index(plans, name):
+    assert plans[name] == [], f"{name} would sequentially scan {', '.join(plans[name])}"
+
+
+def test_hot_queries_load_without_optional_dependencies():
+    # The deploy runs the plan check with only the required dependencies installed
+    code = "import sys; sys.modules['numpy'] = None; from go_bot_backend.migrations import hot_queries; hot_queries()"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
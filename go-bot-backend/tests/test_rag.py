@@ -0,0 +1,125 @@
+import os
+import json
+import uuid
+
+import numpy as np
+import pytest
+
+from go_bot_backend.rag import HashingEmbedder, LocalVectorIndex, SimilarTickets, VectorIndex
+
+
+DIM = 8
+
+
+def unit(i: int) -> np.ndarray:
+    vector = np.zeros(DIM, dtype=np.float32)
+    vector[i % DIM] = 1.0
+    return vector
+
+
+def check_rows(index: LocalVectorIndex, namespace: str):
+    """Every id's row holds its own vector and metadata, and rows are packed"""
+    space = index._namespaces[namespace]
+    assert sorted(space.rows.values()) == list(range(len(space.ids)))
+    for id, row in space.rows.items():
+        assert space.ids[row] == id
+        assert space.metadata[row] == {"id": id}
+        assert np.array_equal(space.vectors[row], unit(int(id)))
+
+
+def test_query_returns_best_first():
+    index = LocalVectorIndex(DIM)
+    index.upsert("ns", [(str(i), unit(i), {"id": str(i)}) for i in range(4)])
+    query = unit(2) * 0.8 + unit(1) * 0.6
+    matches = index.query("ns", query, top_k=3)
+    assert [match.id for match in matches] == ["2", "1", "0"]
+    assert matches[0].score == pytest.approx(0.8) and matches[1].score == pytest.approx(0.6)
+    assert matches[0].metadata == {"id": "2"}
+    assert index.query("other", query, top_k=3) == []
+
+
+def test_upsert_of_an_existing_id_replaces_it_in_place():
+    index = LocalVectorIndex(DIM)
+    index.upsert("ns", [(str(i), unit(i), {"id": str(i)}) for i in range(3)])
+    index.upsert("ns", [("1", unit(5), {"id": "1", "v": 2})])
+    assert index.stats()["vectors"] == 3
+    match = index.query("ns", unit(5), top_k=1)[0]
+    assert match.id == "1" and match.metadata == {"id": "1", "v": 2}
+
+
+def test_remove_moves_the_last_row_into_the_freed_slot():
+    index = LocalVectorIndex(DIM)
+    index.upsert("ns", [(str(i), unit(i), {"id": str(i)}) for i in range(5)])
+    index.delete("ns", ["1"])
+    space = index._namespaces["ns"]
+    assert space.rows["4"] == 1 and space.ids == ["0", "4", "2", "3"]
+    check_rows(index, "ns")
+    assert index.query("ns", unit(4), top_k=1)[0].id == "4"
+
+    # The last row itself, and ids that aren't there
+    index.delete("ns", ["3", "missing"])
+    index.delete("other", ["0"])
+    assert space.ids == ["0", "4", "2"]
+    check_rows(index, "ns")
+
+
+def test_full_namespace_drops_its_oldest_vector():
+    index = LocalVectorIndex(DIM, max_per_namespace=3)
+    index.upsert("ns", [(str(i), unit(i), {"id": str(i)}) for i in range(3)])
+    index.upsert("ns", [("0", unit(0), {"id": "0"})])  # Now the newest
+    index.upsert("ns", [("3", unit(3), {"id": "3"}), ("4", unit(4), {"id": "4"})])
+    assert sorted(index._namespaces["ns"].ids) == ["0", "3", "4"]
+    check_rows(index, "ns")
+
+
+def test_growth_keeps_vectors_and_namespaces_apart():
+    index = LocalVectorIndex(DIM, max_per_namespace=100)
+    index.upsert("a", [(str(i), unit(i), {"id": str(i)}) for i in range(40)])
+    index.upsert("b", [("0", unit(3), {"id": "0"})])
+    check_rows(index, "a")
+    assert index.query("b", unit(3), top_k=5)[0].id == "0"
+    assert index.stats() == {"type": "local", "namespaces": 2, "vectors": 41}
+
+
+def test_partial_index_implementation_fails_when_constructed():
+    class QueryOnly(VectorIndex):
+        def query(self, namespace, vector, top_k):
+            return []
+
+    with pytest.raises(TypeError):
+        QueryOnly()
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+
+@pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+def test_add_keeps_the_newest_tickets_per_install_and_kind():
+    from go_bot_backend.db import DatabasePool
+    from go_bot_backend.migrations import SCHEMA_VERSION, schema_version
+
+    db = DatabasePool(DATABASE_URL, max_size=2)
+    install = f"test-{uuid.uuid4().hex[:12]}"
+    try:
+        with db.connection() as conn:
+            if schema_version(conn) < SCHEMA_VERSION:
+                pytest.skip("Database is not migrated (python -m go_bot_backend.migrate)")
+
+        index = LocalVectorIndex(64)
+        rag = SimilarTickets(HashingEmbedder(64), index, db, max_per_install=3)
+        ids = [rag.add(install, "clarify", f"ticket number {i}", json.dumps({"n": i})) for i in range(5)]
+        rag.add(install, "gen-code", "ticket number 0", json.dumps({"n": 0}))
+
+        with db.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT id, kind FROM similar_tickets WHERE install = %s", (install,))
+            rows = cur.fetchall()
+        assert sorted(row["id"] for row in rows if row["kind"] == "clarify") == sorted(ids[2:])
+        assert sum(row["kind"] == "gen-code" for row in rows) == 1
+        assert sorted(index._namespaces[f"clarify:{install}"].ids) == sorted(ids[2:])
+        assert rag.stats()["pruned"] == 2
+    finally:
+        with db.connection() as conn:
+            conn.cursor().execute("DELETE FROM similar_tickets WHERE install = %s", (install,))
+            conn.commit()
+        db.closeall()
@@ -0,0 +1,73 @@
+import os
+import time
+import uuid
+import asyncio
+
+import pytest
+
+from go_bot_backend.db import DatabasePool
+from go_bot_backend.migrations import SCHEMA_VERSION, schema_version
+from go_bot_backend.stripe_events import StripeEventOutbox
+
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="DATABASE_URL is not set")
+
+
+@pytest.fixture
+def db():
+    pool = DatabasePool(DATABASE_URL, max_size=4)
+    with pool.connection() as conn:
+        if schema_version(conn) < SCHEMA_VERSION:
+            pytest.skip("Database is not migrated (python -m go_bot_backend.migrate)")
+    yield pool
+    pool.closeall()
+
+
+def statuses(db, event_ids):
+    with db.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT event_id, status FROM stripe_events WHERE event_id = ANY(%s)", (list(event_ids),))
+        by_id = {row["event_id"]: row["status"] for row in cur.fetchall()}
+    return [by_id.get(event_id) for event_id in event_ids]
+
+
+def test_worker_survives_a_database_error_finishing_an_event(db):
+    event_ids = [f"evt_test_{uuid.uuid4().hex}" for _ in range(2)]
+    handled = []
+
+    async def main():
+        outbox = StripeEventOutbox(db, lambda payload: handled.append(payload["id"]), workers=1, poll_interval=0.05)
+        finish = outbox._finish
+        calls = []
+
+        def flaky_finish(event_id):
+            calls.append(event_id)
+            if len(calls) == 1:
+                raise RuntimeError("server closed the connection unexpectedly")
+            return finish(event_id)
+
+        outbox._finish = flaky_finish
+        for event_id in event_ids:
+            outbox.record({"id": event_id, "type": "invoice.paid", "created": int(time.time()), "data": {"object": {}}})
+        await outbox.start()
+        try:
+            for _ in range(100):
+                if statuses(db, event_ids)[1] == "processed":
+                    break
+                await asyncio.sleep(0.05)
+            worker_alive = not outbox._tasks[0].done()
+        finally:
+            await outbox.stop()
+        return worker_alive
+
+    try:
+        assert asyncio.run(main())
+        assert handled == event_ids
+        # The first event stays claimed until its lease expires, then it's retried
+        assert statuses(db, event_ids) == ["processing", "processed"]
+    finally:
+        with db.connection() as conn:
+            conn.cursor().execute("DELETE FROM stripe_events WHERE event_id = ANY(%s)", (event_ids,))
+            conn.commit()
@@ -0,0 +1,50 @@
+import json
+
+from go_bot_backend.structured import StreamingArrayParser, list_fields_tool
+
+
+ANSWER = {
+    "questions": ["What is \"done\"?", "Which API, v1 or v2?", "Any [limits] {here}?"],
+    "assumptions": ["Uses the \\ separator", "Unicode é ✓"],
+    "notes": [],
+}
+
+
+def fragments(text: str, size: int):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+def test_any_split_of_the_stream_parses_the_same():
+    text = json.dumps(ANSWER)
+    for size in (1, 2, 3, 7, len(text)):
+        parser = StreamingArrayParser()
+        completed = [item for fragment in fragments(text, size) for item in parser.feed(fragment)]
+        assert parser.items == ANSWER
+        assert completed == [(key, value) for key, values in ANSWER.items() for value in values]
+
+
+def test_items_are_returned_as_soon_as_their_quote_closes():
+    parser = StreamingArrayParser()
+    assert parser.feed('{"questions": ["First') == []
+    assert parser.feed('", "Sec') == [("questions", "First")]
+    assert parser.feed('ond"') == [("questions", "Second")]
+    assert parser.items == {"questions": ["First", "Second"]}
+
+
+def test_a_cut_off_stream_keeps_what_completed():
+    parser = StreamingArrayParser()
+    parser.feed('{"questions": ["One", "Two"], "assumptions": ["Three", "Fo')
+    assert parser.items == {"questions": ["One", "Two"], "assumptions": ["Three"]}
+
+
+def test_strings_outside_top_level_arrays_are_not_items():
+    parser = StreamingArrayParser()
+    parser.feed(json.dumps({"meta": {"note": "skip", "tags": ["nested"]}, "title": "skip", "questions": ["Kept"]}))
+    assert parser.items == {"questions": ["Kept"]}
+
+
+def test_list_fields_tool_requires_every_field():
+    tool = list_fields_tool("clarify", "Clarify a ticket", {"questions": "Open questions", "notes": "Notes"})
+    schema = tool["input_schema"]
+    assert schema["required"] == ["questions", "notes"]
+    assert schema["properties"]["notes"] == {"type": "array", "items": {"type": "string"}, "description": "Notes"}